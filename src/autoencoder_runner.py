@@ -11,7 +11,7 @@ from torch.nn.parallel.distributed import DistributedDataParallel
 from myutils.common import file_util, yaml_util
 from myutils.pytorch import func_util, module_util
 from structure.logger import MetricLogger, SmoothedValue
-from utils import ae_util, main_util
+from utils import ae_util, ckpt_util, dataset_util, main_util
 
 
 def get_argparser():
@@ -19,6 +19,8 @@ def get_argparser():
     argparser.add_argument('--config', required=True, help='yaml file path')
     argparser.add_argument('--device', default='cuda', help='device')
     argparser.add_argument('-test_only', action='store_true', help='only test model')
+    argparser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                           help='precision of the forward passes (bf16 uses autocast and channels_last)')
     argparser.add_argument('-extended_only', action='store_true', help='test extended model only')
     # distributed training parameters
     argparser.add_argument('--world_size', default=1, type=int, help='number of distributed processes')
@@ -39,7 +41,8 @@ def resume_from_ckpt(ckpt_file_path, autoencoder):
     return start_epoch, checkpoint['best_value']
 
 
-def train_epoch(autoencoder, head_model, train_loader, optimizer, criterion, epoch, device, interval):
+def train_epoch(autoencoder, head_model, train_loader, optimizer, criterion, epoch, device, interval,
+                precision='fp32'):
     autoencoder.train()
     head_model.eval()
     metric_logger = MetricLogger(delimiter='  ')
@@ -48,40 +51,79 @@ def train_epoch(autoencoder, head_model, train_loader, optimizer, criterion, epo
     header = 'Epoch: [{}]'.format(epoch)
     for sample_batch, targets in metric_logger.log_every(train_loader, interval, header):
         start_time = time.time()
-        sample_batch = sample_batch.to(device)
+        with metric_logger.time_transfer():
+            sample_batch = main_util.to_channels_last(sample_batch.to(device), precision)
         optimizer.zero_grad()
-        head_outputs = head_model(sample_batch)
-        ae_outputs = autoencoder(head_outputs)
-        loss = criterion(ae_outputs, head_outputs) if not isinstance(ae_outputs, tuple) else ae_outputs[1]
+        with main_util.autocast(precision, device):
+            head_outputs = head_model(sample_batch)
+            ae_outputs = autoencoder(head_outputs)
+        # losses are computed in fp32
+        loss = criterion(ae_outputs.float(), head_outputs.float()) if not isinstance(ae_outputs, tuple) \
+            else ae_outputs[1].float()
         loss.backward()
         optimizer.step()
         batch_size = sample_batch.shape[0]
-        metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        metric_logger.update(loss=loss, lr=optimizer.param_groups[0]['lr'])
         metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+    return metric_logger
+
+
+def train_epoch_from_cache(autoencoder, feature_cache, optimizer, criterion, epoch, device, interval, batch_size,
+                           precision='fp32'):
+    """
+    Same as train_epoch, but the head outputs are read from the feature cache (see ae_util.cache_head_outputs) instead
+    of being computed.
+    """
+    autoencoder.train()
+    metric_logger = MetricLogger(delimiter='  ')
+    metric_logger.add_meter('lr', SmoothedValue(window_size=1, fmt='{value}'))
+    metric_logger.add_meter('img/s', SmoothedValue(window_size=10, fmt='{value}'))
+    header = 'Epoch: [{}]'.format(epoch)
+    cache_loader = dataset_util.get_loader(feature_cache, shuffle=True, batch_size=batch_size,
+                                           pin_memory=device.type == 'cuda')
+    for head_outputs, _ in metric_logger.log_every(cache_loader, interval, header):
+        start_time = time.time()
+        with metric_logger.time_transfer():
+            head_outputs = main_util.to_channels_last(head_outputs.to(device, non_blocking=True).float(), precision)
+        optimizer.zero_grad()
+        with main_util.autocast(precision, device):
+            ae_outputs = autoencoder(head_outputs)
+        # losses are computed in fp32
+        loss = criterion(ae_outputs.float(), head_outputs) if not isinstance(ae_outputs, tuple) \
+            else ae_outputs[1].float()
+        loss.backward()
+        optimizer.step()
+        batch_size = head_outputs.shape[0]
+        metric_logger.update(loss=loss, lr=optimizer.param_groups[0]['lr'])
+        metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+    return metric_logger
 
 
 @torch.no_grad()
-def evaluate(model, data_loader, device, interval=1000, split_name='Test', title=None):
+def evaluate(model, data_loader, device, interval=1000, split_name='Test', title=None, precision='fp32'):
     if title is not None:
         print(title)
 
     num_threads = torch.get_num_threads()
-    torch.set_num_threads(1)
+    torch.set_num_threads(main_util.get_eval_threads())
+    model = main_util.to_channels_last(model, precision)
     model.eval()
     metric_logger = MetricLogger(delimiter='  ')
     header = '{}:'.format(split_name)
     with torch.no_grad():
         for image, target in metric_logger.log_every(data_loader, interval, header):
-            image = image.to(device, non_blocking=True)
-            target = target.to(device, non_blocking=True)
-            output = model(image)
+            with metric_logger.time_transfer():
+                image = main_util.to_channels_last(image.to(device, non_blocking=True), precision)
+                target = target.to(device, non_blocking=True)
+            with main_util.autocast(precision, device):
+                output = model(image).float()
 
             acc1, acc5 = main_util.compute_accuracy(output, target, topk=(1, 5))
             # FIXME need to take into account that the datasets
             # could have been padded in distributed setup
             batch_size = image.shape[0]
-            metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-            metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
+            metric_logger.meters['acc1'].update(acc1, n=batch_size)
+            metric_logger.meters['acc5'].update(acc5, n=batch_size)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -92,12 +134,12 @@ def evaluate(model, data_loader, device, interval=1000, split_name='Test', title
     return metric_logger.acc1.global_avg
 
 
-def validate(ae_without_ddp, data_loader, config, device, distributed, device_ids):
+def validate(ae_without_ddp, data_loader, config, device, distributed, device_ids, precision='fp32'):
     input_shape = config['input_shape']
     extended_model, _ = ae_util.get_extended_model(ae_without_ddp, config, input_shape, device, True)
     if distributed:
         extended_model = DistributedDataParallel(extended_model, device_ids=device_ids)
-    return evaluate(extended_model, data_loader, device, split_name='Validation')
+    return evaluate(extended_model, data_loader, device, split_name='Validation', precision=precision)
 
 
 def save_ckpt(autoencoder, epoch, best_avg_loss, ckpt_file_path, ae_type):
@@ -109,16 +151,16 @@ def save_ckpt(autoencoder, epoch, best_avg_loss, ckpt_file_path, ae_type):
         'epoch': epoch + 1,
         'best_value': best_avg_loss
     }
-    file_util.make_parent_dirs(ckpt_file_path)
-    torch.save(state, ckpt_file_path)
+    ckpt_util.save_async(state, ckpt_file_path)
 
 
-def train(train_loader, valid_loader, input_shape, config, device, distributed, device_ids):
+def train(train_loader, valid_loader, input_shape, config, device, distributed, device_ids, precision='fp32'):
     ae_without_ddp, ae_type = ae_util.get_autoencoder(config, device)
-    head_model = ae_util.get_head_model(config, input_shape, device)
+    head_model = main_util.to_channels_last(ae_util.get_head_model(config, input_shape, device), precision)
     module_util.freeze_module_params(head_model)
     ckpt_file_path = config['autoencoder']['ckpt']
     start_epoch, best_valid_acc = resume_from_ckpt(ckpt_file_path, ae_without_ddp)
+    ae_without_ddp = main_util.to_channels_last(ae_without_ddp, precision)
     if best_valid_acc is None:
         best_valid_acc = 0.0
 
@@ -142,14 +184,30 @@ def train(train_loader, valid_loader, input_shape, config, device, distributed,
         autoencoder = DataParallel(ae_without_ddp)
         head_model = DataParallel(head_model)
 
+    # optional cache of the head outputs, refreshed every 'refresh' epochs (0: computed once)
+    cache_config = train_config.get('feature_cache', None)
+    feature_cache = None
+    if cache_config is not None and distributed:
+        cache_config = dict(cache_config, file='{}.{}'.format(cache_config['file'], main_util.get_rank()))
+
     end_epoch = start_epoch + train_config['epoch']
     start_time = time.time()
     for epoch in range(start_epoch, end_epoch):
         if distributed:
             train_loader.sampler.set_epoch(epoch)
 
-        train_epoch(autoencoder, head_model, train_loader, optimizer, criterion, epoch, device, interval)
-        valid_acc = validate(ae_without_ddp, valid_loader, config, device, distributed, device_ids)
+        if cache_config is None:
+            train_epoch(autoencoder, head_model, train_loader, optimizer, criterion, epoch, device, interval,
+                        precision)
+        else:
+            refresh = cache_config.get('refresh', 0)
+            if feature_cache is None or (refresh > 0 and (epoch - start_epoch) % refresh == 0):
+                print('Caching head outputs to {}'.format(cache_config['file']))
+                feature_cache = ae_util.cache_head_outputs(head_model, train_loader, cache_config['file'], device,
+                                                           precision, cache=feature_cache)
+            train_epoch_from_cache(autoencoder, feature_cache, optimizer, criterion, epoch, device, interval,
+                                   train_loader.batch_size, precision)
+        valid_acc = validate(ae_without_ddp, valid_loader, config, device, distributed, device_ids, precision)
         if valid_acc > best_valid_acc and main_util.is_main_process():
             print('Updating ckpt (Best top1 accuracy: {:.4f} -> {:.4f})'.format(best_valid_acc, valid_acc))
             best_valid_acc = valid_acc
@@ -158,24 +216,26 @@ def train(train_loader, valid_loader, input_shape, config, device, distributed,
 
     dist.barrier()
     total_time = time.time() - start_time
+    ckpt_util.wait()
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
     del head_model
 
 
 def run(args):
-    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url)
+    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url, args.device)
     device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
     if device.type == 'cuda':
         cudnn.benchmark = True
 
     print(args)
     config = yaml_util.load_yaml_file(args.config)
+    main_util.set_eval_policy(config['test'].get('threads', None), config['test'].get('workers', 1))
     input_shape = config['input_shape']
     ckpt_file_path = config['autoencoder']['ckpt']
     train_loader, valid_loader, test_loader = main_util.get_data_loaders(config, distributed)
     if not args.test_only:
-        train(train_loader, valid_loader, input_shape, config, device, distributed, device_ids)
+        train(train_loader, valid_loader, input_shape, config, device, distributed, device_ids, args.precision)
 
     autoencoder, _ = ae_util.get_autoencoder(config, device)
     resume_from_ckpt(ckpt_file_path, autoencoder)
@@ -184,13 +244,13 @@ def run(args):
         if device.type == 'cuda':
             model = DistributedDataParallel(model, device_ids=device_ids) if distributed \
                 else DataParallel(model)
-        evaluate(model, test_loader, device, title='[Original model]')
+        evaluate(model, test_loader, device, title='[Original model]', precision=args.precision)
 
     if device.type == 'cuda':
         extended_model = DistributedDataParallel(extended_model, device_ids=device_ids) if distributed \
             else DataParallel(extended_model)
 
-    evaluate(extended_model, test_loader, device, title='[Mimic model]')
+    evaluate(extended_model, test_loader, device, title='[Mimic model]', precision=args.precision)
 
 
 if __name__ == '__main__':
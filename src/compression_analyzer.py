@@ -1,14 +1,13 @@
 import argparse
-import sys
-import zlib
 
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
+from torch import nn
 
 from myutils.common import file_util, yaml_util
-from structure.wrapper import CompressionWrapper, RunTimeWrapper
+from structure.wrapper import CompressionPool, CompressionWrapper, RunTimeWrapper
 from utils import misc_util, module_util, module_wrap_util, dataset_util
 
 
@@ -19,6 +18,13 @@ def get_argparser():
     parser.add_argument('--mode', default='comp_rate', help='evaluation option')
     parser.add_argument('--comp_layer', type=int, default=-1, help='index of layer to compress its input'
                                                                    ' (starts from 1, no compression if 0 is given)')
+    parser.add_argument('--sample_interval', type=int, default=1,
+                        help='compress only one batch every sample_interval batches')
+    parser.add_argument('--reservoir', type=int, default=0,
+                        help='compress a uniform reservoir of that many samples per layer (0: all the sampled ones)')
+    parser.add_argument('--comp_workers', type=int, default=4,
+                        help='threads compressing off the forward path (0: compress inline)')
+    parser.add_argument('--trace', help='run_time mode: Chrome trace file path, with a profiler range per module')
     parser.add_argument('-cpu', action='store_true', help='use CPU')
     return parser
 
@@ -56,18 +62,25 @@ def save_ckpt(model, acc, epoch, ckpt_file_path, model_type):
     torch.save(state, ckpt_file_path)
 
 
-def test(model, test_loader, device, data_type='Test'):
+def test(model, test_loader, device, data_type='Test', input_wrapper=None):
+    """
+    Args:
+        model:
+        test_loader:
+        device:
+        data_type:
+        input_wrapper (CompressionWrapper): wrapper measuring the compression of the inputs, if any
+
+    Returns (tuple): accuracy and, if input_wrapper is given, its average original and compressed input sizes
+
+    """
     model.eval()
     correct = 0
     total = 0
-    data_size = 0
-    compressed_data_size = 0
     with torch.no_grad():
         for batch_idx, (inputs, targets) in enumerate(test_loader):
-            np_input = inputs.clone().cpu().detach().numpy()
-            data_size += np_input.nbytes
-            compressed_input = zlib.compress(np_input, 9)
-            compressed_data_size += sys.getsizeof(compressed_input)
+            if input_wrapper is not None:
+                inputs = input_wrapper(inputs)
             inputs, targets = inputs.to(device), targets.to(device)
             outputs = model(inputs)
             _, predicted = outputs.max(1)
@@ -76,7 +89,11 @@ def test(model, test_loader, device, data_type='Test'):
 
     acc = 100.0 * correct / total
     print('\n{} set: Accuracy: {}/{} ({:.4f}%)\n'.format(data_type, correct, total, acc))
-    return acc, data_size / total, compressed_data_size / total
+    if input_wrapper is None:
+        return acc, None, None
+
+    input_wrapper.finalize()
+    return acc, input_wrapper.get_average_org_data_size(), input_wrapper.get_average_compressed_data_size()
 
 
 def validate(model, valid_loader, epoch, device, best_acc, ckpt_file_path, model_type):
@@ -87,27 +104,40 @@ def validate(model, valid_loader, epoch, device, best_acc, ckpt_file_path, model
     return best_acc
 
 
-def extract_compression_rates(parent_module, org_data_size_list, compressed_data_size_list, name_list):
+def extract_compression_rates(parent_module, org_data_size_list, compressed_data_size_list, name_list,
+                              interval_list=None):
     for name, child_module in parent_module.named_children():
         if isinstance(child_module, CompressionWrapper):
+            child_module.finalize()
             org_data_size_list.append(child_module.get_average_org_data_size())
             compressed_data_size_list.append(child_module.get_average_compressed_data_size())
             name_list.append(type(child_module.org_module).__name__)
+            if interval_list is not None:
+                interval_list.append(child_module.get_compression_rate_interval())
         elif list(child_module.children()):
-            extract_compression_rates(child_module, org_data_size_list, compressed_data_size_list, name_list)
+            extract_compression_rates(child_module, org_data_size_list, compressed_data_size_list, name_list,
+                                      interval_list)
         else:
             print('CompressionWrapper is missing for {}: {}'.format(name, type(child_module).__name__))
 
 
-def plot_compression_rates(model, avg_input_data_size, avg_compressed_input_data_size):
+def plot_compression_rates(model, input_wrapper):
     org_data_size_list = list()
     compressed_data_size_list = list()
     name_list = list()
+    interval_list = list()
+    avg_input_data_size = input_wrapper.get_average_org_data_size()
+    avg_compressed_input_data_size = input_wrapper.get_average_compressed_data_size()
     org_data_size_list.append(avg_input_data_size)
     compressed_data_size_list.append(avg_compressed_input_data_size)
     name_list.append('Input')
-    extract_compression_rates(model, org_data_size_list, compressed_data_size_list, name_list)
+    interval_list.append(input_wrapper.get_compression_rate_interval())
+    extract_compression_rates(model, org_data_size_list, compressed_data_size_list, name_list, interval_list)
     xs = list(range(len(org_data_size_list)))
+    print('Layer\tCompression Rate 95% CI')
+    for i in range(len(xs)):
+        print('{}\t[{:.4f}, {:.4f}]'.format(name_list[i], *interval_list[i]))
+
     if not misc_util.check_if_plottable():
         print('Average Input Data Size: {}\tCompressed: {}'.format(avg_input_data_size, avg_compressed_input_data_size))
         print('Layer\tOriginal Data Size\tCompressed Data Size')
@@ -125,39 +155,46 @@ def plot_compression_rates(model, avg_input_data_size, avg_compressed_input_data
     plt.show()
 
 
-def analyze_compression_rate(model, input_shape, test_loader, device):
+def analyze_compression_rate(model, input_shape, test_loader, device, sample_interval=1, reservoir_size=0,
+                             num_workers=4):
+    pool = CompressionPool(num_workers) if num_workers > 0 else None
     input_batch = torch.rand(input_shape).unsqueeze(0).to(device)
-    module_wrap_util.wrap_decomposable_modules(model, CompressionWrapper, input_batch)
-    _, avg_input_data_size, avg_compressed_input_data_size = test(model, test_loader, device)
-    plot_compression_rates(model, avg_input_data_size, avg_compressed_input_data_size)
+    module_wrap_util.wrap_decomposable_modules(model, CompressionWrapper, input_batch, sample_interval=sample_interval,
+                                               reservoir_size=reservoir_size, pool=pool)
+    input_wrapper = CompressionWrapper(nn.Identity(), sample_interval=sample_interval, reservoir_size=reservoir_size,
+                                       pool=pool)
+    test(model, test_loader, device, input_wrapper=input_wrapper)
+    plot_compression_rates(model, input_wrapper)
 
 
-def extract_running_times(wrapped_modules):
-    num_samples = len(wrapped_modules[0].get_timestamps())
-    start_times = np.array(wrapped_modules[0].start_timestamp_list)
-    time_mat = np.zeros((num_samples, len(wrapped_modules)))
-    comp_time_mat = np.zeros_like(time_mat)
-    for i, wrapped_module in enumerate(wrapped_modules):
-        target_times = np.array(wrapped_module.get_compression_timestamps() if wrapped_module.is_compressed
-                                else wrapped_module.get_timestamps())
-        time_mat[:, i] = (target_times - start_times).reshape(1, start_times.size)
-        if wrapped_module.is_compressed:
-            comp_time_mat[:, i] = np.array(wrapped_module.get_compression_time_list()).reshape(1, start_times.size)
-    return time_mat, comp_time_mat
+def extract_running_times(wrapped_modules, percentiles=(50, 99)):
+    """
+    Args:
+        wrapped_modules (list): RunTimeWrapper modules, in order
+        percentiles (tuple): percentiles of the accumulated elapsed times to extract
+
+    Returns (tuple): mean accumulated elapsed times, mean compression times (in seconds, one entry per module) and
+        a matrix of the percentiles of the accumulated elapsed times (one row per module)
+
+    """
+    mean_times = np.array([wrapped_module.elapsed_time_stats.mean for wrapped_module in wrapped_modules]) * 1e-9
+    mean_comp_times = np.array([wrapped_module.comp_time_stats.mean for wrapped_module in wrapped_modules]) * 1e-9
+    percentile_mat = np.array([[wrapped_module.elapsed_time_stats.percentile(q) for q in percentiles]
+                               for wrapped_module in wrapped_modules]) * 1e-9
+    return mean_times, mean_comp_times, percentile_mat
 
 
 def plot_running_time(wrapped_modules):
     name_list = ['{}{}: {}'.format(type(wrapped_module.org_module).__name__,
                                    '*' if wrapped_module.is_compressed else '', i + 1)
                  for i, wrapped_module in enumerate(wrapped_modules)]
-    time_mat, comp_time_mat = extract_running_times(wrapped_modules)
-    mean_times = time_mat.mean(axis=0)
-    mean_comp_times = comp_time_mat.mean(axis=0)
+    mean_times, mean_comp_times, percentile_mat = extract_running_times(wrapped_modules)
     xs = list(range(len(name_list)))
     if not misc_util.check_if_plottable():
-        print('Layer\tAverage Accumulated Elapsed Time\tAverage Elapsed Time for Compression')
+        print('Layer\tAverage Accumulated Elapsed Time\tAverage Elapsed Time for Compression'
+              '\tp50 Accumulated Elapsed Time\tp99 Accumulated Elapsed Time')
         for i in range(len(xs)):
-            print('{}\t{}\t{}'.format(name_list[i], mean_times[i], mean_comp_times[i]))
+            print('{}\t{}\t{}\t{}\t{}'.format(name_list[i], mean_times[i], mean_comp_times[i], *percentile_mat[i]))
         return
 
     fig, ax1 = plt.subplots()
@@ -171,16 +208,18 @@ def plot_running_time(wrapped_modules):
 
     ax2 = ax1.twinx()
     ax2.plot(xs, mean_times, 'r--')
+    ax2.fill_between(xs, percentile_mat[:, 0], percentile_mat[:, 1], color='r', alpha=0.2)
     ax2.set_ylabel('Average Accumulated Elapsed Time [sec]', color='r')
     plt.tight_layout()
     plt.show()
 
 
-def analyze_running_time(model, input_shape, comp_layer_idx, test_loader, device):
+def analyze_running_time(model, input_shape, comp_layer_idx, test_loader, device, trace_file_path=None):
     wrapped_modules = list()
     input_batch = torch.rand(input_shape).unsqueeze(0).to(device)
     module_wrap_util.wrap_decomposable_modules(model, RunTimeWrapper, input_batch,
-                                               wrapped_list=wrapped_modules)
+                                               wrapped_list=wrapped_modules,
+                                               record_function=trace_file_path is not None)
     wrapped_modules[0].is_first = True
     if comp_layer_idx < 0:
         for wrapped_module in wrapped_modules:
@@ -188,7 +227,14 @@ def analyze_running_time(model, input_shape, comp_layer_idx, test_loader, device
     elif 0 < comp_layer_idx <= len(wrapped_modules):
         wrapped_modules[comp_layer_idx - 1].is_compressed = True
 
-    _, avg_input_data_size, _ = test(model, test_loader, device)
+    if trace_file_path is None:
+        test(model, test_loader, device)
+    else:
+        # the profiler keeps every event, unlike the wrappers' statistics
+        with torch.profiler.profile() as prof:
+            test(model, test_loader, device)
+        file_util.make_parent_dirs(trace_file_path)
+        prof.export_chrome_trace(trace_file_path)
     plot_running_time(wrapped_modules)
 
 
@@ -219,9 +265,10 @@ def run(args):
     analysis_mode = args.mode
     model.eval()
     if analysis_mode == 'comp_rate':
-        analyze_compression_rate(model, input_shape, test_loader, device)
+        analyze_compression_rate(model, input_shape, test_loader, device, args.sample_interval, args.reservoir,
+                                 args.comp_workers)
     elif analysis_mode == 'run_time':
-        analyze_running_time(model, input_shape, args.comp_layer, test_loader, device)
+        analyze_running_time(model, input_shape, args.comp_layer, test_loader, device, args.trace)
     else:
         raise ValueError('mode argument `{}` is not expected'.format(analysis_mode))
 
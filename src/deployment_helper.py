@@ -11,7 +11,7 @@ from torch.nn.parallel import DistributedDataParallel
 from model_distiller import load_ckpt
 from myutils.common import file_util, yaml_util
 from myutils.pytorch import tensor_util
-from utils import mimic_util, module_util, dataset_util
+from utils import mimic_util, module_util, dataset_util, profile_util
 
 
 def get_argparser():
@@ -29,6 +29,7 @@ def get_argparser():
     argparser.add_argument('-scpu', action='store_true', help='option to make sensor-side model runnable without cuda')
     argparser.add_argument('-ecpu', action='store_true', help='option to make edge-server model runnable without cuda')
     argparser.add_argument('-test', action='store_true', help='option to check if performance changes after splitting')
+    profile_util.add_argument(argparser)
     return argparser
 
 
@@ -68,11 +69,12 @@ def test_split_model(model, head_network, tail_network, sensor_device, edge_devi
     head_proc_time_list = list()
     tail_proc_time_list = list()
     with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(test_loader):
+        for batch_idx, (inputs, targets) in enumerate(profile_util.iterate(test_loader)):
             total += targets.size(0)
             inputs, targets = inputs.to(sensor_device), targets.to(edge_device)
             head_start_time = time.time()
-            zs = head_network(inputs)
+            with profile_util.record('student_head'):
+                zs = head_network(inputs)
             if spbit in ['8bits', '16bits']:
                 if spbit == '8bits':
                     # Quantization and dequantization
@@ -90,13 +92,15 @@ def test_split_model(model, head_network, tail_network, sensor_device, edge_devi
                 head_end_time = time.time()
                 file_size_list.append(file_util.get_binary_object_size(zs))
 
-            preds = tail_network(zs.to(edge_device))
+            with profile_util.record('tail'):
+                preds = tail_network(zs.to(edge_device))
             tail_end_time = time.time()
             sub_correct_count, sub_test_loss = predict(preds, targets)
             split_correct_count += sub_correct_count
             split_test_loss += sub_test_loss
             inputs, targets = inputs.to(device), targets.to(device)
-            preds = model(inputs)
+            with profile_util.record('forward'):
+                preds = model(inputs)
             sub_correct_count, sub_test_loss = predict(preds, targets)
             org_correct_count += sub_correct_count
             org_test_loss += sub_test_loss
@@ -184,6 +188,8 @@ def convert_model(model, device, output_file_path):
 def run(args):
     print(args)
     config = yaml_util.load_yaml_file(args.config)
+    if args.profile is not None:
+        profile_util.start(args.profile, profile_util.get_output_dir(config, 'deployment_helper'))
     sensor_device = torch.device('cpu' if args.scpu else 'cuda')
     edge_device = torch.device('cpu' if args.ecpu else 'cuda')
     partition_idx = args.partition
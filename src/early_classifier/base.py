@@ -107,6 +107,15 @@ class BaseClassifier:
     def load(self, filename):
         raise NotImplementedError('method must be implemented')
 
+    def export(self, filename):
+        """
+        Exports the model as a compact file that ee_runtime.model_io.load reads with numpy only.
+        Args:
+            filename (str): destination .npz file
+
+        """
+        raise NotImplementedError('method must be implemented')
+
     def get_prediction_confidences(self, y):
         raise NotImplementedError('method must be implemented')
 
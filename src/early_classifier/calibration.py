@@ -0,0 +1,82 @@
+import numpy as np
+import torch
+
+
+class ConfidenceCalibration:
+    """
+    Sorted summary of the confidences observed on the training set, used to turn a quantile threshold into the
+    confidence value that an early prediction has to reach. The summary is updated in bulk (once per fit) and the
+    quantiles are cached, so that repeated threshold lookups at evaluation time are O(1). When serialized, summaries
+    larger than max_size are compressed to max_size evenly spaced quantiles.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.values = np.empty(0, dtype=np.float32)
+        self.count = 0
+        self._quantiles = dict()
+
+    def __len__(self):
+        return self.count
+
+    def reset(self):
+        self.values = np.empty(0, dtype=np.float32)
+        self.count = 0
+        self._quantiles = dict()
+
+    def update(self, confidences):
+        """
+        Merges a bulk of new confidences into the summary.
+        Args:
+            confidences (Tensor or np.ndarray or list): confidences to add
+
+        """
+        if torch.is_tensor(confidences):
+            confidences = confidences.detach().cpu().numpy()
+        confidences = np.asarray(confidences, dtype=np.float32).reshape(-1)
+        self.values = np.sort(np.concatenate((self.values, confidences)), kind='stable')
+        self.count += confidences.size
+        self._quantiles = dict()
+
+    def quantile(self, q):
+        """
+        Args:
+            q (float): quantile in [0, 1]
+
+        Returns (float): the q-th quantile of the observed confidences (linear interpolation, as np.quantile)
+
+        """
+        if q not in self._quantiles:
+            if self.values.size == 0:
+                raise ValueError('Cannot compute a quantile before any confidence has been observed.')
+            position = q * (self.values.size - 1)
+            lower = int(np.floor(position))
+            upper = min(lower + 1, self.values.size - 1)
+            self._quantiles[q] = float(self.values[lower] + (self.values[upper] - self.values[lower]) * (position - lower))
+        return self._quantiles[q]
+
+    def to_state_dict(self):
+        values = self.values
+        if values.size > self.max_size:
+            values = np.quantile(values, np.linspace(0, 1, self.max_size)).astype(np.float32)
+        return dict({
+            'values': values,
+            'count': self.count,
+            'max_size': self.max_size
+        })
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        calibration = cls(state_dict['max_size'])
+        calibration.values = np.asarray(state_dict['values'], dtype=np.float32)
+        calibration.count = state_dict['count']
+        return calibration
+
+    @classmethod
+    def from_confidences(cls, confidences, max_size=4096):
+        """
+        Builds the summary from a raw collection of confidences (e.g., the list stored by older checkpoints).
+        """
+        calibration = cls(max_size)
+        calibration.update(confidences)
+        return calibration
@@ -1,3 +1,6 @@
+import copy
+
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
@@ -26,20 +29,59 @@ class EmbeddingDataset(Dataset):
         #    embeddings = torch.nn.BatchNorm2d(3)(embeddings)
         #    embeddings = embeddings.reshape(embeddings.shape[0], embedding_size)
 
-        self.data = embeddings[labels < n_classes]
-        self.targets = labels[labels < n_classes]
-        self.confidences = confidences[labels < n_classes]
+        # samples out of the label subset are hidden by an index view instead of copying the storage
+        in_subset = np.asarray(labels < n_classes)
+        self._data = embeddings
+        self._targets = labels
+        self._confidences = confidences
+        self.indexes = None if in_subset.all() else np.flatnonzero(in_subset)
         self.transform = transform
 
+    @property
+    def data(self):
+        return self._data if self.indexes is None else _take(self._data, self.indexes)
+
+    @property
+    def targets(self):
+        return self._targets if self.indexes is None else _take(self._targets, self.indexes)
+
+    @property
+    def confidences(self):
+        return self._confidences if self.indexes is None else _take(self._confidences, self.indexes)
+
+    def subset(self, indexes):
+        """
+        Restrict the dataset to the given indexes, sharing the underlying storage with this dataset.
+        Args:
+            indexes (np.ndarray): indexes relative to this dataset
+
+        Returns (EmbeddingDataset):
+
+        """
+        view = copy.copy(self)
+        indexes = np.asarray(indexes, dtype=np.int64)
+        view.indexes = indexes if self.indexes is None else self.indexes[indexes]
+        return view
+
+    def get_storage(self):
+        """
+        Returns (tuple): the underlying embeddings and labels, and the indexes of the samples of this dataset in them
+        (None if the dataset is not a subset)
+
+        """
+        return self._data, self._targets, self.indexes
+
     def __len__(self):
-        return len(self.targets)
+        return len(self._targets) if self.indexes is None else len(self.indexes)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
+        if self.indexes is not None:
+            idx = self.indexes[idx]
 
-        embedding = self.data[idx]
-        label = self.targets[idx]
+        embedding = _take(self._data, idx)
+        label = _take(self._targets, idx)
 
         sample = (embedding, label)
 
@@ -62,3 +104,9 @@ class EmbeddingDataset(Dataset):
             self.normalizer.eval()
             return self.normalizer(samples)
     '''
+
+
+def _take(storage, idx):
+    if torch.is_tensor(storage) and isinstance(idx, np.ndarray):
+        idx = torch.from_numpy(idx)
+    return storage[idx]
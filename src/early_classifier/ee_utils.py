@@ -1,25 +1,47 @@
+import importlib
 import numpy as np
 
+from collections.abc import Mapping
 from typing import Dict, Type
 
 from early_classifier.base import BaseClassifier
-from early_classifier.faiss_kmeans import FaissKMeansClassifier
-from early_classifier.faiss_knn import FaissKNNClassifier
-from early_classifier.gmml import GMMLClassifier
-from early_classifier.knn import KNNClassifier
-from early_classifier.linear import LinearClassifier
-from early_classifier.kmeans import KMeansClassifier
-from early_classifier.sdgm import SDGMClassifier
-
-models: Dict[str, Type[BaseClassifier]] = {
-    'kmeans': KMeansClassifier,
-    'linear': LinearClassifier,
-    'faiss_kmeans': FaissKMeansClassifier,
-    'sdgm': SDGMClassifier,
-    'gmm_layer': GMMLClassifier,
-    'knn': KNNClassifier,
-    'faiss_knn': FaissKNNClassifier
-}
+
+
+class LazyModelRegistry(Mapping):
+    """
+    Early exit model type -> classifier class, importing the module of a class only when that type is first looked
+    up, so that importing ee_utils does not pull in faiss, sklearn or the GMM layers of the unused classifiers.
+    """
+
+    def __init__(self, class_paths):
+        self.class_paths = class_paths
+        self.classes: Dict[str, Type[BaseClassifier]] = dict()
+
+    def __getitem__(self, ee_type):
+        if ee_type not in self.classes:
+            module_name, class_name = self.class_paths[ee_type].rsplit('.', 1)
+            self.classes[ee_type] = getattr(importlib.import_module(module_name), class_name)
+        return self.classes[ee_type]
+
+    def __contains__(self, ee_type):
+        return ee_type in self.class_paths
+
+    def __iter__(self):
+        return iter(self.class_paths)
+
+    def __len__(self):
+        return len(self.class_paths)
+
+
+models = LazyModelRegistry({
+    'kmeans': 'early_classifier.kmeans.KMeansClassifier',
+    'linear': 'early_classifier.linear.LinearClassifier',
+    'faiss_kmeans': 'early_classifier.faiss_kmeans.FaissKMeansClassifier',
+    'sdgm': 'early_classifier.sdgm.SDGMClassifier',
+    'gmm_layer': 'early_classifier.gmml.GMMLClassifier',
+    'knn': 'early_classifier.knn.KNNClassifier',
+    'faiss_knn': 'early_classifier.faiss_knn.FaissKNNClassifier'
+})
 
 
 class UnknownEETypeError(BaseException):
@@ -46,7 +68,10 @@ def iterate_configurations(ee_type, params, device, bn_shape, thresholds='auto')
                  'criterion_config': params['criterion'],
                  'validation_dataset': None,
                  'batch_size': params['batch_size'],
-                 'epochs': params['epoch']}
+                 'epochs': params['epoch'],
+                 'solver': params.get('solver', 'sgd'),
+                 'l2': params.get('l2', 0.0),
+                 'max_iter': params.get('max_iter', 100)}
                 for classes_subset in params['labels_subsets']], thresholds
     elif ee_type == 'faiss_kmeans':
         return [{'device': device,
@@ -65,7 +90,10 @@ def iterate_configurations(ee_type, params, device, bn_shape, thresholds='auto')
                  'validation_dataset': None,
                  'per_label_components': params['per_label_components'],
                  'batch_size': params['batch_size'],
-                 'epochs': params['epoch']}
+                 'epochs': params['epoch'],
+                 'cov_type': params.get('cov_type', 'full'),
+                 'rank': params.get('rank', 16),
+                 'bn_shape': tuple(bn_shape)}
                 for classes_subset in params['labels_subsets']], thresholds
     elif ee_type == 'gmm_layer':
         return [{'device': device,
@@ -136,12 +164,6 @@ def get_ee_model(ee_config, device, bn_shape, pre_trained=False, conf_idx=-1):
     return ee_model
 
 
-def get_model_type(model_cls):
-    for k, c in models.items():
-        if c == model_cls:
-            return k
-
-
 '''
 def requires_normalization(model_type):
     if model_type == 'gmm_layer':
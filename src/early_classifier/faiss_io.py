@@ -0,0 +1,75 @@
+import json
+import os
+
+import faiss
+import numpy as np
+
+from utils import ckpt_util
+
+MANIFEST_FILE_NAME = 'manifest.json'
+INDEX_FILE_NAME = 'index.faiss'
+
+
+def is_dir_format(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE_NAME))
+
+
+def write_dir(state, dir_path):
+    """
+    Writes the index with faiss.write_index, every array as a raw .npy file and a JSON manifest listing them along
+    with the (JSON serializable) metadata.
+    Args:
+        state (dict): 'index' (CPU faiss index), 'arrays' (dict of np.ndarray) and 'metadata' (dict)
+        dir_path (str): destination directory (existing)
+
+    """
+    faiss.write_index(state['index'], os.path.join(dir_path, INDEX_FILE_NAME))
+    for name, array in state['arrays'].items():
+        np.save(os.path.join(dir_path, '{}.npy'.format(name)), array, allow_pickle=False)
+
+    manifest = dict(state['metadata'], index=INDEX_FILE_NAME, arrays=sorted(state['arrays'].keys()))
+    with open(os.path.join(dir_path, MANIFEST_FILE_NAME), 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+
+
+def save_async(dir_path, index, arrays, metadata):
+    """
+    Saves a faiss based classifier to dir_path in background (see ckpt_util.save_async), copying the index and the
+    arrays first.
+    Args:
+        dir_path (str): destination directory
+        index: faiss index (on CPU)
+        arrays (dict): name -> array
+        metadata (dict): JSON serializable metadata
+
+    """
+    state = {
+        'index': faiss.clone_index(index),
+        'arrays': {name: np.array(array) for name, array in arrays.items()},
+        'metadata': dict(metadata)
+    }
+    ckpt_util.save_async(state, dir_path, write_dir, directory=True, copy_state=False)
+
+
+def read_dir(dir_path, mmap=True):
+    """
+    Args:
+        dir_path (str): directory written by write_dir
+        mmap (bool): memory-map the index (IO_FLAG_MMAP, where the index type supports it) and the arrays, so that
+            loading is immediate and pages are shared among processes
+
+    Returns (tuple): the index, the dict of arrays and the manifest
+
+    """
+    with open(os.path.join(dir_path, MANIFEST_FILE_NAME), 'r') as fp:
+        manifest = json.load(fp)
+
+    index_file_path = os.path.join(dir_path, manifest['index'])
+    try:
+        index = faiss.read_index(index_file_path, faiss.IO_FLAG_MMAP if mmap else 0)
+    except RuntimeError:
+        index = faiss.read_index(index_file_path)
+
+    arrays = {name: np.load(os.path.join(dir_path, '{}.npy'.format(name)), mmap_mode='r' if mmap else None)
+              for name in manifest['arrays']}
+    return index, arrays, manifest
@@ -3,8 +3,10 @@ import torch
 import faiss
 
 from early_classifier.base import BaseClassifier
+from early_classifier.calibration import ConfidenceCalibration
+from early_classifier import faiss_io
 from early_classifier.ee_dataset import EmbeddingDataset
-from utils import dataset_util
+from utils import ckpt_util, dataset_util
 
 
 class FaissKMeansClassifier(BaseClassifier):
@@ -22,6 +24,7 @@ class FaissKMeansClassifier(BaseClassifier):
         self.shares = np.zeros(self.k, dtype=float)
         self.cluster_sizes = np.zeros(self.k, dtype=int)
         self.valid_shares = None
+        self.calibration = ConfidenceCalibration()
         self.share_threshold = threshold
         self.share_threshold = self.share_threshold if self.share_threshold != 'auto' else 0.5
         self.distances_q = None
@@ -73,6 +76,7 @@ class FaissKMeansClassifier(BaseClassifier):
 
         # only keep clusters featuring more than one item
         self.valid_shares = [share for i, share in enumerate(self.shares) if self.cluster_sizes[i] > 1]
+        self.calibration = ConfidenceCalibration.from_confidences(self.valid_shares)
 
     def predict(self, x):
 
@@ -108,7 +112,7 @@ class FaissKMeansClassifier(BaseClassifier):
 
     def get_threshold(self, normalized=True):
         if normalized:
-            return np.quantile(self.valid_shares, self.share_threshold)
+            return self.calibration.quantile(self.share_threshold)
         else:
             return self.share_threshold
 
@@ -163,17 +167,62 @@ class FaissKMeansClassifier(BaseClassifier):
         self.max_labels = model_dict['metadata']['max_labels']
         self.shares = model_dict['metadata']['shares']
         self.valid_shares = model_dict['metadata']['valid_shares']
+        self.calibration = ConfidenceCalibration.from_confidences(self.valid_shares)
         self.share_threshold = model_dict['metadata']['share_threshold']
         self.distances_q = model_dict['metadata']['distances_q']
         self.jointly_trained = False  #model_dict['metadata']['jointly_trained']
 
     def save(self, filename):
-        model_dict = self.to_state_dict()
-        np.save(f"{filename}.npy", model_dict)
+        """
+        Saves the model as a directory (see faiss_io): the index, the centroids and the cluster shares can then be
+        memory-mapped by load.
+        """
+        index = faiss.index_gpu_to_cpu(self.model.index) if 'cuda' in self.device.type else self.model.index
+        metadata = {
+            'type': 'faiss_kmeans',
+            'k': self.k,
+            'dim': int(self.dim),
+            'niter': self.niter,
+            'device': str(self.device),
+            'n_labels': self.n_labels,
+            'share_threshold': float(self.share_threshold),
+            'jointly_trained': bool(self.jointly_trained)
+        }
+        arrays = {
+            'centroids': self.model.centroids,
+            'max_labels': self.max_labels,
+            'shares': self.shares,
+            'valid_shares': np.asarray(self.valid_shares, dtype=float),
+            'distances_q': self.distances_q
+        }
+        faiss_io.save_async(filename, index, arrays, metadata)
 
     def load(self, filename):
-        model_dict = np.load(f"{filename}.npy", allow_pickle=True).item()
-        self.from_state_dict(model_dict)
+        ckpt_util.wait()
+        if not faiss_io.is_dir_format(filename):
+            # pickled state dict of older checkpoints
+            model_dict = np.load(f"{filename}.npy", allow_pickle=True).item()
+            self.from_state_dict(model_dict)
+            return
+
+        index, arrays, metadata = faiss_io.read_dir(filename)
+        if metadata['type'] != 'faiss_kmeans':
+            raise TypeError("Expected model type 'faiss_kmeans'.")
+        self.k = metadata['k']
+        self.dim = metadata['dim']
+        self.niter = metadata['niter']
+        self.device = torch.device(metadata['device'])
+        self.model = faiss.Kmeans(self.dim, self.k, gpu='cuda' in self.device.type)
+        self.model.centroids = arrays['centroids']
+        self.model.index = index
+        # copied, as fit updates them in place
+        self.max_labels = np.array(arrays['max_labels'])
+        self.shares = np.array(arrays['shares'])
+        self.valid_shares = np.array(arrays['valid_shares'])
+        self.calibration = ConfidenceCalibration.from_confidences(self.valid_shares)
+        self.share_threshold = metadata['share_threshold']
+        self.distances_q = arrays['distances_q']
+        self.jointly_trained = False
 
     def to(self, device):
         self.device = device
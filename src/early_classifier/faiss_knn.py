@@ -5,8 +5,10 @@ import torch
 import faiss
 
 from early_classifier.base import BaseClassifier
+from early_classifier.calibration import ConfidenceCalibration
+from early_classifier import faiss_io
 from early_classifier.ee_dataset import EmbeddingDataset
-from utils import dataset_util
+from utils import ckpt_util, dataset_util
 
 
 class FaissKNNClassifier(BaseClassifier):
@@ -23,7 +25,7 @@ class FaissKNNClassifier(BaseClassifier):
         if type(threshold) == list:
             self.threshold = threshold[0]
         self.threshold = self.threshold if self.threshold != 'auto' else 0.5
-        self.confidences = []
+        self.calibration = ConfidenceCalibration()
         self.dataset = None
         self.y = None
 
@@ -61,7 +63,8 @@ class FaissKNNClassifier(BaseClassifier):
         c, l = c.max(dim=-1)
         #c = c[l != y]
         # self._t_up = c.max()
-        self.confidences = c * 0.85
+        self.calibration.reset()
+        self.calibration.update(c * 0.85)
 
     def predict(self, x):
 
@@ -94,7 +97,7 @@ class FaissKNNClassifier(BaseClassifier):
 
     def get_threshold(self, normalized=True):
         if normalized:
-            return np.quantile(self.confidences, self.threshold)
+            return self.calibration.quantile(self.threshold)
         else:
             return self.threshold
 
@@ -120,7 +123,7 @@ class FaissKNNClassifier(BaseClassifier):
             'n_labels': self.n_labels,
             'threshold': self.threshold,
             'jointly_trained': self.jointly_trained,
-            'confidences': self.confidences,
+            'calibration': self.calibration.to_state_dict(),
             'dim': self.dim,
             'model': faiss.serialize_index(self.model),
             'y': self.y
@@ -140,17 +143,50 @@ class FaissKNNClassifier(BaseClassifier):
         self.n_labels = model_dict['n_labels']
         self.threshold = model_dict['threshold']
         self.jointly_trained = model_dict['jointly_trained']
-        self.confidences = model_dict['confidences']
+        self.calibration = ConfidenceCalibration.from_state_dict(model_dict['calibration']) if 'calibration' in model_dict \
+            else ConfidenceCalibration.from_confidences(model_dict['confidences'])
 
     def save(self, filename):
-        with open(filename, "wb") as f:
-            model_dict = self.to_state_dict()
-            pickle.dump(model_dict, f)
+        """
+        Saves the model as a directory (see faiss_io): the index, the labels and the calibration values can then be
+        memory-mapped by load.
+        """
+        index = faiss.index_gpu_to_cpu(self.model) if 'cuda' in self.device.type else self.model
+        calibration = self.calibration.to_state_dict()
+        metadata = {
+            'type': 'faiss_knn',
+            'k': self.k,
+            'device': str(self.device),
+            'n_labels': self.n_labels,
+            'threshold': float(self.threshold),
+            'jointly_trained': bool(self.jointly_trained),
+            'dim': int(self.dim),
+            'calibration': {'count': int(calibration['count']), 'max_size': calibration['max_size']}
+        }
+        faiss_io.save_async(filename, index, {'y': self.y, 'calibration_values': calibration['values']}, metadata)
 
     def load(self, filename):
-        with open(filename, "rb") as f:
-            model_dict = pickle.load(f)
-            self.from_state_dict(model_dict)
+        ckpt_util.wait()
+        if not faiss_io.is_dir_format(filename):
+            # pickled state dict of older checkpoints
+            with open(filename, "rb") as f:
+                model_dict = pickle.load(f)
+                self.from_state_dict(model_dict)
+            return
+
+        index, arrays, metadata = faiss_io.read_dir(filename)
+        if metadata['type'] != 'faiss_knn':
+            raise TypeError("Expected model type 'faiss_knn'.")
+        self.k = metadata['k']
+        self.dim = metadata['dim']
+        self.device = torch.device(metadata['device'])
+        self.model = index
+        self.y = arrays['y']
+        self.n_labels = metadata['n_labels']
+        self.threshold = metadata['threshold']
+        self.jointly_trained = metadata['jointly_trained']
+        self.calibration = ConfidenceCalibration.from_state_dict(dict(metadata['calibration'],
+                                                                      values=arrays['calibration_values']))
 
     def to(self, device):
         if 'cuda' in device.type and 'cpu' in self.device.type:
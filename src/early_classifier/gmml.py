@@ -1,11 +1,12 @@
-import faiss
 import torch
 import numpy as np
 
 from structure.logger import MetricLogger
 from myutils.pytorch import func_util
 from early_classifier.base import BaseClassifier
+from early_classifier.calibration import ConfidenceCalibration
 from early_classifier.gmm_layer.gmml import GMML
+from utils import ckpt_util
 
 
 class GMMLClassifier(BaseClassifier):
@@ -27,7 +28,7 @@ class GMMLClassifier(BaseClassifier):
         self.batch_size = batch_size
         self.v_batch_size = v_batch_size
         self.threshold = threshold
-        self.confidences = []
+        self.calibration = ConfidenceCalibration()
         self.components_init = components_init
 
     def _mean_centroids_init(self, dataset):
@@ -53,6 +54,7 @@ class GMMLClassifier(BaseClassifier):
         x = np.array(dataset[:][0].cpu())
         y = np.array(dataset.targets)
         k = self.n_components*self.n_labels
+        import faiss
         kmeans = faiss.Kmeans(round(self.embedding_size/2), k, niter=10, gpu=False)
         kmeans.train(x)
         centroids = torch.tensor(kmeans.centroids).to(self.device)
@@ -96,7 +98,7 @@ class GMMLClassifier(BaseClassifier):
 
         metric_logger = MetricLogger(delimiter='  ')
         header = 'TRAIN EE (GMML): epoch {}'.format(epoch)
-        self.confidences = []
+        confidences = []
         self.model.train()
         self.model.mu_p.requires_grad = True
         self.model.sigma_p.requires_grad = True
@@ -113,8 +115,10 @@ class GMMLClassifier(BaseClassifier):
             if i * sample_batch.shape[0] % self.v_batch_size == 0 or i*sample_batch.shape[0] + sample_batch.shape[0] >= len(data_loader.dataset):
                 self.optimizer.step()
             self.model.sample_parameters()
-            metric_logger.update(loss=loss.item(), lr=self.optimizer.param_groups[0]['lr'])
-            self.confidences.extend(outputs.max(dim=-1).values.cpu().detach().numpy())
+            metric_logger.update(loss=loss, lr=self.optimizer.param_groups[0]['lr'])
+            confidences.append(outputs.max(dim=-1).values.detach())
+        self.calibration.reset()
+        self.calibration.update(torch.cat(confidences))
         self.training_history[epoch] = (metric_logger.lr.value, metric_logger.loss.global_avg)
         self.last_epoch = epoch
         self.scheduler.step()
@@ -140,7 +144,7 @@ class GMMLClassifier(BaseClassifier):
 
     def get_threshold(self, normalized=True):
         if normalized:
-            return np.quantile(np.array(self.confidences), self.threshold)
+            return self.calibration.quantile(self.threshold)
         else:
             return self.threshold
 
@@ -166,7 +170,7 @@ class GMMLClassifier(BaseClassifier):
             'threshold': self.threshold,
             'device': self.device,
             'jointly_trained': self.jointly_trained,
-            'confidences': self.confidences,
+            'calibration': self.calibration.to_state_dict(),
             'last_epoch': self.last_epoch,
             'performance': self.performance
         })
@@ -187,15 +191,16 @@ class GMMLClassifier(BaseClassifier):
         self.v_batch_size = model_dict['v_batch_size']
         self.threshold = model_dict['threshold']
         self.jointly_trained = model_dict['jointly_trained']
-        self.confidences = model_dict['confidences']
+        self.calibration = ConfidenceCalibration.from_state_dict(model_dict['calibration']) if 'calibration' in model_dict \
+            else ConfidenceCalibration.from_confidences(model_dict['confidences'])
         self.last_epoch = model_dict['last_epoch'] if 'last_epoch' in model_dict else -1
         self.performance = model_dict['performance'] if 'performance' in model_dict else 0.0
 
     def save(self, filename):
-        model_dict = self.to_state_dict()
-        torch.save(model_dict, open(filename, 'wb'))
+        ckpt_util.save_async(self.to_state_dict(), filename)
 
     def load(self, filename):
+        ckpt_util.wait()
         model_dict = torch.load(filename)
         self.from_state_dict(model_dict)
 
@@ -215,9 +220,9 @@ class GMMLClassifier(BaseClassifier):
 
     def get_cls_loss(self, p, t):
         # return torch.nn.NLLLoss(reduction="sum")(p, t)  # +
-        #if self.confidences:
-        #    p_ = p[(p > np.quantile(np.array(self.confidences), 0.7)).any(1), :]
-        #    t_ = t[(p > np.quantile(np.array(self.confidences), 0.7)).any(1)]
+        #if len(self.calibration) > 0:
+        #    p_ = p[(p > self.calibration.quantile(0.7)).any(1), :]
+        #    t_ = t[(p > self.calibration.quantile(0.7)).any(1)]
         #else:
         #    p_ = p
         #    t_ = t
@@ -230,22 +235,44 @@ class GMMLClassifier(BaseClassifier):
         return - torch.sum(p.max(dim=-1).values + ((p.max(dim=-1).indices != t).long() * float('-inf')).nan_to_num(nan=0), dim=-1)
 
     def get_kl_divergence(self, mu, logvar, targets):
-        mu = self.model.bottleneck(mu)
-        logvar = self.model.bottleneck(logvar)
+        """
+        KL divergence between the diagonal posterior of each embedding and the component of its target label, summed
+        over the batch. Log-determinants and precision diagonals are derived from the Cholesky factors once per call
+        (i.e., once per optimizer step) and gathered by target label; the Mahalanobis term applies the inverse factor
+        of each label to the samples of that label, i.e., O(B d^2) with no d x d tensor per sample.
+        Args:
+            mu (Tensor):
+            logvar (Tensor):
+            targets (Tensor):
+
+        Returns (Tensor):
+
+        """
+        in_subset = targets < self.n_labels
+        mu = self.model.bottleneck(mu[in_subset])
+        logvar = self.model.bottleneck(logvar[in_subset])
+        targets = targets[in_subset]
         var = logvar.exp()
-        kld = 0
-        for i in range(0, mu.size(0), self.batch_size):
-            j = i+self.batch_size
-            for c in range(self.n_labels):
-                mu_c = mu[i:j][targets[i:j] == c]
-                var_c = var[i:j][targets[i:j] == c]
-                kld += 0.5 * (self.model.distribution.covariance_matrix[0][c].det().log() - var_c.log().sum(dim=1)
-                              - self.model.d
-                              + torch.einsum('bs,bs->b',
-                                             torch.matmul(mu_c - self.model.distribution.loc[0][c], self.model.distribution.precision_matrix[0][c]),
-                                             (mu_c - self.model.distribution.loc[0][c]))
-                              + torch.einsum('bii->b', self.model.distribution.precision_matrix[0][c] * var_c.reshape(mu_c.size(0), 1, self.model.d).repeat(1, self.model.d, 1))).sum()
-        return kld
+
+        loc = self.model.distribution.loc[0][:self.n_labels]
+        scale_tril = self.model.distribution.scale_tril[0][:self.n_labels]
+        log_det = 2 * scale_tril.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
+        identity = torch.eye(self.model.d, dtype=scale_tril.dtype, device=scale_tril.device).expand_as(scale_tril)
+        inv_scale_tril = torch.linalg.solve_triangular(scale_tril, identity, upper=False)
+        # diagonal of the precision matrix inv(L)^T inv(L)
+        precision_diag = inv_scale_tril.pow(2).sum(dim=-2)
+
+        # Mahalanobis term |inv(L) (mu - loc)|^2, applying the inverse factor of each label to its samples only
+        diff = mu - loc[targets]
+        mahalanobis = diff.new_zeros(diff.size(0))
+        for label in targets.unique():
+            in_label = targets == label
+            mahalanobis[in_label] = (diff[in_label] @ inv_scale_tril[label].T).pow(2).sum(dim=1)
+        kld = 0.5 * (log_det[targets] - var.log().sum(dim=1)
+                     - self.model.d
+                     + mahalanobis
+                     + torch.einsum('bs,bs->b', precision_diag[targets], var))
+        return kld.sum()
 
     def init_param_from_dataset(self, dataset=None):
         if self.components_init:
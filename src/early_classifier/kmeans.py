@@ -6,6 +6,8 @@ from sklearn.cluster import KMeans
 
 from early_classifier.base import BaseClassifier
 from early_classifier.ee_dataset import EmbeddingDataset
+from ee_runtime import model_io
+from utils import ckpt_util
 
 
 class KMeansClassifier(BaseClassifier):
@@ -124,13 +126,31 @@ class KMeansClassifier(BaseClassifier):
         self.jointly_trained = model_dict['metadata']['jointly_trained']
 
     def save(self, filename):
-        model_dict = self.to_state_dict()
-        joblib.dump(model_dict, open(filename, 'wb'))
+        ckpt_util.save_async(self.to_state_dict(), filename, joblib.dump)
 
     def load(self, filename):
+        ckpt_util.wait()
         model_dict = joblib.load(filename)
         self.from_state_dict(model_dict)
 
+    def export(self, filename):
+        """
+        Exports only what inference needs (centroids, majority label and share of each cluster and the share
+        threshold) as a compact model that ee_runtime predicts with numpy only, without sklearn or joblib.
+        Args:
+            filename (str): destination .npz file
+
+        """
+        state = {
+            'type': 'kmeans',
+            'n_labels': self.n_labels,
+            'threshold': self.get_threshold(),
+            'centroids': self.model.cluster_centers_.astype(np.float32),
+            'max_labels': self.max_labels,
+            'shares': self.shares
+        }
+        ckpt_util.save_async(state, filename, model_io.save)
+
     def eval(self):
         pass
 
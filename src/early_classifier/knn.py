@@ -3,12 +3,13 @@ import sys
 import joblib
 import numpy as np
 import torch
-import faiss
 from sklearn.neighbors import KNeighborsClassifier
 
 from early_classifier.base import BaseClassifier
+from early_classifier.calibration import ConfidenceCalibration
 from early_classifier.ee_dataset import EmbeddingDataset
-from utils import dataset_util
+from ee_runtime import model_io
+from utils import ckpt_util, dataset_util
 
 
 class KNNClassifier(BaseClassifier):
@@ -30,7 +31,7 @@ class KNNClassifier(BaseClassifier):
         self.threshold = self.threshold if self.threshold != 'auto' else 0.5
         self._t_up = 1
         self._t_down = 0
-        self.confidences = torch.tensor([])
+        self.calibration = ConfidenceCalibration()
         self.distances_q = None
         self.dataset = None
 
@@ -66,7 +67,8 @@ class KNNClassifier(BaseClassifier):
         c, l = c.max(dim=-1)
         #c = c[l != y]
         # self._t_up = c.max()
-        self.confidences = c * 0.95
+        self.calibration.reset()
+        self.calibration.update(c * 0.95)
 
     def predict(self, x):
         # y = self.model.predict_proba(torch.as_tensor(x))
@@ -99,7 +101,7 @@ class KNNClassifier(BaseClassifier):
     def get_threshold(self, normalized=True):
         if normalized:
             # return self.confidences[-1]*self.threshold
-            return np.quantile(self.confidences, self.threshold)
+            return self.calibration.quantile(self.threshold)
         else:
             return self.threshold
 
@@ -125,7 +127,7 @@ class KNNClassifier(BaseClassifier):
             'n_labels': self.n_labels,
             'threshold': self.threshold,
             'jointly_trained': self.jointly_trained,
-            'confidences': self.confidences
+            'calibration': self.calibration.to_state_dict()
         })
         return  model_dict
 
@@ -140,16 +142,37 @@ class KNNClassifier(BaseClassifier):
         self.n_labels = model_dict['n_labels']
         self.threshold = model_dict['threshold']
         self.jointly_trained = model_dict['jointly_trained']
-        self.confidences = model_dict['confidences']
+        self.calibration = ConfidenceCalibration.from_state_dict(model_dict['calibration']) if 'calibration' in model_dict \
+            else ConfidenceCalibration.from_confidences(model_dict['confidences'])
 
     def save(self, filename):
-        model_dict = self.to_state_dict()
-        joblib.dump(model_dict, open(filename, 'wb'))
+        ckpt_util.save_async(self.to_state_dict(), filename, joblib.dump)
 
     def load(self, filename):
+        ckpt_util.wait()
         model_dict = joblib.load(filename)
         self.from_state_dict(model_dict)
 
+    def export(self, filename, fp16=False):
+        """
+        Exports only what inference needs (training embeddings and labels, k and the confidence threshold) as a
+        compact model that ee_runtime predicts with numpy only, without sklearn or joblib.
+        Args:
+            filename (str): destination .npz file
+            fp16 (bool): store the embeddings in half precision
+
+        """
+        embeddings = np.asarray(self.model._fit_X)
+        state = {
+            'type': 'knn',
+            'n_labels': self.n_labels,
+            'k': self.k,
+            'threshold': self.get_threshold(),
+            'embeddings': embeddings.astype(np.float16 if fp16 else np.float32),
+            'labels': self.model._y
+        }
+        ckpt_util.save_async(state, filename, model_io.save)
+
     def to(self, device):
         return self
 
@@ -1,15 +1,24 @@
+import time
+
+import numpy as np
 import torch
 
 from early_classifier.base import BaseClassifier
+from early_classifier.calibration import ConfidenceCalibration
+from ee_runtime import model_io
 from structure.logger import MetricLogger
 from myutils.pytorch import func_util
+from utils import ckpt_util
 
 
 class LinearClassifier(BaseClassifier):
 
     def __init__(self, device, n_labels, embedding_size, optimizer_config, scheduler_config, criterion_config,
-                 validation_dataset, batch_size=32, epochs=100, threshold=0.5):
+                 validation_dataset, batch_size=32, epochs=100, threshold=0.5, solver='sgd', l2=0.0, max_iter=100,
+                 tol=1e-5):
         super().__init__(device, n_labels)
+        if solver not in ['sgd', 'lbfgs', 'newton']:
+            raise ValueError('solver `{}` is not expected'.format(solver))
         self.epochs = epochs
         self.embedding_size = embedding_size
         self.model = torch.nn.Linear(embedding_size, n_labels).to(device)
@@ -19,13 +28,21 @@ class LinearClassifier(BaseClassifier):
         self.scheduler = func_util.get_scheduler(self.optimizer, scheduler_config['type'], scheduler_config['params'])
         self.batch_size = batch_size
         self.threshold = threshold
-        self.confidences = []
+        self.calibration = ConfidenceCalibration()
+        self.solver = solver
+        self.l2 = l2
+        self.max_iter = max_iter
+        self.tol = tol
+        self.cg_max_iter = 50
 
     def fit(self, data_loader, epoch=0):
+        if self.solver != 'sgd':
+            self._fit_full_batch(data_loader, epoch)
+            return
 
         metric_logger = MetricLogger(delimiter='  ')
         header = 'TRAIN EE (LINEAR): epoch {}'.format(epoch)
-        self.confidences = []
+        confidences = []
         self.model.train()
         for sample_batch, targets in metric_logger.log_every(data_loader, len(data_loader.dataset), header=header):
             sample_batch, targets = sample_batch.to(self.device), targets.to(self.device)
@@ -34,10 +51,99 @@ class LinearClassifier(BaseClassifier):
             loss = self.criterion(outputs, targets)
             loss.backward()
             self.optimizer.step()
-            metric_logger.update(loss=loss.item(), lr=self.optimizer.param_groups[0]['lr'])
-            self.confidences.extend(self.get_prediction_confidences(outputs).tolist())
+            metric_logger.update(loss=loss, lr=self.optimizer.param_groups[0]['lr'])
+            confidences.append(self.get_prediction_confidences(outputs).detach())
+        self.calibration.reset()
+        self.calibration.update(torch.cat(confidences))
         self.scheduler.step()
 
+    def _full_batch_loss(self, x, y):
+        loss = torch.nn.functional.cross_entropy(self.model(x), y)
+        return loss + 0.5 * self.l2 * self.model.weight.pow(2).sum()
+
+    def _fit_full_batch(self, data_loader, epoch):
+        """
+        Fit a L2-regularized multinomial logistic regression on the whole training set at once, warm-starting from
+        the current parameters. The problem is convex, so every call moves towards the same optimum and returns
+        right away once it has been reached.
+        """
+        header = 'TRAIN EE (LINEAR, {}): epoch {}'.format(self.solver.upper(), epoch)
+        start_time = time.time()
+        x = torch.as_tensor(data_loader.dataset.data, dtype=torch.float32).to(self.device)
+        y = torch.as_tensor(np.asarray(data_loader.dataset.targets), dtype=torch.long).to(self.device)
+        self.model.train()
+        n_iter = self._fit_lbfgs(x, y) if self.solver == 'lbfgs' else self._fit_newton(x, y)
+        with torch.no_grad():
+            outputs = self.model(x)
+            loss = self._full_batch_loss(x, y)
+        self.calibration.reset()
+        self.calibration.update(self.get_prediction_confidences(outputs))
+        print('{}  iterations: {}  loss: {:.6f}  time: {:.2f}s'.format(header, n_iter, loss.item(),
+                                                                     time.time() - start_time))
+
+    def _fit_lbfgs(self, x, y):
+        optimizer = torch.optim.LBFGS(self.model.parameters(), lr=1, max_iter=self.max_iter, tolerance_grad=self.tol,
+                                      tolerance_change=1e-9, history_size=20, line_search_fn='strong_wolfe')
+
+        def closure():
+            optimizer.zero_grad()
+            loss = self._full_batch_loss(x, y)
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+        return optimizer.state[optimizer.param_groups[0]['params'][0]].get('n_iter', 0)
+
+    def _fit_newton(self, x, y):
+        """
+        Truncated Newton (Newton-CG): the Newton direction is approximated by conjugate gradient, using Hessian-vector
+        products instead of materializing the Hessian, followed by a backtracking line search.
+        """
+        params = list(self.model.parameters())
+        for n_iter in range(self.max_iter):
+            loss = self._full_batch_loss(x, y)
+            grad = torch.cat([g.reshape(-1) for g in torch.autograd.grad(loss, params, create_graph=True)])
+            g = grad.detach()
+            g_norm = g.norm()
+            if g.abs().max() <= self.tol:
+                return n_iter
+
+            # conjugate gradient on H p = -g
+            p = torch.zeros_like(g)
+            r = -g
+            d = r.clone()
+            rs = r.dot(r)
+            cg_tol = min(0.5, g_norm.sqrt().item()) * g_norm
+            for _ in range(self.cg_max_iter):
+                hd = torch.cat([h.reshape(-1) for h in torch.autograd.grad(grad, params, grad_outputs=d,
+                                                                              retain_graph=True)])
+                curvature = d.dot(hd)
+                if curvature <= 0:
+                    break
+                alpha = rs / curvature
+                p += alpha * d
+                r -= alpha * hd
+                rs_next = r.dot(r)
+                if rs_next.sqrt() <= cg_tol:
+                    break
+                d = r + (rs_next / rs) * d
+                rs = rs_next
+            if not p.any():
+                p = -g
+
+            # backtracking (Armijo) line search
+            with torch.no_grad():
+                w = torch.nn.utils.parameters_to_vector(params)
+                loss = loss.detach()
+                decrease = 1e-4 * g.dot(p)
+                step = 1.0
+                while step > 1e-10:
+                    torch.nn.utils.vector_to_parameters(w + step * p, params)
+                    if self._full_batch_loss(x, y) <= loss + step * decrease:
+                        break
+                    step *= 0.5
+        return self.max_iter
+
     def predict(self, x):
         self.model.eval()
         with torch.no_grad():
@@ -76,9 +182,11 @@ class LinearClassifier(BaseClassifier):
             'n_labels': self.n_labels,
             'batch_size': self.batch_size,
             'threshold': self.threshold,
+            'solver': self.solver,
+            'l2': self.l2,
             'device': self.device,
             'jointly_trained': self.jointly_trained,
-            'confidences': self.confidences,
+            'calibration': self.calibration.to_state_dict(),
             'last_epoch': self.last_epoch,
             'performance': self.performance
         })
@@ -94,19 +202,40 @@ class LinearClassifier(BaseClassifier):
         self.n_labels = model_dict['n_labels']
         self.batch_size = model_dict['batch_size']
         self.threshold = model_dict['threshold']
+        self.solver = model_dict['solver'] if 'solver' in model_dict else 'sgd'
+        self.l2 = model_dict['l2'] if 'l2' in model_dict else 0.0
         self.jointly_trained = model_dict['jointly_trained']
-        self.confidences = model_dict['confidences']
+        self.calibration = ConfidenceCalibration.from_state_dict(model_dict['calibration']) if 'calibration' in model_dict \
+            else ConfidenceCalibration.from_confidences(model_dict['confidences'])
         self.last_epoch = model_dict['last_epoch'] if 'last_epoch' in model_dict else -1
         self.performance = model_dict['performance'] if 'performance' in model_dict else 0.0
 
     def save(self, filename):
-        model_dict = self.to_state_dict()
-        torch.save(model_dict, open(filename, 'wb'))
+        ckpt_util.save_async(self.to_state_dict(), filename)
 
     def load(self, filename):
+        ckpt_util.wait()
         model_dict = torch.load(filename)
         self.from_state_dict(model_dict)
 
+    def export(self, filename):
+        """
+        Exports the weights, the bias and the confidence threshold of the state dict as a compact model that
+        ee_runtime predicts with numpy only.
+        Args:
+            filename (str): destination .npz file
+
+        """
+        model_dict = self.to_state_dict()
+        state = {
+            'type': 'linear',
+            'n_labels': model_dict['n_labels'],
+            'threshold': self.get_threshold(),
+            'weight': model_dict['model']['weight'].detach().cpu().float().numpy(),
+            'bias': model_dict['model']['bias'].detach().cpu().float().numpy()
+        }
+        ckpt_util.save_async(state, filename, model_io.save)
+
     def eval(self):
         self.model.eval()
 
@@ -2,20 +2,35 @@ import torch
 
 from early_classifier.base import BaseClassifier
 from early_classifier.sgdm.SGDM import SDGM
-from early_classifier.sgdm.torch_ard import ELBOLoss
+from early_classifier.sgdm.torch_ard import ELBOLoss, get_dropped_params_ratio, get_saved_flops
+from ee_runtime import model_io
 from structure.logger import MetricLogger
 from myutils.pytorch import func_util
+from utils import ckpt_util
 
 
 class SDGMClassifier(BaseClassifier):
 
     def __init__(self, device, n_labels, embedding_size, optimizer_config, scheduler_config,
-                 validation_dataset, per_label_components, batch_size=32, epochs=100, threshold=0.5):
+                 validation_dataset, per_label_components, batch_size=32, epochs=100, threshold=0.5, cov_type='full',
+                 rank=16, bn_shape=None):
         super().__init__(device, n_labels)
         self.epochs = epochs
-        self.embedding_size = 384
+        self.cov_type = cov_type
+        self.rank = rank
+        # the full covariance needs the embeddings downsampled by 2 along height and width for computational feasibility
+        if cov_type == 'full':
+            if bn_shape is None or len(bn_shape) != 3:
+                raise ValueError('the full covariance type needs the (channels, height, width) bottleneck shape, '
+                                 'got {}'.format(bn_shape))
+            self.bn_shape = tuple(int(size) for size in bn_shape)
+            self.embedding_size = self.bn_shape[0] * (self.bn_shape[1] // 2) * (self.bn_shape[2] // 2)
+        else:
+            self.bn_shape = None if bn_shape is None else tuple(int(size) for size in bn_shape)
+            self.embedding_size = int(embedding_size)
         self.components = n_labels * per_label_components
-        self.model = SDGM(self.embedding_size, n_labels, n_component=per_label_components, cov_type="full").to(device)
+        self.model = SDGM(self.embedding_size, n_labels, n_component=per_label_components, cov_type=cov_type,
+                          rank=rank).to(device)
         self.validation_dataset = validation_dataset
         self.optimizer = func_util.get_optimizer(self.model, optimizer_config['type'], optimizer_config['params'])
         self.criterion = ELBOLoss(self.model, torch.nn.functional.cross_entropy).to(device)
@@ -24,32 +39,42 @@ class SDGMClassifier(BaseClassifier):
         self.threshold = threshold if threshold != 'auto' else 0.5
         self.min_c, self.max_c = 1, 0
 
+    def _reduce(self, x):
+        """
+        Downsamples the embeddings to the reduced size used with full covariance matrices, only flattens them
+        otherwise.
+        """
+        if self.cov_type != 'full':
+            return x.reshape((x.shape[0], self.embedding_size))
+        downsampler = torch.nn.Upsample(scale_factor=0.5)
+        x = x.reshape((x.shape[0],) + self.bn_shape)
+        x = downsampler(x)
+        return x.reshape((x.shape[0], self.embedding_size))
+
     def fit(self, data_loader, epoch=0):
 
-        downsampler = torch.nn.Upsample(scale_factor=0.5)
         metric_logger = MetricLogger(delimiter='  ')
         header = 'TRAIN EE (SDGM): epoch {}'.format(epoch)
         self.model.train()
         def get_kl_weight(epoch_, max_epoch): return min(1, 1e-9 * epoch_ / max_epoch)
+        # confidence range kept on the device during the epoch, read back once at its end
+        min_c = torch.tensor(float(self.min_c), device=self.device)
+        max_c = torch.tensor(float(self.max_c), device=self.device)
         for sample_batch, targets in metric_logger.log_every(data_loader, len(data_loader.dataset), header=header):
             sample_batch, targets = sample_batch.to(self.device), targets.to(self.device)
             self.optimizer.zero_grad()
-
-            # FIXME this reduces the embedding size for computational feasibility
-            sample_batch = sample_batch.reshape((sample_batch.shape[0], 6, 17, 17))
-            sample_batch = downsampler(sample_batch)
-            sample_batch = sample_batch.reshape((sample_batch.shape[0], self.embedding_size))
-
+            sample_batch = self._reduce(sample_batch)
             outputs = self.model.forward(sample_batch)
             kl_weight = get_kl_weight(epoch, max(self.epochs, epoch))
             loss = self.criterion(outputs, targets, 1, kl_weight=kl_weight)
             loss.backward()
             self.optimizer.step()
-            metric_logger.update(loss=loss.item(), lr=self.optimizer.param_groups[0]['lr'])
+            metric_logger.update(loss=loss, lr=self.optimizer.param_groups[0]['lr'])
             outputs = outputs + (outputs.min(dim=-1)[0] * -1).reshape(outputs.shape[-2], 1).expand(outputs.shape)
-            c_list = torch.max(torch.nn.functional.normalize(outputs), -1)[0]
-            self.min_c = min(c_list.min().item(), self.min_c)
-            self.max_c = max(c_list.max().item(), self.max_c)
+            c_list = torch.max(torch.nn.functional.normalize(outputs.detach()), -1)[0]
+            min_c = torch.minimum(min_c, c_list.min())
+            max_c = torch.maximum(max_c, c_list.max())
+        self.min_c, self.max_c = min_c.item(), max_c.item()
         self.scheduler.step()
 
     def predict(self, x):
@@ -61,12 +86,8 @@ class SDGMClassifier(BaseClassifier):
             return y
 
     def forward(self, x):
-        downsampler = torch.nn.Upsample(scale_factor=0.5)
         in_device = x.device
-        x = x.to(self.device)
-        x = x.reshape((x.shape[0], 6, 17, 17))
-        x = downsampler(x)
-        x = x.reshape((x.shape[0], self.embedding_size))
+        x = self._reduce(x.to(self.device))
         y = self.model.forward(x)
         return y.to(in_device)
 
@@ -84,6 +105,8 @@ class SDGMClassifier(BaseClassifier):
 
     def init_results(self):
         d = dict()
+        d['dropped_params_ratio'] = float(get_dropped_params_ratio(self.model))
+        d['saved_flops'] = get_saved_flops(self.model)
         return d
 
     def key_param(self):
@@ -97,6 +120,9 @@ class SDGMClassifier(BaseClassifier):
             'embedding_size': self.embedding_size,
             'n_labels': self.n_labels,
             'components': self.components,
+            'cov_type': self.cov_type,
+            'rank': self.rank,
+            'bn_shape': self.bn_shape,
             'batch_size': self.batch_size,
             'threshold': self.threshold,
             'device': self.device,
@@ -115,6 +141,9 @@ class SDGMClassifier(BaseClassifier):
         self.model.load_state_dict(model_dict['model'])
         self.n_labels = model_dict['n_labels']
         self.components = model_dict['components']
+        self.cov_type = model_dict['cov_type'] if 'cov_type' in model_dict else 'full'
+        self.rank = model_dict['rank'] if 'rank' in model_dict else 16
+        self.bn_shape = model_dict['bn_shape'] if 'bn_shape' in model_dict else self.bn_shape
         self.batch_size = model_dict['batch_size']
         self.threshold = model_dict['threshold']
         self.min_c = model_dict['min_c']
@@ -122,13 +151,38 @@ class SDGMClassifier(BaseClassifier):
         self.jointly_trained = model_dict['jointly_trained']
 
     def save(self, filename):
-        model_dict = self.to_state_dict()
-        torch.save(model_dict, open(filename, 'wb'))
+        ckpt_util.save_async(self.to_state_dict(), filename)
 
     def load(self, filename):
+        ckpt_util.wait()
         model_dict = torch.load(filename)
         self.from_state_dict(model_dict)
 
+    def export(self, filename):
+        """
+        Exports the model as a compact GMM of its covariance type that ee_runtime predicts with numpy only: the
+        weights are the ARD-clipped ones used at inference (weights_clipped) and the threshold is the normalized one.
+        Args:
+            filename (str): destination .npz file
+
+        """
+        model_dict = self.to_state_dict()
+        weight = self.model.fc.weights_clipped.detach()
+        state = {
+            'type': '{}_gmm'.format(self.cov_type),
+            'n_labels': model_dict['n_labels'],
+            'n_components': self.model.n_component,
+            'input_dim': self.embedding_size,
+            'threshold': self.get_threshold(),
+            'weight': weight.cpu().float().numpy(),
+            'bias': model_dict['model']['fc.bias'].detach().cpu().float().numpy()
+        }
+        if self.cov_type == 'lowrank':
+            state['projection'] = model_dict['model']['projection'].detach().cpu().float().numpy()
+        elif self.cov_type == 'full':
+            state['bn_shape'] = self.bn_shape
+        ckpt_util.save_async(state, filename, model_io.save)
+
     def eval(self):
         self.model.eval()
 
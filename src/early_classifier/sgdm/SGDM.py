@@ -6,29 +6,35 @@ from early_classifier.sgdm.torch_ard import LinearARD
 
 
 class SDGM(nn.Module):
-    def __init__(self, input_dim, n_class, n_component=1, cov_type="diag", **kwargs):
+    def __init__(self, input_dim, n_class, n_component=1, cov_type="diag", rank=16, **kwargs):
         """An SDGM layer, which can be used as a last layer for a classificaiton neural network.
         Attributes:
             input_dim (int): Input dimension
             n_class (int): The number of classes
             n_component (int): The number of Gaussian components
-            cov_type: (str): The type of covariance matrices. If "diag", diagonal matrices are used, which is computationally advantageous. If "full", the model uses full rank matrices that have high expression capability at the cost of increased computational complexity.
+            cov_type: (str): The type of covariance matrices. If "diag", diagonal matrices are used, which is computationally advantageous. If "full", the model uses full rank matrices that have high expression capability at the cost of increased computational complexity. If "lowrank", the quadratic term is a diagonal plus the squares of rank projections (x*U)^2 shared by all the components, so that memory and FLOPs are O(input_dim*rank) per sample.
+            rank (int): The rank of the projection used by the "lowrank" covariance type
         """
         super(SDGM, self).__init__(**kwargs)
         assert input_dim > 0
         assert n_class > 1
         assert n_component > 0
-        assert cov_type in ["diag", "full"]
+        assert cov_type in ["diag", "full", "lowrank"]
         self.input_dim = input_dim
         self.n_class = n_class
         self.n_component = n_component
         self.cov_type = cov_type
         self.n_total_component = n_component*n_class
-        self.ones_mask = (torch.triu(torch.ones(input_dim, input_dim)) == 1)
+        self.rank = rank
         # Bias term will be set in the linear layer so we omitted "+1"
         if cov_type == "diag":
             self.H = int(2 * self.input_dim)
+        elif cov_type == "lowrank":
+            assert rank > 0
+            self.H = int(2 * self.input_dim + rank)
+            self.projection = nn.Parameter(torch.randn(input_dim, rank) / np.sqrt(input_dim))
         else:
+            self.ones_mask = (torch.triu(torch.ones(input_dim, input_dim)) == 1)
             self.H = int(self.input_dim * (self.input_dim + 3) / 2)
         # Network
         self.fc = LinearARD(self.H, self.n_total_component)
@@ -41,7 +47,9 @@ class SDGM(nn.Module):
         return output
 
     def nonlinear_transformation(self, x):
-        if self.input_dim == 1 or self.cov_type == "diag":
+        if self.cov_type == "lowrank":
+            quadratic_term = torch.cat([x*x, torch.matmul(x, self.projection)**2], dim=1)
+        elif self.input_dim == 1 or self.cov_type == "diag":
             quadratic_term = x*x
         else:
             outer_prod = torch.einsum('ni,nj->nij', x, x)
@@ -11,12 +11,14 @@ class LinearARD(nn.Module):
     Dense layer implementation with weights ARD-prior (arxiv:1701.05369)
     """
 
-    def __init__(self, in_features, out_features, bias=True, thresh=3, ard_init=-10):
+    def __init__(self, in_features, out_features, bias=True, thresh=3, ard_init=-10, sparse_thresh=0.5):
         super(LinearARD, self).__init__()
         self.in_features = in_features
         self.out_features = out_features
         self.weight = Parameter(torch.Tensor(out_features, in_features))
         self.thresh = thresh
+        self.sparse_thresh = sparse_thresh
+        self._frozen_weight = None
         if bias:
             self.bias = Parameter(torch.Tensor(out_features))
         else:
@@ -30,9 +32,41 @@ class LinearARD(nn.Module):
             epsilon = self.weight.new(self.weight.shape).normal_()
             W = self.weight + epsilon * torch.exp(self.log_sigma2 / 2)
         else:
-            W = self.weights_clipped
+            if self._frozen_weight is None:
+                self.freeze()
+            if self._frozen_weight.layout == torch.sparse_csr:
+                return torch.matmul(self._frozen_weight, input.t()).t() + self.bias
+            W = self._frozen_weight
         return F.linear(input, W) + self.bias
 
+    def train(self, mode=True):
+        if mode or self.training:
+            self._frozen_weight = None
+        super(LinearARD, self).train(mode)
+        if self._frozen_weight is None and not mode:
+            self.freeze()
+        return self
+
+    def freeze(self):
+        """
+        Computes the clipped weights once for inference, stored as a CSR sparse matrix when on CPU and the fraction
+        of dropped weights exceeds "sparse_thresh"
+        """
+        with torch.no_grad():
+            W = self.weights_clipped.detach()
+            if W.device.type == 'cpu' and self.get_dropped_params_cnt() > self.sparse_thresh * W.numel():
+                W = W.to_sparse_csr()
+        self._frozen_weight = W
+
+    def _apply(self, fn):
+        # weights may be moved or converted, the frozen copy is computed again at the next inference
+        self._frozen_weight = None
+        return super(LinearARD, self)._apply(fn)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._frozen_weight = None
+        super(LinearARD, self)._load_from_state_dict(*args, **kwargs)
+
     @property
     def weights_clipped(self):
         clip_mask = self.get_clip_mask()
@@ -71,6 +105,15 @@ class LinearARD(nn.Module):
         """
         return self.get_clip_mask().sum().cpu().numpy()
 
+    def get_saved_flops(self):
+        """
+        Get number of FLOPs per sample actually saved at inference, i.e., one multiply and one add for each dropped
+        weight if the sparse weights are in use, none otherwise
+        """
+        if self._frozen_weight is None or self._frozen_weight.layout != torch.sparse_csr:
+            return 0
+        return 2 * (self.weight.numel() - self._frozen_weight.values().numel())
+
     @property
     def log_alpha(self):
         log_alpha = self.log_sigma2 - 2 * \
@@ -190,6 +233,18 @@ def _get_dropped_params_cnt(module):
     return 0
 
 
+def get_saved_flops(module):
+    """
+    :param module: model to evaluate the inference FLOPs saved by sparse ARD layers for
+    :return: total FLOPs per sample saved by the module
+    """
+    if hasattr(module, 'get_saved_flops'):
+        return module.get_saved_flops()
+    elif hasattr(module, 'children'):
+        return sum([get_saved_flops(submodule) for submodule in module.children()])
+    return 0
+
+
 def _get_params_cnt(module):
     if any([isinstance(module, l) for l in [LinearARD, Conv2dARD]]):
         return reduce(operator.mul, module.weight.shape, 1)
@@ -1,8 +1,9 @@
 import argparse
 import datetime
+import functools
 import json
+import math
 import time
-import copy
 import os
 
 from pathlib import Path
@@ -18,10 +19,11 @@ from early_classifier.base import BaseClassifier
 from early_classifier import ee_utils
 from early_classifier.ee_dataset import EmbeddingDataset
 
-from myutils.common import file_util, yaml_util
+from myutils.common import yaml_util
 from myutils.pytorch import func_util, module_util
-from structure.logger import MetricLogger, SmoothedValue, CtrValue
-from utils import main_util, mimic_util, dataset_util, metric_util
+from structure import metric_sink
+from structure.logger import MetricLogger, SmoothedValue, CtrValue, TensorValue
+from utils import main_util, mimic_util, dataset_util, metric_util, eval_util, ckpt_util, profile_util
 
 
 def get_argparser():
@@ -35,9 +37,15 @@ def get_argparser():
     argparser.add_argument('-metric_learning', action='store_true', help='optimize distance metric on embeddings')
     argparser.add_argument('-ee_joint_train', action='store_true', help='train an early exit model jointly')
     argparser.add_argument('-ee_solo_train', action='store_true', help='train an early exit model independently')
+    argparser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                           help='precision of the forward passes (bf16 uses autocast and channels_last)')
+    argparser.add_argument('-eval_throughput', action='store_true',
+                           help='print the evaluation throughput for several workers x threads splits (CPU only)')
     # distributed training parameters
     argparser.add_argument('--world_size', default=1, type=int, help='number of distributed processes')
     argparser.add_argument('--dist_url', default='env://', help='url used to set up distributed training')
+    profile_util.add_argument(argparser)
+    metric_sink.add_argument(argparser)
     return argparser
 
 
@@ -49,15 +57,20 @@ def train_epoch(model, train_loader, optimizer, criterion, epoch, device, interv
     header = 'Epoch: [{}]'.format(epoch)
     for sample_batch, targets, _ in metric_logger.log_every(train_loader, interval, header):
         start_time = time.time()
-        sample_batch, targets = sample_batch.to(device), targets.to(device)
+        with metric_logger.time_transfer():
+            sample_batch, targets = sample_batch.to(device), targets.to(device)
         optimizer.zero_grad()
-        outputs = model(sample_batch)
-        loss = criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
+        with profile_util.record('forward'):
+            outputs = model(sample_batch)
+            loss = criterion(outputs, targets)
+        with profile_util.record('backward'):
+            loss.backward()
+        with profile_util.record('optimizer_step'):
+            optimizer.step()
         batch_size = sample_batch.shape[0]
-        metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        metric_logger.update(loss=loss, lr=optimizer.param_groups[0]['lr'])
         metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+    return metric_logger
 
 
 def save_ckpt(student_model, epoch, best_valid_value, ckpt_file_path, teacher_model_type, ee_model=None,
@@ -72,20 +85,101 @@ def save_ckpt(student_model, epoch, best_valid_value, ckpt_file_path, teacher_mo
         'best_valid_value': best_valid_value,
         'student': True
     }
-    file_util.make_parent_dirs(ckpt_file_path)
-    torch.save(state, ckpt_file_path)
+    ckpt_util.save_async(state, ckpt_file_path)
     if ee_model is not None:
         dname = ee_config['ckpt']
         ee_model_file = dname.format(ee_model.n_labels, ee_config['samples_fraction'], ee_model.key_param())
-        file_util.make_parent_dirs(ckpt_file_path)
         ee_model.save(ee_model_file)
 
 
 @torch.no_grad()
-def evaluate(model, data_loader, device, ee_model=None, interval=1000, split_name='Test', title=None):
+def evaluate_batches(data_loader, model, ee_model=None, threshold=None, interval=1000, header='', precision='fp32',
+                     fused=False):
+    """
+    Run the model (jointly with the early exit model, if any) on the batches of data_loader.
+    When fused, the tail is run on every embedding, so that the accuracy of the full model (full_acc1 and full_acc5
+    meters) comes from the same pass as the early exit one, computing the head only once.
+    Args:
+        data_loader:
+        model:
+        ee_model (BaseClassifier):
+        threshold (float): normalized confidence threshold of the early exit model
+        interval:
+        header:
+        precision (str): 'fp32' or 'bf16'
+        fused (bool): also evaluate the full model on the same embeddings (requires ee_model)
+
+    Returns (MetricLogger): logger with acc1 and acc5 meters and the early_predictions counter
+
+    """
+    metric_logger = MetricLogger(delimiter='  ')
+    metric_logger.add_counter('early_predictions', CtrValue())
+    for image, target, _ in metric_logger.log_every(data_loader, interval, header, verbose=False):
+        with metric_logger.time_transfer():
+            image = main_util.to_channels_last(image.to(model.device, non_blocking=True), precision)
+            target = target.to(model.device, non_blocking=True)
+
+        batch_size = image.shape[0]
+
+        if not ee_model:
+            with profile_util.record('forward'), main_util.autocast(precision, model.device):
+                output = model(image).float()
+            new_early_exits = 0
+        else:
+            # run model up to bottleneck
+            with profile_util.record('student_head'), main_util.autocast(precision, model.device):
+                bn_output, *_ = model.forward_to_bn(image)
+            bn_output = bn_output.float()
+            embeddings = bn_output.to(ee_model.device)
+            embeddings = embeddings.reshape(embeddings.shape[0], embeddings.shape[1:].numel())
+
+            # early prediction
+            with profile_util.record('ee_predict'):
+                ee_output = ee_model.predict(embeddings)
+                ee_conf = ee_model.get_prediction_confidences(ee_output)
+            if ee_model.n_labels < model.out_features:
+                ee_output = torch_f.pad(ee_output, pad=(0, model.out_features - ee_model.n_labels, 0, 0), value=0)
+
+            # forward not-confident vectors to the full model
+            # c, p = torch.max(torch.nn.functional.softmax(ee_output[i], dim=0), 0)
+            # full_predictions = bn_output[ee_output < ee_threshold].gpu()
+            not_confident = (ee_conf < threshold).to(bn_output.device)
+            full_predictions = bn_output[not_confident]
+            new_early_exits = batch_size - full_predictions.shape[0]
+            output = ee_output.to(model.device)
+            # early_exit_ctr += new_early_exits
+
+            if fused:
+                with profile_util.record('tail'), main_util.autocast(precision, model.device):
+                    full_output = model.forward_from_bn(bn_output).float()
+                full_acc1, full_acc5 = main_util.compute_accuracy(full_output, target, topk=(1, 5))
+                metric_logger.meters['full_acc1'].update(full_acc1, n=batch_size)
+                metric_logger.meters['full_acc5'].update(full_acc5, n=batch_size)
+                output[not_confident.to(output.device)] = full_output[not_confident].to(output.dtype)
+            elif full_predictions.shape[0] > 0:
+                with profile_util.record('tail'), main_util.autocast(precision, model.device):
+                    full_output = model.forward_from_bn(full_predictions)
+                # merge early and full predictions
+                output[not_confident.to(output.device)] = full_output.to(output.dtype)
+
+            if threshold == 1 and new_early_exits > 0:
+                print(new_early_exits)
+
+        acc1, acc5 = main_util.compute_accuracy(output, target, topk=(1, 5))
+        metric_logger.meters['acc1'].update(acc1, n=batch_size)
+        metric_logger.meters['acc5'].update(acc5, n=batch_size)
+        metric_logger.counters['early_predictions'].update(new_early_exits, batch_size)
+    return metric_logger
+
+
+@torch.no_grad()
+def evaluate(model, data_loader, device, ee_model=None, interval=1000, split_name='Test', title=None,
+             precision='fp32', throughput_curve=False, fused=False):
     """
     Run the model on a test set and compute the top-1 and top-5 accuracy.
     The model is run jointly with an early exit model.
+    With more than one evaluation worker (see main_util.set_eval_policy) the test set is sharded among worker
+    processes, if running on CPU.
     Args:
         model:
         data_loader:
@@ -94,6 +188,10 @@ def evaluate(model, data_loader, device, ee_model=None, interval=1000, split_nam
         interval:
         split_name:
         title:
+        precision (str): 'fp32' or 'bf16'
+        throughput_curve (bool): print the throughput for several workers x threads splits before evaluating
+        fused (bool): evaluate the full model in the same pass as the early exit one, the full model accuracy is
+            returned as 'full_accuracy'
 
     Returns:
 
@@ -101,80 +199,28 @@ def evaluate(model, data_loader, device, ee_model=None, interval=1000, split_nam
     if title is not None:
         print(title)
 
-    model = model.to(model.device)
+    model = main_util.to_channels_last(model.to(model.device), precision)
     if ee_model is not None:
         ee_model = ee_model.to(ee_model.device)
 
-    # overall_samples = 50000
-    overall_samples_per_class = 100
-    used_samples_per_class = 100
-    # samples = int(overall_samples / overall_samples_per_class) * used_samples_per_class
-    samples = len(data_loader.dataset)
-
     num_threads = torch.get_num_threads()
-    torch.set_num_threads(1)
+    torch.set_num_threads(main_util.get_eval_threads())
     model.eval()
     if ee_model:
         ee_model.eval()
-    metric_logger = MetricLogger(delimiter='  ')
-    metric_logger.add_counter('early_predictions', CtrValue())
     header = '{}:'.format(split_name)
-    with torch.no_grad():
-        img_ctr_wide = -1
-        img_ctr = 0
-        early_exit_ctr = 0
-        for image, target, _ in metric_logger.log_every(data_loader, interval, header, verbose=False):
-
-            img_ctr_wide += data_loader.batch_size
-            if img_ctr_wide % overall_samples_per_class >= used_samples_per_class:
-                continue
-            if img_ctr >= samples:
-                break
-
-            image = image.to(model.device, non_blocking=True)
-            target = target.to(model.device, non_blocking=True)
-
-            batch_size = image.shape[0]
-
-            if not ee_model:
-                output = model(image)
-                new_early_exits = 0
-            else:
-                # run model up to bottleneck
-                bn_output, *_ = model.forward_to_bn(image)
-                embeddings = bn_output.to(ee_model.device)
-                embeddings = embeddings.reshape(embeddings.shape[0], embeddings.shape[1:].numel())
-
-                # early prediction
-                ee_output = ee_model.predict(embeddings)
-                ee_conf = ee_model.get_prediction_confidences(ee_output)
-                if ee_model.n_labels < model.out_features:
-                    ee_output = torch_f.pad(ee_output, pad=(0, model.out_features - ee_model.n_labels, 0, 0), value=0)
-
-                # forward not-confident vectors to the full model
-                # c, p = torch.max(torch.nn.functional.softmax(ee_output[i], dim=0), 0)
-                # full_predictions = bn_output[ee_output < ee_threshold].gpu()
-                full_predictions = bn_output[ee_conf < ee_model.get_threshold()]
-                new_early_exits = batch_size - full_predictions.shape[0]
-                output = ee_output.to(model.device)
-                # early_exit_ctr += new_early_exits
-
-                if full_predictions.shape[0] > 0:
-                    full_output = model.forward_from_bn(full_predictions)
-                    # merge early and full predictions
-                    j = 0
-                    for i in range(len(ee_output)):
-                        if ee_conf[i] < ee_model.get_threshold():
-                            output[i] = full_output[j]
-                            j += 1
-
-                if ee_model.get_threshold() == 1 and new_early_exits > 0:
-                    print(new_early_exits)
-
-            acc1, acc5 = main_util.compute_accuracy(output, target, topk=(1, 5))
-            metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-            metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
-            metric_logger.counters['early_predictions'].update(new_early_exits, batch_size)
+    threshold = ee_model.get_threshold() if ee_model else None
+    run_batches = functools.partial(evaluate_batches, model=model, ee_model=ee_model, threshold=threshold,
+                                    interval=interval, header=header, precision=precision,
+                                    fused=fused and ee_model is not None)
+    data_parallel = model.device.type == 'cpu' and not main_util.is_dist_avail_and_initialized()
+    if throughput_curve and data_parallel:
+        eval_util.print_throughput_curve(run_batches, data_loader)
+    if data_parallel and main_util.get_eval_workers() > 1:
+        metric_logger = eval_util.run_data_parallel(run_batches, data_loader, main_util.get_eval_workers(),
+                                                    main_util.get_eval_threads())
+    else:
+        metric_logger = run_batches(data_loader)
 
     # gather the solo_train-solo_eval from all processes
     metric_logger.synchronize_between_processes()
@@ -189,11 +235,16 @@ def evaluate(model, data_loader, device, ee_model=None, interval=1000, split_nam
     results['overall_accuracy'] = top1_accuracy
     results['confident_accuracy'] = top1_accuracy
     results['coverage'] = early_predictions
+    if 'full_acc1' in metric_logger.meters:
+        results['full_accuracy'] = metric_logger.full_acc1.global_avg
+        print(' * Full model Acc@1 {:.4f}\tAcc@5 {:.4f}'.format(results['full_accuracy'],
+                                                                metric_logger.full_acc5.global_avg))
 
     return results
 
 
-def validate(student_model_without_ddp, data_loader, config, device, distributed, device_ids, ee_model):
+def validate(student_model_without_ddp, data_loader, config, device, distributed, device_ids, ee_model,
+             precision='fp32'):
     """
     Evaluate on the validation test after one distillation epoch.
     Args:
@@ -204,6 +255,7 @@ def validate(student_model_without_ddp, data_loader, config, device, distributed
         distributed:
         device_ids:
         ee_model (BaseClassifier):
+        precision (str): 'fp32' or 'bf16'
 
     Returns:
 
@@ -215,14 +267,20 @@ def validate(student_model_without_ddp, data_loader, config, device, distributed
     mimic_model_without_dp = mimic_model.module if isinstance(mimic_model, DataParallel) else mimic_model
     if distributed:
         mimic_model = DistributedDataParallel(mimic_model_without_dp, device_ids=device_ids)
-    mimic_accuracy = evaluate(mimic_model, data_loader, device, split_name='Mimic Validation')["overall_accuracy"]
-    ee_accuracy = evaluate(mimic_model, data_loader, device, ee_model=ee_model, split_name='EE Validation')[
-        "overall_accuracy"] if ee_model else mimic_accuracy
+    if not ee_model:
+        mimic_accuracy = evaluate(mimic_model, data_loader, device, split_name='Mimic Validation',
+                                  precision=precision)["overall_accuracy"]
+        return mimic_accuracy
+
+    # head computed once, both the full model and the early exit one are evaluated on the same embeddings
+    results = evaluate(mimic_model, data_loader, device, ee_model=ee_model, split_name='Mimic+EE Validation',
+                       precision=precision, fused=True)
+    mimic_accuracy, ee_accuracy = results['full_accuracy'], results['overall_accuracy']
     return 0.5 * ee_accuracy + 0.5 * mimic_accuracy
 
 
 def distill_one_epoch(student_model, teacher_model, teacher_input_size, student_input_size, train_loader, optimizer,
-                      criterion, epoch, device, interval, bn_shape, loss_c, ee_model=None):
+                      criterion, epoch, device, interval, bn_shape, loss_c, ee_model=None, precision='fp32'):
     student_model.train()
     teacher_model.eval()
     if ee_model:
@@ -235,49 +293,60 @@ def distill_one_epoch(student_model, teacher_model, teacher_input_size, student_
     teacher_upsampler = torch.nn.Upsample(teacher_input_size).to(device)
     for sample_batch, targets, indexes in metric_logger.log_every(train_loader, interval, header):
         start_time = time.time()
-        sample_batch, targets = sample_batch.to(device), targets.to(device)
+        with metric_logger.time_transfer():
+            sample_batch, targets = main_util.to_channels_last(sample_batch.to(device), precision), targets.to(device)
         batch_size = sample_batch.shape[0]
         optimizer.zero_grad()
-        teacher_outputs = teacher_model(teacher_upsampler(sample_batch))
+        with profile_util.record('teacher_forward'), main_util.autocast(precision, device):
+            teacher_outputs = teacher_model(teacher_upsampler(sample_batch))
         cls_loss = 0
         reg_loss = 0
         if ee_model:
             ee_model.train()
             # get embedding
-            z, mu, logvar = student_model.forward_to_bn(student_upsampler(sample_batch))
+            with profile_util.record('student_head'), main_util.autocast(precision, device):
+                z, mu, logvar = student_model.forward_to_bn(student_upsampler(sample_batch))
             # embedding = z.detach()
-            embedding = z.reshape((z.shape[0], np.prod(z.shape[1:])))
+            embedding = z.float().reshape((z.shape[0], np.prod(z.shape[1:])))
             # early prediction
-            ee_outputs = ee_model.forward(embedding)
+            with profile_util.record('ee_predict'):
+                ee_outputs = ee_model.forward(embedding)
             # full prediction
-            student_outputs = student_model.forward_from_bn(z)
+            with profile_util.record('tail'), main_util.autocast(precision, device):
+                student_outputs = student_model.forward_from_bn(z)
             # update ee model
-            ee_model.update_and_fit(embedding, indexes, epoch)
+            with profile_util.record('ee_update_and_fit'):
+                ee_model.update_and_fit(embedding, indexes, epoch)
             # classification loss
             cls_loss = ee_model.get_cls_loss(ee_outputs, targets)
             # discrepancy loss (regularization)
             if student_model.variational:
-                mu = mu.reshape((mu.shape[0], np.prod(mu.shape[1:])))
-                logvar = logvar.reshape((mu.shape[0], np.prod(mu.shape[1:])))
+                mu = mu.float().reshape((mu.shape[0], np.prod(mu.shape[1:])))
+                logvar = logvar.float().reshape((mu.shape[0], np.prod(mu.shape[1:])))
                 # kld = 0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
                 reg_loss = ee_model.get_kl_divergence(mu, logvar, targets)
                 if reg_loss.isnan():
                     print(reg_loss)
                     reg_loss = 0
         else:
-            student_outputs = student_model(student_upsampler(sample_batch))
-        mimic_loss = criterion(student_outputs, teacher_outputs)
+            with profile_util.record('student_forward'), main_util.autocast(precision, device):
+                student_outputs = student_model(student_upsampler(sample_batch))
+        # losses are computed in fp32
+        mimic_loss = criterion(student_outputs.float(), teacher_outputs.float())
         loss = loss_c[0] * mimic_loss + loss_c[2] * cls_loss + loss_c[1] * reg_loss
 
-        loss.backward()
-        optimizer.step()
+        with profile_util.record('backward'):
+            loss.backward()
+        with profile_util.record('optimizer_step'):
+            optimizer.step()
 
-        metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        metric_logger.update(loss=loss, lr=optimizer.param_groups[0]['lr'])
         metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+    return metric_logger
 
 
 def distill(train_loader, valid_loader, student_input_shape, teacher_input_shape, config, device, distributed,
-            device_ids, bn_shape, loss_c=None, ee_model=None):
+            device_ids, bn_shape, loss_c=None, ee_model=None, precision='fp32'):
     """
     Train the (head of a) student model by knowledge distillation from the teacher model.
     The student is stored in ckpt.
@@ -293,12 +362,14 @@ def distill(train_loader, valid_loader, student_input_shape, teacher_input_shape
         device_ids:
         loss_c (tuple):
         ee_model (BaseClassifier):
+        precision (str): 'fp32' or 'bf16'
 
     Returns:
 
     """
     teacher_model_config = config['teacher_model']
     teacher_model, teacher_model_type = mimic_util.get_teacher_model(teacher_model_config, teacher_input_shape, device)
+    teacher_model = main_util.to_channels_last(teacher_model, precision)
     module_util.freeze_module_params(teacher_model)
     student_model_config = config['student_model']
     student_model = mimic_util.get_student_model(teacher_model_type, student_model_config, config['dataset']['name'],
@@ -307,6 +378,7 @@ def distill(train_loader, valid_loader, student_input_shape, teacher_input_shape
     student_model.device = device
     start_epoch, best_valid_acc = mimic_util.resume_from_ckpt(student_model_config['ckpt'], student_model, device,
                                                               is_student=True)
+    student_model = main_util.to_channels_last(student_model, precision)
     if best_valid_acc is None:
         best_valid_acc = 0.0
 
@@ -350,9 +422,9 @@ def distill(train_loader, valid_loader, student_input_shape, teacher_input_shape
             train_loader.sampler.set_epoch(epoch)
         # distill
         distill_one_epoch(student_model, teacher_model, student_input_shape[-1], teacher_input_shape[-1], train_loader,
-                          optimizer, criterion, epoch, device, interval, bn_shape, loss_c, ee_model)
+                          optimizer, criterion, epoch, device, interval, bn_shape, loss_c, ee_model, precision)
         # evaluate
-        valid_acc = validate(student_model, valid_loader, config, device, distributed, device_ids, ee_model)
+        valid_acc = validate(student_model, valid_loader, config, device, distributed, device_ids, ee_model, precision)
         if valid_acc > best_valid_acc and main_util.is_main_process():
             print('Updating ckpt (Best top1 accuracy: {:.4f} -> {:.4f})'.format(best_valid_acc, valid_acc))
             best_valid_acc = valid_acc
@@ -365,6 +437,7 @@ def distill(train_loader, valid_loader, student_input_shape, teacher_input_shape
 
     # dist.barrier()
     total_time = time.time() - start_time
+    ckpt_util.wait()
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
     del teacher_model
@@ -418,6 +491,7 @@ def finetune(train_loader, valid_loader, student_input_shape, config, device, di
         scheduler.step()
 
     total_time = time.time() - start_time
+    ckpt_util.wait()
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
     del org_model
@@ -451,12 +525,10 @@ def get_embeddings(dataset, config, device, fraction_of_samples=1.0, split_name=
                                        use_ckpt=use_ckpt)
     bn_shape = model.head.bn_shape(config["input_shape"], device)
 
-    overall_samples = len(dataset)
-    overall_classes = max(dataset.targets) + 1
-    overall_samples_per_class = overall_samples / overall_classes
-    used_samples_per_class = int(fraction_of_samples * overall_samples_per_class)
-    used_samples = overall_classes * used_samples_per_class
-    # bn_shape = model.head.bn_shape(input_shape, device)
+    # samples per class are selected once, so that the skipped images are never loaded
+    targets = dataset_util.get_targets(dataset)
+    subset_indexes = dataset_util.get_subset_indexes(targets, fraction_of_samples=fraction_of_samples)
+    used_samples = len(subset_indexes)
 
     cache_labels = np.zeros([used_samples], dtype=int)
     cache_labels_t = np.zeros([used_samples], dtype=int)
@@ -468,46 +540,40 @@ def get_embeddings(dataset, config, device, fraction_of_samples=1.0, split_name=
 
     if load_from_storage:
         print(f"Loading previous embeddings tensors from disk...")
+        # embeddings are stored following the per-label order of the whole dataset
+        stored_order = np.argsort(np.asarray(targets), kind='stable')
+        stored_positions = np.flatnonzero(np.isin(stored_order, subset_indexes))
         try:
-            cache_labels = torch.load(f'{embedding_storage}/{store_prefix}labels.sav')[
-                [i for i in range(overall_samples) if i % overall_samples_per_class < used_samples_per_class]]
-            cache_labels_t = torch.load(f'{embedding_storage}/{store_prefix}labels_t.sav')[
-                [i for i in range(overall_samples) if i % overall_samples_per_class < used_samples_per_class]]
-            cache_confidences = torch.load(f'{embedding_storage}/{store_prefix}confidences.sav')[
-                [i for i in range(overall_samples) if i % overall_samples_per_class < used_samples_per_class]]
-            img_ctr = 0
-            for img_ctr_wide in range(overall_samples):
-                if img_ctr_wide % overall_samples_per_class < used_samples_per_class:
-                    embedding = torch.load(f'{embedding_storage}/{store_prefix}embedding_{img_ctr_wide}.sav')
-                    cache_data[img_ctr] = embedding
-                    # save embeddings as pictures
-                    # bn_util.intermediate_output_to_fig(embedding.reshape(bn_shape), img_ctr, dataset.classes[cache_labels_t[img_ctr]], dataset.classes[cache_labels[img_ctr]], cache_confidences[img_ctr])
-                    img_ctr += 1
+            cache_labels = torch.load(f'{embedding_storage}/{store_prefix}labels.sav')[stored_positions]
+            cache_labels_t = torch.load(f'{embedding_storage}/{store_prefix}labels_t.sav')[stored_positions]
+            cache_confidences = torch.load(f'{embedding_storage}/{store_prefix}confidences.sav')[stored_positions]
+            for img_ctr, img_ctr_wide in enumerate(stored_positions):
+                embedding = torch.load(f'{embedding_storage}/{store_prefix}embedding_{img_ctr_wide}.sav')
+                cache_data[img_ctr] = embedding
+                # save embeddings as pictures
+                # bn_util.intermediate_output_to_fig(embedding.reshape(bn_shape), img_ctr, dataset.classes[cache_labels_t[img_ctr]], dataset.classes[cache_labels[img_ctr]], cache_confidences[img_ctr])
         except FileNotFoundError as ex:
             load_from_storage = False
 
     if not load_from_storage:
         # use the bottlenecked model to produce embeddings
-        data_loader = dataset_util.get_loader(dataset, shuffle=False, order_labels=True, n_labels=overall_classes)
+        sub_dataset = dataset_util.get_subset(dataset, subset_indexes)
+        data_loader = dataset_util.get_loader(sub_dataset, shuffle=False, order_labels=True)
         model = model.to(model.device)
         num_threads = torch.get_num_threads()
-        torch.set_num_threads(1)
+        torch.set_num_threads(main_util.get_eval_threads())
         model.eval()
         with torch.no_grad():
-            img_ctr_wide = -1
             img_ctr = 0
             for image, target, _ in metric_logger.log_every(data_loader, len(data_loader.dataset), header):
-                img_ctr_wide += data_loader.batch_size
-                if img_ctr_wide % overall_samples_per_class >= used_samples_per_class:
-                    continue
-                if img_ctr >= used_samples:
-                    break
+                with metric_logger.time_transfer():
+                    image = image.to(device, non_blocking=True)
+                    target = target.to(device, non_blocking=True)
 
-                image = image.to(device, non_blocking=True)
-                target = target.to(device, non_blocking=True)
-
-                embeddings, *_ = model.forward_to_bn(image)
-                output = model.forward_from_bn(embeddings)
+                with profile_util.record('student_head'):
+                    embeddings, *_ = model.forward_to_bn(image)
+                with profile_util.record('tail'):
+                    output = model.forward_from_bn(embeddings)
 
                 # process model output
                 confidence = list()
@@ -553,7 +619,7 @@ def train_ee_model(mimic_model, ee_config, samples_fraction_per_class, train_dat
         bn_shape:
         mimic_model:
         ee_config:
-        samples_fraction_per_class: TODO this parameter is ignored
+        samples_fraction_per_class: fraction of the training samples of each label used to fit the early exit model
         train_dataset:
         valid_dataset:
         device:
@@ -599,7 +665,7 @@ def train_ee_model(mimic_model, ee_config, samples_fraction_per_class, train_dat
         # Get data loaders
         pin_memory = 'cuda' in ee_model.device.type
         train_loader = dataset_util.get_loader(train_dataset, batch_size=batch_size, shuffle=shuffle, n_labels=n_labels,
-                                               pin_memory=pin_memory)
+                                               pin_memory=pin_memory, fraction_of_samples=samples_fraction_per_class)
         valid_loader = dataset_util.get_loader(valid_dataset, shuffle=False, n_labels=n_labels, pin_memory=pin_memory)
 
         print(f"Fitting early exit model of type '{ee_type}' with parameters '{ee_params}'...")
@@ -609,7 +675,8 @@ def train_ee_model(mimic_model, ee_config, samples_fraction_per_class, train_dat
         for epoch in range(ee_model.last_epoch + 1, epochs):
             # Train early exit model one epoch
             ee_model.train()
-            ee_model.fit(train_loader, epoch=epoch)
+            with profile_util.record('ee_fit'):
+                ee_model.fit(train_loader, epoch=epoch)
             # Evaluate early exit model
             for threshold in thresholds:
                 ee_model.set_threshold(threshold)
@@ -625,7 +692,12 @@ def train_ee_model(mimic_model, ee_config, samples_fraction_per_class, train_dat
                             results[instance_key][ee_model.key_param()][threshold]['performance'], r['performance']))
                         results[instance_key][ee_model.key_param()][threshold] = r
                         ee_model.performance = r['performance']
-                        best_ee_model[instance_key][ee_model.key_param()] = copy.deepcopy(ee_model.to_state_dict())
+                        # Stored right away: the checkpoint writer snapshots the state, no deep copy is kept around
+                        print(f"Saving best model so far for instance {instance_key}, key {ee_model.key_param()}")
+                        ee_model_file = ee_config['ckpt'].format(n_labels, samples_fraction_per_class,
+                                                                 ee_model.key_param())
+                        ee_model.save(ee_model_file)
+                        best_ee_model[instance_key][ee_model.key_param()] = ee_model_file
                 '''
                 if r['performance'] >= results[instance_key][ee_model.key_param()][threshold]['performance']:
                     print('Updating ckpt (Best performance value: {:.4f} -> {:.4f})'.format(
@@ -634,16 +706,6 @@ def train_ee_model(mimic_model, ee_config, samples_fraction_per_class, train_dat
                     if threshold == thresholds[0]:
                         best_ee_model[instance_key][ee_model.key_param()] = copy.deepcopy(ee_model.to_state_dict())
                 '''
-            # store best models
-            if epoch % 1 == 0:
-                b_ee_model = ee_utils.models[ee_type](**ee_params)
-                if b_ee_model.key_param() in best_ee_model[instance_key]:
-                    print(f"Saving best model so far for instance {instance_key}, key {b_ee_model.key_param()}")
-                    b_ee_model.from_state_dict(best_ee_model[instance_key][b_ee_model.key_param()])
-                    dname = ee_config['ckpt']
-                    Path(dname).mkdir(parents=True, exist_ok=True)
-                    ee_model_file = dname.format(n_labels, samples_fraction_per_class, b_ee_model.key_param())
-                    b_ee_model.save(ee_model_file)
         print(f"Training summary: {ee_model.training_history}")
 
     '''
@@ -683,11 +745,11 @@ def evaluate_ee_model(ee_model, mimic_model, data_loader, device, interval=100,
     ee_model = ee_model.to(ee_model.device)
     metric_logger = MetricLogger(delimiter='  ')
     metric_logger.add_counter('early_predictions', CtrValue())
-    metric_logger.add_meter('ee_acc1', SmoothedValue())
-    metric_logger.add_meter('ee_acc5', SmoothedValue())
-    metric_logger.add_meter('ee_acc1_c', SmoothedValue())
-    metric_logger.add_meter('ee_acc5_c', SmoothedValue())
-    metric_logger.add_meter('cls_loss', SmoothedValue())
+    metric_logger.add_meter('ee_acc1', TensorValue())
+    metric_logger.add_meter('ee_acc5', TensorValue())
+    metric_logger.add_meter('ee_acc1_c', TensorValue())
+    metric_logger.add_meter('ee_acc5_c', TensorValue())
+    metric_logger.add_meter('cls_loss', TensorValue())
 
     if not use_threshold:
         confidence_threshold = 0
@@ -697,13 +759,14 @@ def evaluate_ee_model(ee_model, mimic_model, data_loader, device, interval=100,
     header = '{}:'.format(split_name)
 
     num_threads = torch.get_num_threads()
-    torch.set_num_threads(1)
+    torch.set_num_threads(main_util.get_eval_threads())
     ee_model.eval()
     mimic_model.eval()
 
     for embeddings, target in metric_logger.log_every(data_loader, interval, header, verbose=False):
-        embeddings = embeddings.to(mimic_model.device, non_blocking=True)
-        target = target.to(device, non_blocking=True)
+        with metric_logger.time_transfer():
+            embeddings = embeddings.to(mimic_model.device, non_blocking=True)
+            target = target.to(device, non_blocking=True)
         batch_size = embeddings.shape[0]
         if any([t > ee_model.n_labels - 1 for t in target]):
             break
@@ -717,8 +780,9 @@ def evaluate_ee_model(ee_model, mimic_model, data_loader, device, interval=100,
         # confident_predictions = predictions[confidences < ee_model.get_threshold()]
         # confident_targets = target[confidences < ee_model.get_threshold()]
         embeddings = embeddings.to(ee_model.device)
-        ee_output = ee_model.predict(embeddings)
-        ee_conf = ee_model.get_prediction_confidences(ee_output)
+        with profile_util.record('ee_predict'):
+            ee_output = ee_model.predict(embeddings)
+            ee_conf = ee_model.get_prediction_confidences(ee_output)
         ee_output = ee_output.to(device)
         ee_conf = ee_conf.to(device)
 
@@ -730,10 +794,10 @@ def evaluate_ee_model(ee_model, mimic_model, data_loader, device, interval=100,
         acc1, acc5 = main_util.compute_accuracy(ee_output, target, topk=(1, 5))
         acc1_c, acc5_c = main_util.compute_accuracy(confident_output, confident_targets, topk=(1, 5))
         metric_logger.meters['cls_loss'].update(ee_model.get_cls_loss(ee_output, target), n=batch_size)
-        metric_logger.meters['ee_acc1'].update(acc1.item(), n=batch_size)
-        metric_logger.meters['ee_acc5'].update(acc5.item(), n=batch_size)
-        metric_logger.meters['ee_acc1_c'].update(acc1_c.item(), n=early_predictions)
-        metric_logger.meters['ee_acc5_c'].update(acc5_c.item(), n=early_predictions)
+        metric_logger.meters['ee_acc1'].update(acc1, n=batch_size)
+        metric_logger.meters['ee_acc5'].update(acc5, n=batch_size)
+        metric_logger.meters['ee_acc1_c'].update(acc1_c, n=early_predictions)
+        metric_logger.meters['ee_acc5_c'].update(acc5_c, n=early_predictions)
         metric_logger.counters['early_predictions'].update(early_predictions, batch_size)
 
     torch.set_num_threads(num_threads)
@@ -755,7 +819,7 @@ def evaluate_ee_model(ee_model, mimic_model, data_loader, device, interval=100,
     performance_metric = compute_performance_metric(top1_accuracy_c, early_predictions, 3.5)
     '''
 
-    performance_metric = (1 / cls_loss.log()).item()
+    performance_metric = 1 / math.log(cls_loss)
 
     print(' * OVERALL:\t\tAcc@1 {:.4f}\tAcc@5 {:.4f}'.format(top1_accuracy, top5_accuracy))
     print(' * CONFIDENT:\t\tAcc@1 {:.4f}\tAcc@5 {:.4f}\t(fraction of early predictions {:.4f})'.format(top1_accuracy_c,
@@ -774,7 +838,7 @@ def evaluate_ee_model(ee_model, mimic_model, data_loader, device, interval=100,
 
 def run(args):
     str_time = time.strftime('%Y%m%d-%H%M%S')
-    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url)
+    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url, args.device)
     device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
     if torch.cuda.is_available():
         cudnn.benchmark = True
@@ -782,10 +846,15 @@ def run(args):
     print(args)
     print(str_time)
     config = yaml_util.load_yaml_file(args.config)
+    if args.profile is not None:
+        profile_util.start(args.profile, profile_util.get_output_dir(config, 'ee_runner'))
+    if args.metrics_dir is not None:
+        metric_sink.open_default_sinks(args.metrics_dir, args.metrics_formats)
     dataset_config = config['dataset']
     student_input_shape = config['input_shape']
     train_config = config['train']
     test_config = config['test']
+    main_util.set_eval_policy(test_config.get('threads', None), test_config.get('workers', 1))
 
     teacher_model_config = config['teacher_model']
     teacher_input_shape = yaml_util.load_yaml_file(teacher_model_config['config'])['input_shape']
@@ -828,7 +897,7 @@ def run(args):
             ee_model.jointly_trained = True
             loss_coefficients = tuple(ee_config['params']['joint_loss_coefficients'].values())
         distill(train_loader, valid_loader, student_input_shape, teacher_input_shape, config, device, distributed,
-                device_ids, bn_shape, ee_model=ee_model, loss_c=loss_coefficients)
+                device_ids, bn_shape, ee_model=ee_model, loss_c=loss_coefficients, precision=args.precision)
     # [finetune] Keep training mimic model freezing the layers before the bottleneck
     if args.finetune:
         print("[Fine tuning Mimic Model]")
@@ -878,7 +947,7 @@ def run(args):
         print("[Test Original Model]")
         if distributed:
             org_model = DataParallel(org_model, device_ids=device_ids)
-        evaluate(org_model, test_loader, device, title='[Original model]')
+        evaluate(org_model, test_loader, device, title='[Original model]', precision=args.precision)
 
     # [bn_eval] Test mimic model
     mimic_model = mimic_util.get_mimic_model(config, org_model, teacher_model_type, teacher_model_config, device,
@@ -888,7 +957,8 @@ def run(args):
         print("[Test Mimic Model]")
         if distributed:
             mimic_model = DataParallel(mimic_model, device_ids=device_ids)
-        evaluate(mimic_model, test_loader, device, title='[BN model]')
+        evaluate(mimic_model, test_loader, device, title='[BN model]', precision=args.precision,
+                 throughput_curve=args.eval_throughput)
 
     # Test early exit models
     results = dict()
@@ -920,7 +990,9 @@ def run(args):
         joint_results = dict()
         for threshold in ee_config['thresholds']:
             ee_model.set_threshold(threshold)
-            r = evaluate(mimic_model, test_loader, device, ee_model=ee_model, title=f'[BN_EE model - t={threshold}]')
+            r = evaluate(mimic_model, test_loader, device, ee_model=ee_model, title=f'[BN_EE model - t={threshold}]',
+                         precision=args.precision,
+                         throughput_curve=args.eval_throughput and threshold == ee_config['thresholds'][0])
             joint_results[threshold] = r
         # store results on disk
         joint_results = {f"{ee_model.n_labels}:{fraction_of_samples_per_class}": {ee_model.key_param(): joint_results}}
@@ -0,0 +1,33 @@
+class BasePredictor(object):
+    """
+    Inference-only early exit model running on numpy arrays, built from the state of a compact export.
+    """
+
+    def __init__(self, state):
+        self.n_labels = int(state['n_labels'])
+        self.threshold = float(state['threshold'])
+
+    def predict(self, x):
+        """
+        Args:
+            x (np.ndarray): batch of flattened embeddings
+
+        Returns (np.ndarray): predicted confidences per label
+
+        """
+        raise NotImplementedError('predict method must be implemented')
+
+    def get_prediction_confidences(self, y):
+        return y.max(axis=-1)
+
+    def get_threshold(self):
+        return self.threshold
+
+    def predict_early(self, x):
+        """
+        Returns (tuple): predicted labels, their confidences and the mask of the confident (early exit) predictions
+
+        """
+        y = self.predict(x)
+        confidences = self.get_prediction_confidences(y)
+        return y.argmax(axis=-1), confidences, confidences >= self.threshold
@@ -0,0 +1,74 @@
+import numpy as np
+
+from ee_runtime.base import BasePredictor
+
+
+def logsumexp(z, axis=-1):
+    z_max = z.max(axis=axis, keepdims=True)
+    return (z_max + np.log(np.exp(z - z_max).sum(axis=axis, keepdims=True))).squeeze(axis)
+
+
+class DiagonalGMMPredictor(BasePredictor):
+    """
+    Discriminative Gaussian mixture with diagonal covariances (SDGMClassifier with cov_type 'diag'): the log
+    likelihood of each component is a linear function of [x, x * x], the score of a label is the logsumexp over its
+    components. As SDGMClassifier, the scores are shifted to a zero minimum and L2 normalized, and the confidence
+    is the largest normalized score.
+    """
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.n_components = int(state['n_components'])
+        weight = state['weight'].astype(np.float32)
+        dim = int(state['input_dim']) if 'input_dim' in state else weight.shape[1] // 2
+        self.linear_weight_t = np.ascontiguousarray(weight[:, :dim].T)
+        self.quadratic_weight_t = np.ascontiguousarray(weight[:, dim:].T)
+        self.bias = state['bias'].astype(np.float32)
+
+    def reduce(self, x):
+        return x
+
+    def quadratic_features(self, x):
+        return x * x
+
+    def predict(self, x):
+        x = self.reduce(np.asarray(x, dtype=np.float32).reshape(len(x), -1))
+        z = x @ self.linear_weight_t + self.quadratic_features(x) @ self.quadratic_weight_t + self.bias
+        y = logsumexp(z.reshape(x.shape[0], self.n_labels, self.n_components), axis=-1)
+        y = y - y.min(axis=-1, keepdims=True)
+        return y / np.maximum(np.linalg.norm(y, axis=-1, keepdims=True), 1e-12)
+
+
+class LowRankGMMPredictor(DiagonalGMMPredictor):
+    """
+    SDGMClassifier with cov_type 'lowrank': the quadratic features are [x * x, (x U)^2], U being the projection
+    shared by all the components.
+    """
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.projection = np.ascontiguousarray(state['projection'].astype(np.float32))
+
+    def quadratic_features(self, x):
+        return np.concatenate([x * x, (x @ self.projection) ** 2], axis=1)
+
+
+class FullGMMPredictor(DiagonalGMMPredictor):
+    """
+    SDGMClassifier with cov_type 'full': the embeddings are first downsampled by 2 along height and width (nearest
+    neighbor, as SDGMClassifier), then the quadratic features are the products x_i x_j with i <= j, in the row-major
+    order of the upper triangle.
+    """
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.bn_shape = tuple(int(size) for size in state['bn_shape'])
+        self.rows, self.cols = np.triu_indices(self.linear_weight_t.shape[0])
+
+    def reduce(self, x):
+        channels, height, width = self.bn_shape
+        x = x.reshape(len(x), channels, height, width)[:, :, 0:height // 2 * 2:2, 0:width // 2 * 2:2]
+        return np.ascontiguousarray(x.reshape(len(x), -1))
+
+    def quadratic_features(self, x):
+        return x[:, self.rows] * x[:, self.cols]
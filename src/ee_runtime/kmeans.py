@@ -0,0 +1,33 @@
+import numpy as np
+
+from ee_runtime.base import BasePredictor
+
+
+def get_squared_distances(x, points, squared_norms=None):
+    """
+    Returns (np.ndarray): squared euclidean distances between the rows of x and the rows of points
+    """
+    if squared_norms is None:
+        squared_norms = np.einsum('ij,ij->i', points, points)
+    x_squared_norms = np.einsum('ij,ij->i', x, x)[:, None]
+    return np.maximum(x_squared_norms - 2 * x @ points.T + squared_norms[None, :], 0)
+
+
+class KMeansPredictor(BasePredictor):
+    """
+    Nearest centroid: the confidence of the majority label of the cluster is the share of that label in it.
+    """
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.centroids = state['centroids'].astype(np.float32)
+        self.centroid_squared_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.max_labels = state['max_labels'].astype(np.int64)
+        self.shares = state['shares'].astype(np.float32)
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape(len(x), -1)
+        clusters = get_squared_distances(x, self.centroids, self.centroid_squared_norms).argmin(axis=1)
+        y = np.zeros((x.shape[0], self.n_labels), dtype=np.float32)
+        y[np.arange(x.shape[0]), self.max_labels[clusters]] = self.shares[clusters]
+        return y
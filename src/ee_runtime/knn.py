@@ -0,0 +1,49 @@
+import numpy as np
+
+from ee_runtime.base import BasePredictor
+from ee_runtime.kmeans import get_squared_distances
+
+
+class KNNPredictor(BasePredictor):
+    """
+    Brute force k nearest neighbors over the stored training embeddings (possibly fp16), computed by blocks of
+    block_size training rows so that the distance matrix never exceeds batch size x block_size. The confidences are
+    the ones of KNNClassifier: per label, the sum of 1 / d ** 25 over the neighbors with that label, divided by k.
+    """
+
+    def __init__(self, state, block_size=65536):
+        super().__init__(state)
+        self.k = int(state['k'])
+        self.embeddings = state['embeddings']
+        self.labels = state['labels'].astype(np.int64)
+        self.block_size = block_size
+
+    def get_neighbors(self, x):
+        """
+        Returns (tuple): euclidean distances and indexes of the k nearest training embeddings, sorted by distance
+        """
+        best_distances = np.full((x.shape[0], 0), np.inf, dtype=np.float32)
+        best_indexes = np.zeros((x.shape[0], 0), dtype=np.int64)
+        for start in range(0, self.embeddings.shape[0], self.block_size):
+            block = self.embeddings[start:start + self.block_size].astype(np.float32)
+            distances = np.concatenate((best_distances, get_squared_distances(x, block)), axis=1)
+            indexes = np.concatenate((best_indexes, np.arange(start, start + block.shape[0])[None, :]
+                                      .repeat(x.shape[0], axis=0)), axis=1)
+            k = min(self.k, distances.shape[1])
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            best_distances = np.take_along_axis(distances, top, axis=1)
+            best_indexes = np.take_along_axis(indexes, top, axis=1)
+
+        order = np.argsort(best_distances, axis=1)
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        return np.sqrt(best_distances), np.take_along_axis(best_indexes, order, axis=1)
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape(len(x), -1)
+        distances, indexes = self.get_neighbors(x)
+        neighbor_labels = self.labels[indexes]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            weights = 1 / distances.astype(np.float64) ** 25
+            y = np.stack([np.nan_to_num(weights * (neighbor_labels == i), nan=0).sum(axis=-1)
+                          for i in range(self.n_labels)], axis=1) / self.k
+        return y.astype(np.float32)
@@ -0,0 +1,24 @@
+import numpy as np
+
+from ee_runtime.base import BasePredictor
+
+
+def softmax(z):
+    z = z - z.max(axis=-1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+class LinearPredictor(BasePredictor):
+    """
+    Softmax of an affine map of the embeddings, as LinearClassifier.
+    """
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.weight_t = np.ascontiguousarray(state['weight'].astype(np.float32).T)
+        self.bias = state['bias'].astype(np.float32)
+
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape(len(x), -1)
+        return softmax(x @ self.weight_t + self.bias)
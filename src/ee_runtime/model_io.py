@@ -0,0 +1,51 @@
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def save(state, fp):
+    """
+    Writes a compact early exit model as an .npz archive of plain arrays (no pickled objects), readable with numpy
+    only.
+    Args:
+        state (dict): name -> array or scalar; 'type' is the model type
+        fp: open binary file or path
+
+    """
+    np.savez(fp, format_version=FORMAT_VERSION, **{name: np.asarray(value) for name, value in state.items()})
+
+
+def load_state(file_path):
+    with np.load(file_path, allow_pickle=False) as archive:
+        state = {name: archive[name] for name in archive.files}
+    if int(state['format_version']) > FORMAT_VERSION:
+        raise ValueError('Unsupported compact model format version {}'.format(int(state['format_version'])))
+    return state
+
+
+def load(file_path):
+    """
+    Args:
+        file_path (str): compact model exported by an early exit classifier (export method)
+
+    Returns: the numpy predictor of the model
+
+    """
+    from ee_runtime.gmm import DiagonalGMMPredictor, FullGMMPredictor, LowRankGMMPredictor
+    from ee_runtime.kmeans import KMeansPredictor
+    from ee_runtime.knn import KNNPredictor
+    from ee_runtime.linear import LinearPredictor
+
+    predictors = {
+        'knn': KNNPredictor,
+        'kmeans': KMeansPredictor,
+        'linear': LinearPredictor,
+        'diag_gmm': DiagonalGMMPredictor,
+        'lowrank_gmm': LowRankGMMPredictor,
+        'full_gmm': FullGMMPredictor
+    }
+    state = load_state(file_path)
+    model_type = str(state['type'])
+    if model_type not in predictors:
+        raise ValueError('Unexpected compact model type `{}`'.format(model_type))
+    return predictors[model_type](state)
@@ -0,0 +1,156 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def get_argparser():
+    argparser = argparse.ArgumentParser(description='Benchmark of the numpy early exit runtime against torch')
+    argparser.add_argument('--config', required=True, help='yaml file path (with an ee_model entry)')
+    argparser.add_argument('--variant', type=int, default=-1, help='index of the early exit model configuration')
+    argparser.add_argument('--export', help='compact model file path (default: under ./resource/ckpt/ee_runtime/)')
+    argparser.add_argument('--samples', type=int, default=1000, help='number of samples timed one by one')
+    argparser.add_argument('--startup_runs', type=int, default=5, help='fresh interpreters started per runtime')
+    argparser.add_argument('--threads', type=int, default=1, help='intra-op threads')
+    # internal: startup measurement run in a fresh interpreter
+    argparser.add_argument('--startup', choices=['torch', 'numpy'], help=argparse.SUPPRESS)
+    argparser.add_argument('--bn_shape', type=int, nargs='+', help=argparse.SUPPRESS)
+    return argparser
+
+
+def get_ee_config(config):
+    ee_config = config['ee_model']
+    ee_config['thresholds'] = ee_config['thresholds'] if type(ee_config['thresholds']) == list \
+        else [ee_config['thresholds']]
+    return ee_config
+
+
+def load_torch_model(config, variant, bn_shape):
+    import torch
+    from early_classifier import ee_utils
+
+    device = torch.device('cpu')
+    ee_model = ee_utils.get_ee_model(get_ee_config(config), device, bn_shape, pre_trained=True, conf_idx=variant)
+    if ee_model is None:
+        raise FileNotFoundError('Early exit model checkpoint not found, train it first with ee_runner')
+    ee_model.to(device)
+    ee_model.eval()
+    return ee_model
+
+
+def run_startup(args):
+    """
+    Body of the fresh interpreter timed by measure_startup: imports the runtime, loads the model and predicts one
+    sample, then exits.
+    """
+    x = np.zeros((1, int(np.prod(args.bn_shape))), dtype=np.float32)
+    if args.startup == 'numpy':
+        from ee_runtime import model_io
+        model_io.load(args.export).predict_early(x)
+    else:
+        import torch
+        from myutils.common import yaml_util
+        torch.set_num_threads(args.threads)
+        ee_model = load_torch_model(yaml_util.load_yaml_file(args.config), args.variant, torch.Size(args.bn_shape))
+        with torch.no_grad():
+            ee_model.get_prediction_confidences(ee_model.predict(torch.from_numpy(x)))
+
+
+def measure_startup(args, runtime, bn_shape):
+    """
+    Returns (float): the shortest wall time in seconds, over startup_runs fresh interpreters, to import the runtime,
+    load the model and predict the first sample (or only to start the interpreter, if runtime is None)
+    """
+    command = [sys.executable, '-c', 'pass'] if runtime is None else \
+        [sys.executable, os.path.abspath(__file__), '--config', args.config, '--variant', str(args.variant),
+         '--export', args.export, '--threads', str(args.threads), '--startup', runtime,
+         '--bn_shape'] + [str(size) for size in bn_shape]
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads))
+    elapsed_times = list()
+    for _ in range(args.startup_runs):
+        start_time = time.perf_counter()
+        subprocess.run(command, check=True, env=env, stdout=subprocess.DEVNULL)
+        elapsed_times.append(time.perf_counter() - start_time)
+    return min(elapsed_times)
+
+
+def measure_latencies(predict_fn, x):
+    """
+    Returns (np.ndarray): latency in milliseconds of predict_fn on every single sample of x
+    """
+    latencies = np.empty(len(x), dtype=np.float64)
+    for i in range(len(x)):
+        start_time = time.perf_counter_ns()
+        predict_fn(x[i:i + 1])
+        latencies[i] = (time.perf_counter_ns() - start_time) / 1e6
+    return latencies
+
+
+def print_latencies(title, latencies):
+    print('{}: mean {:.4f} ms, p50 {:.4f} ms, p99 {:.4f} ms'.format(title, latencies.mean(),
+                                                                    *np.percentile(latencies, [50, 99])))
+
+
+def run(args):
+    import torch
+    from ee_runtime import model_io
+    from myutils.common import yaml_util
+    from utils import ckpt_util, mimic_util
+
+    torch.set_num_threads(args.threads)
+    config = yaml_util.load_yaml_file(args.config)
+    ee_config = get_ee_config(config)
+    mimic_model = mimic_util.get_mimic_model_easily(config, torch.device('cpu'))
+    bn_shape = mimic_model.head.bn_shape(config['input_shape'], torch.device('cpu'))
+    del mimic_model
+    ee_model = load_torch_model(config, args.variant, bn_shape)
+
+    if args.export is None:
+        args.export = os.path.join('./resource/ckpt/ee_runtime/', '{}-variant{}.npz'.format(ee_config['experiment'],
+                                                                                          args.variant))
+    try:
+        ee_model.export(args.export)
+        ckpt_util.wait()
+    except NotImplementedError as e:
+        print('{} cannot be exported to ee_runtime: {}'.format(type(ee_model).__name__, e))
+        return
+    predictor = model_io.load(args.export)
+    print('Exported {} to {} ({:.1f} KiB)'.format(type(ee_model).__name__, args.export,
+                                                 os.path.getsize(args.export) / 1024))
+
+    x = np.random.default_rng(0).standard_normal((args.samples, int(np.prod(bn_shape))), dtype=np.float32)
+    x_tensor = torch.from_numpy(x)
+    with torch.no_grad():
+        y = ee_model.predict(x_tensor)
+        confidences = ee_model.get_prediction_confidences(y)
+        torch_labels = y.argmax(dim=-1).numpy()
+        torch_mask = (confidences >= ee_model.get_threshold()).numpy()
+    labels, _, mask = predictor.predict_early(x)
+    print('Agreement with torch: labels {:.2f}%, early exits {:.2f}%'
+          .format(100 * (labels == torch_labels).mean(), 100 * (mask == torch_mask).mean()))
+
+    def predict_torch(batch):
+        with torch.no_grad():
+            ee_model.get_prediction_confidences(ee_model.predict(batch))
+
+    print('Startup time (import, load and first prediction, best of {})'.format(args.startup_runs))
+    interpreter_time = measure_startup(args, None, bn_shape)
+    print('interpreter: {:.3f} s'.format(interpreter_time))
+    for runtime in ['torch', 'numpy']:
+        print('{}: {:.3f} s'.format(runtime, measure_startup(args, runtime, bn_shape) - interpreter_time))
+
+    print('Per-sample latency ({} samples, {} thread(s))'.format(args.samples, args.threads))
+    print_latencies('torch', measure_latencies(predict_torch, x_tensor))
+    print_latencies('numpy', measure_latencies(predictor.predict_early, x))
+
+
+if __name__ == '__main__':
+    parser = get_argparser()
+    parsed_args = parser.parse_args()
+    if parsed_args.startup is not None:
+        run_startup(parsed_args)
+    else:
+        run(parsed_args)
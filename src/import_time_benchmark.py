@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+DEFAULT_MODULES = ['ee_runner', 'mimic_runner', 'model_runner', 'compression_analyzer', 'representation_analyzer']
+# optional dependencies that must be imported only by the code paths using them
+DEFAULT_DEFERRED_MODULES = ['faiss', 'sklearn', 'joblib', 'pytorch_metric_learning', 'compressai',
+                            'early_classifier.gmml', 'early_classifier.sdgm']
+
+
+def get_argparser():
+    argparser = argparse.ArgumentParser(description='Import time regression benchmark (python -X importtime)')
+    argparser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES, help='modules to import')
+    argparser.add_argument('--deferred', nargs='+', default=DEFAULT_DEFERRED_MODULES,
+                           help='packages that importing the modules must not import')
+    argparser.add_argument('--runs', type=int, default=3, help='fresh interpreters per module (the best is kept)')
+    argparser.add_argument('--top', type=int, default=10, help='number of heaviest direct imports listed per module')
+    argparser.add_argument('--baseline', help='JSON file with the reference import time (ms) of each module')
+    argparser.add_argument('--tolerance', type=float, default=0.2,
+                           help='relative slowdown over the baseline reported as a regression')
+    argparser.add_argument('-update', action='store_true', help='write the measured times to the baseline file')
+    return argparser
+
+
+def parse_importtime(stderr):
+    """
+    Args:
+        stderr (str): standard error of `python -X importtime`
+
+    Returns (list): (package, nesting level, self time in us, cumulative time in us) tuples, in the reported order
+
+    """
+    records = list()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_time, cumulative_time, package = line[len('import time:'):].split('|')
+        nesting_level = (len(package) - len(package.lstrip(' ')) - 1) // 2
+        records.append((package.strip(), nesting_level, int(self_time), int(cumulative_time)))
+    return records
+
+
+def measure(module_name, runs):
+    """
+    Returns (tuple): the best import time (ms) of module_name over runs fresh interpreters and the records of that run
+    """
+    src_dir_path = os.path.dirname(os.path.abspath(__file__))
+    best_time, best_records = None, None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module_name)],
+                                cwd=src_dir_path, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError('Failed to import {}:\n{}'.format(module_name, result.stderr.splitlines()[-1]))
+        records = parse_importtime(result.stderr)
+        # top level imports of module_name and of its parent packages, leaving out the interpreter startup ones
+        import_time = sum(cumulative_time for package, nesting_level, _, cumulative_time in records
+                          if nesting_level == 0 and (module_name + '.').startswith(package + '.')) / 1e3
+        if best_time is None or import_time < best_time:
+            best_time, best_records = import_time, records
+    return best_time, best_records
+
+
+def run(args):
+    baseline = dict()
+    if args.baseline is not None and os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+
+    import_times = dict()
+    failures = list()
+    for module_name in args.modules:
+        import_time, records = measure(module_name, args.runs)
+        import_times[module_name] = import_time
+        print('{}: {:.1f} ms'.format(module_name, import_time))
+        top_records = sorted((record for record in records if record[1] == 1), key=lambda record: -record[3])
+        for package, _, _, cumulative_time in top_records[:args.top]:
+            print('    {:>9.1f} ms  {}'.format(cumulative_time / 1e3, package))
+
+        imported_packages = {package for package, _, _, _ in records}
+        for deferred_module in args.deferred:
+            if deferred_module in imported_packages:
+                failures.append('{} imports {}'.format(module_name, deferred_module))
+        if module_name in baseline and import_time > baseline[module_name] * (1 + args.tolerance):
+            failures.append('{} import time {:.1f} ms exceeds the baseline {:.1f} ms by more than {:.0f}%'
+                            .format(module_name, import_time, baseline[module_name], 100 * args.tolerance))
+
+    if args.baseline is not None and args.update:
+        with open(args.baseline, 'w') as fp:
+            json.dump(dict(baseline, **import_times), fp, indent=2)
+
+    for failure in failures:
+        print('REGRESSION: {}'.format(failure))
+    return len(failures) == 0
+
+
+if __name__ == '__main__':
+    parser = get_argparser()
+    sys.exit(0 if run(parser.parse_args()) else 1)
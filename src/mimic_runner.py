@@ -11,8 +11,9 @@ from torch.nn.parallel.distributed import DistributedDataParallel
 
 from myutils.common import file_util, yaml_util
 from myutils.pytorch import func_util, module_util
+from structure import metric_sink
 from structure.logger import MetricLogger, SmoothedValue
-from utils import main_util, mimic_util, dataset_util
+from utils import ckpt_util, main_util, mimic_util, dataset_util, profile_util
 
 
 def get_argparser():
@@ -21,16 +22,68 @@ def get_argparser():
     argparser.add_argument('--device', default='cuda', help='device')
     argparser.add_argument('--aux', type=float, default=100.0, help='auxiliary weight')
     argparser.add_argument('-test_only', action='store_true', help='only test model')
+    argparser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                           help='precision of the forward passes (bf16 uses autocast and channels_last)')
     argparser.add_argument('-student_only', action='store_true', help='test student model only')
     # distributed training parameters
     argparser.add_argument('--world_size', default=1, type=int, help='number of distributed processes')
     argparser.add_argument('--dist_url', default='env://', help='url used to set up distributed training')
+    profile_util.add_argument(argparser)
+    metric_sink.add_argument(argparser)
     return argparser
 
 
+def get_student_configs(config):
+    """
+    Splits a config whose student_model section lists several students into one config per student. Every entry
+    of the list is a student_model section and may carry its own mimic_model section (e.g., a different ckpt),
+    otherwise the top-level one is used.
+    Args:
+        config (dict): full configuration
+
+    Returns (list): one configuration per student
+
+    """
+    if not isinstance(config['student_model'], list):
+        return [config]
+
+    student_configs = list()
+    for student_model_config in config['student_model']:
+        student_model_config = dict(student_model_config)
+        mimic_model_config = student_model_config.pop('mimic_model', config['mimic_model'])
+        student_configs.append(dict(config, student_model=student_model_config, mimic_model=mimic_model_config))
+    return student_configs
+
+
 def distill_one_epoch(student_model, teacher_model, train_loader, optimizer, criterion,
-                      epoch, device, interval, aux_weight):
-    student_model.train()
+                      epoch, device, interval, aux_weight, precision='fp32'):
+    return distill_students_one_epoch([student_model], teacher_model, train_loader, [optimizer], criterion,
+                                      epoch, device, interval, aux_weight, precision)
+
+
+def distill_students_one_epoch(student_models, teacher_model, train_loader, optimizers, criterion,
+                               epoch, device, interval, aux_weight, precision='fp32'):
+    """
+    Distill one epoch several students from the same teacher: every batch is loaded and the teacher run once, then
+    each student is updated by its own optimizer.
+    Args:
+        student_models (list):
+        teacher_model:
+        train_loader:
+        optimizers (list): one optimizer per student
+        criterion:
+        epoch:
+        device:
+        interval:
+        aux_weight (float): weight of the auxiliary classification loss
+        precision (str): 'fp32' or 'bf16'
+
+    Returns (MetricLogger): logger of the epoch, whose data_time and compute_time meters tell whether it was
+        input-bound
+
+    """
+    for student_model in student_models:
+        student_model.train()
     teacher_model.eval()
     metric_logger = MetricLogger(delimiter='  ')
     metric_logger.add_meter('lr', SmoothedValue(window_size=1, fmt='{value}'))
@@ -38,45 +91,60 @@ def distill_one_epoch(student_model, teacher_model, train_loader, optimizer, cri
     header = 'Epoch: [{}]'.format(epoch)
     for sample_batch, targets in metric_logger.log_every(train_loader, interval, header):
         start_time = time.time()
-        sample_batch, targets = sample_batch.to(device), targets.to(device)
-        optimizer.zero_grad()
-        student_outputs = student_model(sample_batch)
-        teacher_outputs = teacher_model(sample_batch)
-        if isinstance(student_outputs, tuple):
-            student_outputs, aux = student_outputs[0], student_outputs[1]
-            loss = criterion(student_outputs, teacher_outputs) + aux_weight * nn.functional.cross_entropy(aux, targets)
-        else:
-            loss = criterion(student_outputs, teacher_outputs)
-
-        loss.backward()
-        optimizer.step()
+        with metric_logger.time_transfer():
+            sample_batch, targets = main_util.to_channels_last(sample_batch.to(device), precision), targets.to(device)
+        with profile_util.record('teacher_forward'), torch.no_grad(), main_util.autocast(precision, device):
+            teacher_outputs = teacher_model(sample_batch)
+        # losses are computed in fp32
+        teacher_outputs = teacher_outputs.float()
+        for i, (student_model, optimizer) in enumerate(zip(student_models, optimizers)):
+            optimizer.zero_grad()
+            with profile_util.record('student_head'), main_util.autocast(precision, device):
+                student_outputs = student_model(sample_batch)
+            if isinstance(student_outputs, tuple):
+                student_outputs, aux = student_outputs[0].float(), student_outputs[1].float()
+                loss = criterion(student_outputs, teacher_outputs) +\
+                    aux_weight * nn.functional.cross_entropy(aux, targets)
+            else:
+                loss = criterion(student_outputs.float(), teacher_outputs)
+
+            with profile_util.record('backward'):
+                loss.backward()
+            with profile_util.record('optimizer_step'):
+                optimizer.step()
+            metric_logger.meters['loss' if len(student_models) == 1 else 'loss{}'.format(i)].update(loss)
+
         batch_size = sample_batch.shape[0]
-        metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        metric_logger.update(lr=optimizers[0].param_groups[0]['lr'])
         metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+    return metric_logger
 
 
 @torch.no_grad()
-def evaluate(model, data_loader, device, interval=1000, split_name='Test', title=None):
+def evaluate(model, data_loader, device, interval=1000, split_name='Test', title=None, precision='fp32'):
     if title is not None:
         print(title)
 
     num_threads = torch.get_num_threads()
-    torch.set_num_threads(1)
+    torch.set_num_threads(main_util.get_eval_threads())
+    model = main_util.to_channels_last(model, precision)
     model.eval()
     metric_logger = MetricLogger(delimiter='  ')
     header = '{}:'.format(split_name)
     with torch.no_grad():
         for image, target in metric_logger.log_every(data_loader, interval, header):
-            image = image.to(device, non_blocking=True)
-            target = target.to(device, non_blocking=True)
-            output = model(image)
+            with metric_logger.time_transfer():
+                image = main_util.to_channels_last(image.to(device, non_blocking=True), precision)
+                target = target.to(device, non_blocking=True)
+            with profile_util.record('forward'), main_util.autocast(precision, device):
+                output = model(image).float()
 
             acc1, acc5 = main_util.compute_accuracy(output, target, topk=(1, 5))
             # FIXME need to take into account that the datasets
             # could have been padded in distributed setup
             batch_size = image.shape[0]
-            metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-            metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
+            metric_logger.meters['acc1'].update(acc1, n=batch_size)
+            metric_logger.meters['acc5'].update(acc5, n=batch_size)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -87,7 +155,7 @@ def evaluate(model, data_loader, device, interval=1000, split_name='Test', title
     return metric_logger.acc1.global_avg
 
 
-def validate(student_model_without_ddp, data_loader, config, device, distributed, device_ids):
+def validate(student_model_without_ddp, data_loader, config, device, distributed, device_ids, precision='fp32'):
     teacher_model_config = config['teacher_model']
     org_model, teacher_model_type = mimic_util.get_org_model(teacher_model_config, device)
     mimic_model = mimic_util.get_mimic_model(config, org_model, teacher_model_type, teacher_model_config,
@@ -95,7 +163,7 @@ def validate(student_model_without_ddp, data_loader, config, device, distributed
     mimic_model_without_dp = mimic_model.module if isinstance(mimic_model, DataParallel) else mimic_model
     if distributed:
         mimic_model = DistributedDataParallel(mimic_model_without_dp, device_ids=device_ids)
-    return evaluate(mimic_model, data_loader, device, split_name='Validation')
+    return evaluate(mimic_model, data_loader, device, split_name='Validation', precision=precision)
 
 
 def save_ckpt(student_model, epoch, best_valid_value, ckpt_file_path, teacher_model_type):
@@ -109,77 +177,107 @@ def save_ckpt(student_model, epoch, best_valid_value, ckpt_file_path, teacher_mo
         'best_valid_value': best_valid_value,
         'student': True
     }
-    file_util.make_parent_dirs(ckpt_file_path)
-    torch.save(state, ckpt_file_path)
+    ckpt_util.save_async(state, ckpt_file_path)
 
 
-def distill(train_loader, valid_loader, input_shape, aux_weight, config, device, distributed, device_ids):
+def distill(train_loader, valid_loader, input_shape, aux_weight, config, device, distributed, device_ids,
+            precision='fp32'):
+    """
+    Distill the student model(s) of config. When the student_model section lists several students (see
+    get_student_configs), they are trained side by side sharing data loading and the teacher forward pass, each one
+    with its own optimizer, scheduler and checkpoint.
+    """
     teacher_model_config = config['teacher_model']
     teacher_model, teacher_model_type = mimic_util.get_teacher_model(teacher_model_config, input_shape, device)
+    teacher_model = main_util.to_channels_last(teacher_model, precision)
     module_util.freeze_module_params(teacher_model)
-    student_model_config = config['student_model']
-    input_size = config['input_shape'][-1]
-    student_model = mimic_util.get_student_model(teacher_model_type, student_model_config, config['dataset']['name'], input_size=input_size)
-    student_model = student_model.to(device)
-    start_epoch, best_valid_acc = mimic_util.resume_from_ckpt(student_model_config['ckpt'], student_model, device,
-                                                              is_student=True)
-    if best_valid_acc is None:
-        best_valid_acc = 0.0
-
     train_config = config['train']
     criterion_config = train_config['criterion']
     criterion = func_util.get_loss(criterion_config['type'], criterion_config['params'])
     optim_config = train_config['optimizer']
-    optimizer = func_util.get_optimizer(student_model, optim_config['type'], optim_config['params'])
     scheduler_config = train_config['scheduler']
-    scheduler = func_util.get_scheduler(optimizer, scheduler_config['type'], scheduler_config['params'])
     interval = train_config['interval']
     if interval <= 0:
         num_batches = len(train_loader)
         interval = num_batches // 20 if num_batches >= 20 else 1
 
-    student_model_without_ddp = student_model
+    input_size = config['input_shape'][-1]
+    students = list()
+    for student_config in get_student_configs(config):
+        student_model_config = student_config['student_model']
+        student_model = mimic_util.get_student_model(teacher_model_type, student_model_config,
+                                                     config['dataset']['name'], input_size=input_size)
+        student_model = student_model.to(device)
+        start_epoch, best_valid_acc = mimic_util.resume_from_ckpt(student_model_config['ckpt'], student_model,
+                                                                  device, is_student=True)
+        student_model = main_util.to_channels_last(student_model, precision)
+        if best_valid_acc is None:
+            best_valid_acc = 0.0
+
+        optimizer = func_util.get_optimizer(student_model, optim_config['type'], optim_config['params'])
+        scheduler = func_util.get_scheduler(optimizer, scheduler_config['type'], scheduler_config['params'])
+        student_model_without_ddp = student_model
+        if distributed:
+            student_model = DistributedDataParallel(student_model, device_ids=device_ids)
+            student_model_without_ddp = student_model.module
+
+        students.append({'config': student_config, 'model': student_model,
+                         'model_without_ddp': student_model_without_ddp, 'optimizer': optimizer,
+                         'scheduler': scheduler, 'best_valid_acc': best_valid_acc,
+                         'start_epoch': start_epoch, 'end_epoch': start_epoch + train_config['epoch']})
+
     if distributed:
         teacher_model = DataParallel(teacher_model, device_ids=device_ids)
-        student_model = DistributedDataParallel(student_model, device_ids=device_ids)
-        student_model_without_ddp = student_model.module
 
-    ckpt_file_path = student_model_config['ckpt']
-    end_epoch = start_epoch + train_config['epoch']
     start_time = time.time()
-    for epoch in range(start_epoch, end_epoch):
+    for epoch in range(min(student['start_epoch'] for student in students),
+                       max(student['end_epoch'] for student in students)):
         if distributed:
             train_loader.sampler.set_epoch(epoch)
 
-        distill_one_epoch(student_model, teacher_model, train_loader, optimizer, criterion,
-                          epoch, device, interval, aux_weight)
-        valid_acc = validate(student_model, valid_loader, config, device, distributed, device_ids)
-        if valid_acc > best_valid_acc and main_util.is_main_process():
-            print('Updating ckpt (Best top1 accuracy: {:.4f} -> {:.4f})'.format(best_valid_acc, valid_acc))
-            best_valid_acc = valid_acc
-            save_ckpt(student_model_without_ddp, epoch, best_valid_acc, ckpt_file_path, teacher_model_type)
-        scheduler.step()
+        # students resumed from different epochs join the others as soon as they reach their own start epoch
+        active_students = [student for student in students if student['start_epoch'] <= epoch < student['end_epoch']]
+        distill_students_one_epoch([student['model'] for student in active_students], teacher_model, train_loader,
+                                   [student['optimizer'] for student in active_students], criterion,
+                                   epoch, device, interval, aux_weight, precision)
+        for student in active_students:
+            student_config = student['config']
+            valid_acc = validate(student['model'], valid_loader, student_config, device, distributed, device_ids,
+                                 precision)
+            if valid_acc > student['best_valid_acc'] and main_util.is_main_process():
+                print('Updating ckpt (Best top1 accuracy: {:.4f} -> {:.4f})'.format(student['best_valid_acc'],
+                                                                                     valid_acc))
+                student['best_valid_acc'] = valid_acc
+                save_ckpt(student['model_without_ddp'], epoch, valid_acc, student_config['student_model']['ckpt'],
+                          teacher_model_type)
+            student['scheduler'].step()
 
     # dist.barrier()
     total_time = time.time() - start_time
+    ckpt_util.wait()
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
     del teacher_model
-    del student_model
+    del students
 
 
 def run(args):
-    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url)
+    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url, args.device)
     device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
     if torch.cuda.is_available():
         cudnn.benchmark = True
 
     print(args)
     config = yaml_util.load_yaml_file(args.config)
+    if args.profile is not None:
+        profile_util.start(args.profile, profile_util.get_output_dir(config, 'mimic_runner'))
+    if args.metrics_dir is not None:
+        metric_sink.open_default_sinks(args.metrics_dir, args.metrics_formats)
     dataset_config = config['dataset']
     input_shape = config['input_shape']
     train_config = config['train']
     test_config = config['test']
+    main_util.set_eval_policy(test_config.get('threads', None), test_config.get('workers', 1))
     train_loader, valid_loader, test_loader, _ =\
         dataset_util.get_data_loaders(dataset_config, batch_size=train_config['batch_size'],
                                       rough_size=train_config['rough_size'], reshape_size=input_shape[1:3],
@@ -187,20 +285,26 @@ def run(args):
                                       distributed=distributed)
     teacher_model_config = config['teacher_model']
     if not args.test_only:
-        distill(train_loader, valid_loader, input_shape, args.aux, config, device, distributed, device_ids)
+        distill(train_loader, valid_loader, input_shape, args.aux, config, device, distributed, device_ids,
+                args.precision)
 
     org_model, teacher_model_type = mimic_util.get_org_model(teacher_model_config, device)
     if not args.student_only:
         if distributed:
             org_model = DataParallel(org_model, device_ids=device_ids)
-        evaluate(org_model, test_loader, device, title='[Original model]')
+        evaluate(org_model, test_loader, device, title='[Original model]', precision=args.precision)
 
-    mimic_model = mimic_util.get_mimic_model(config, org_model, teacher_model_type, teacher_model_config, device)
-    mimic_model_without_dp = mimic_model.module if isinstance(mimic_model, DataParallel) else mimic_model
-    file_util.save_pickle(mimic_model_without_dp, config['mimic_model']['ckpt'])
-    if distributed:
-        mimic_model = DistributedDataParallel(mimic_model_without_dp, device_ids=device_ids)
-    evaluate(mimic_model, test_loader, device, title='[Mimic model]')
+    student_configs = get_student_configs(config)
+    for student_config in student_configs:
+        title = '[Mimic model]' if len(student_configs) == 1\
+            else '[Mimic model: {}]'.format(student_config['student_model']['ckpt'])
+        mimic_model =\
+            mimic_util.get_mimic_model(student_config, org_model, teacher_model_type, teacher_model_config, device)
+        mimic_model_without_dp = mimic_model.module if isinstance(mimic_model, DataParallel) else mimic_model
+        file_util.save_pickle(mimic_model_without_dp, student_config['mimic_model']['ckpt'])
+        if distributed:
+            mimic_model = DistributedDataParallel(mimic_model_without_dp, device_ids=device_ids)
+        evaluate(mimic_model, test_loader, device, title=title, precision=args.precision)
 
 
 if __name__ == '__main__':
@@ -13,7 +13,7 @@ from myutils.common import file_util, yaml_util
 from myutils.pytorch import func_util, module_util
 from structure.logger import MetricLogger, SmoothedValue
 from tools.distillation import DistillationBox
-from utils import main_util, mimic_util, dataset_util
+from utils import ckpt_util, main_util, mimic_util, dataset_util
 
 try:
     from apex import amp
@@ -72,12 +72,14 @@ def get_model(model_config, device, distributed, sync_bn):
 
 
 def save_ckpt(model, optimizer, lr_scheduler, best_value, config, args, output_file_path):
-    file_util.make_parent_dirs(output_file_path)
+    if not main_util.is_main_process():
+        return
+
     model_state_dict =\
         model.module.state_dict() if isinstance(model, DistributedDataParallel) else model.state_dict()
-    main_util.save_on_master({'model': model_state_dict, 'optimizer': optimizer.state_dict(), 'best_value': best_value,
-                              'lr_scheduler': lr_scheduler.state_dict(), 'config': config, 'args': args},
-                             output_file_path)
+    ckpt_util.save_async({'model': model_state_dict, 'optimizer': optimizer.state_dict(), 'best_value': best_value,
+                          'lr_scheduler': lr_scheduler.state_dict(), 'config': config, 'args': args},
+                         output_file_path)
 
 
 def distill_one_epoch(distillation_box, train_data_loader, optimizer, device, epoch, interval, use_apex=False):
@@ -87,7 +89,8 @@ def distill_one_epoch(distillation_box, train_data_loader, optimizer, device, ep
     header = 'Epoch: [{}]'.format(epoch)
     for sample_batch, targets in metric_logger.log_every(train_data_loader, interval, header):
         start_time = time.time()
-        sample_batch, targets = sample_batch.to(device), targets.to(device)
+        with metric_logger.time_transfer():
+            sample_batch, targets = sample_batch.to(device), targets.to(device)
         loss = distillation_box(sample_batch, targets)
         optimizer.zero_grad()
         if use_apex:
@@ -98,8 +101,9 @@ def distill_one_epoch(distillation_box, train_data_loader, optimizer, device, ep
         optimizer.step()
 
         batch_size = sample_batch.shape[0]
-        metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        metric_logger.update(loss=loss, lr=optimizer.param_groups[0]['lr'])
         metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+    return metric_logger
 
 
 @torch.no_grad()
@@ -108,22 +112,23 @@ def evaluate(model, data_loader, device, interval=1000, split_name='Test', title
         print(title)
 
     num_threads = torch.get_num_threads()
-    torch.set_num_threads(1)
+    torch.set_num_threads(main_util.get_eval_threads())
     model.eval()
     metric_logger = MetricLogger(delimiter='  ')
     header = '{}:'.format(split_name)
     with torch.no_grad():
         for image, target in metric_logger.log_every(data_loader, interval, header):
-            image = image.to(device, non_blocking=True)
-            target = target.to(device, non_blocking=True)
+            with metric_logger.time_transfer():
+                image = image.to(device, non_blocking=True)
+                target = target.to(device, non_blocking=True)
             output = model(image)
 
             acc1, acc5 = main_util.compute_accuracy(output, target, topk=(1, 5))
             # FIXME need to take into account that the datasets
             # could have been padded in distributed setup
             batch_size = image.shape[0]
-            metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-            metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
+            metric_logger.meters['acc1'].update(acc1, n=batch_size)
+            metric_logger.meters['acc5'].update(acc5, n=batch_size)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -175,6 +180,7 @@ def distill(teacher_model, student_model, train_data_loader, val_data_loader, de
 
     dist.barrier()
     total_time = time.time() - start_time
+    ckpt_util.wait()
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
 
@@ -187,7 +193,7 @@ def main(args):
             raise RuntimeError('Failed to import apex. Please install apex from https://www.github.com/nvidia/apex '
                                'to enable mixed-precision training.')
 
-    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url)
+    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url, args.device)
     print(args)
     if torch.cuda.is_available():
         torch.backends.cudnn.benchmark = True
@@ -198,6 +204,7 @@ def main(args):
     input_shape = config['input_shape']
     train_config = config['train']
     test_config = config['test']
+    main_util.set_eval_policy(test_config.get('threads', None), test_config.get('workers', 1))
     train_data_loader, val_data_loader, test_data_loader =\
         dataset_util.get_data_loaders(dataset_config, batch_size=train_config['batch_size'],
                                       rough_size=train_config['rough_size'], reshape_size=input_shape[1:3],
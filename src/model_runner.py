@@ -8,15 +8,17 @@ from torch.backends import cudnn
 from torch.nn import DataParallel
 from torch.nn.parallel.distributed import DistributedDataParallel
 
-from myutils.common import file_util, yaml_util
+from myutils.common import yaml_util
 from myutils.pytorch import func_util
+from structure import metric_sink
 from structure.logger import MetricLogger, SmoothedValue
-from utils import main_util, mimic_util, module_util
+from utils import ckpt_util, main_util, mimic_util, module_util, profile_util
 
 
 def get_argparser():
     argparser = argparse.ArgumentParser(description='PyTorch model runner')
     argparser.add_argument('--config', required=True, help='yaml file path')
+    argparser.add_argument('--device', default='cuda', help='device')
     argparser.add_argument('--epoch', type=int, help='epoch (higher priority than config if set)')
     argparser.add_argument('--lr', type=float, help='learning rate (higher priority than config if set)')
     argparser.add_argument('-init', action='store_true', help='overwrite checkpoint')
@@ -24,6 +26,8 @@ def get_argparser():
     # distributed training parameters
     argparser.add_argument('--world_size', default=1, type=int, help='number of distributed processes')
     argparser.add_argument('--dist_url', default='env://', help='url used to set up distributed training')
+    profile_util.add_argument(argparser)
+    metric_sink.add_argument(argparser)
     return argparser
 
 
@@ -35,16 +39,21 @@ def train_epoch(model, train_loader, optimizer, criterion, epoch, device, interv
     header = 'Epoch: [{}]'.format(epoch)
     for sample_batch, targets in metric_logger.log_every(train_loader, interval, header):
         start_time = time.time()
-        sample_batch, targets = sample_batch.to(device), targets.to(device)
+        with metric_logger.time_transfer():
+            sample_batch, targets = sample_batch.to(device), targets.to(device)
         optimizer.zero_grad()
-        outputs = model(sample_batch)
-        loss = sum((criterion(o, targets) for o in outputs)) if isinstance(outputs, tuple)\
-            else criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
+        with profile_util.record('forward'):
+            outputs = model(sample_batch)
+            loss = sum((criterion(o, targets) for o in outputs)) if isinstance(outputs, tuple)\
+                else criterion(outputs, targets)
+        with profile_util.record('backward'):
+            loss.backward()
+        with profile_util.record('optimizer_step'):
+            optimizer.step()
         batch_size = sample_batch.shape[0]
-        metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        metric_logger.update(loss=loss, lr=optimizer.param_groups[0]['lr'])
         metric_logger.meters['img/s'].update(batch_size / (time.time() - start_time))
+    return metric_logger
 
 
 def save_ckpt(model, acc, epoch, ckpt_file_path, model_type):
@@ -55,13 +64,12 @@ def save_ckpt(model, acc, epoch, ckpt_file_path, model_type):
         'acc': acc,
         'epoch': epoch,
     }
-    file_util.make_parent_dirs(ckpt_file_path)
-    torch.save(state, ckpt_file_path)
+    ckpt_util.save_async(state, ckpt_file_path)
 
 
 def test(model, data_loader, device, interval=1000, split_name='Test'):
     num_threads = torch.get_num_threads()
-    torch.set_num_threads(1)
+    torch.set_num_threads(main_util.get_eval_threads())
     model.eval()
     metric_logger = MetricLogger(delimiter='  ')
     header = '{}:'.format(split_name)
@@ -69,19 +77,21 @@ def test(model, data_loader, device, interval=1000, split_name='Test'):
     with torch.no_grad():
         # upsampler = torch.nn.Upsample(226).cuda()
         for image, target in metric_logger.log_every(data_loader, interval, header):
-            image = image.to(device, non_blocking=True)
-            target = target.to(device, non_blocking=True)
+            with metric_logger.time_transfer():
+                image = image.to(device, non_blocking=True)
+                target = target.to(device, non_blocking=True)
             # image = upsampler.forward(image)
             start_time = time.time()
-            output = model(image)
+            with profile_util.record('forward'):
+                output = model(image)
             end_time = time.time()
             proc_time_list.append(end_time - start_time)
             acc1, acc5 = main_util.compute_accuracy(output, target, topk=(1, 5))
             # FIXME need to take into account that the datasets
             # could have been padded in distributed setup
             batch_size = image.shape[0]
-            metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
-            metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
+            metric_logger.meters['acc1'].update(acc1, n=batch_size)
+            metric_logger.meters['acc5'].update(acc5, n=batch_size)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -134,18 +144,24 @@ def train(model, train_loader, valid_loader, best_valid_acc, criterion, device,
 
     dist.barrier()
     total_time = time.time() - start_time
+    ckpt_util.wait()
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
 
 
 def run(args):
-    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url)
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    distributed, device_ids = main_util.init_distributed_mode(args.world_size, args.dist_url, args.device)
+    device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
     if device.type == 'cuda':
         cudnn.benchmark = True
 
     print(args)
     config = yaml_util.load_yaml_file(args.config)
+    if args.profile is not None:
+        profile_util.start(args.profile, profile_util.get_output_dir(config, 'model_runner'))
+    if args.metrics_dir is not None:
+        metric_sink.open_default_sinks(args.metrics_dir, args.metrics_formats)
+    main_util.set_eval_policy(config['test'].get('threads', None), config['test'].get('workers', 1))
     train_loader, valid_loader, test_loader, _ = main_util.get_data_loaders(config, distributed)
     if 'mimic_model' in config:
         model = mimic_util.get_mimic_model_easily(config, device)
@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-from compressai.layers import GDN1
 
 from models.mimic.base import BaseHeadMimic, BaseMimic
 
@@ -297,6 +296,8 @@ def mimic_version6(make_bottleneck, bottleneck_channels):
 
 # best so far
 def mimic_version7(bottleneck_channels, target_channels=512):
+    from compressai.layers import GDN1
+
     return nn.Sequential(
         nn.Conv2d(64, 64, kernel_size=2, stride=1, padding=1, bias=False),
         GDN1(64),
@@ -321,6 +322,8 @@ def mimic_version7(bottleneck_channels, target_channels=512):
 
 # new Matsubara paper
 def mimic_version8(bottleneck_channels, target_channels=512):
+    from compressai.layers import GDN1
+
     return nn.Sequential(
         #nn.Conv2d(3, bottleneck_channels * 4, kernel_size=5, stride=2, padding=2, bias=False),
         nn.Conv2d(3, bottleneck_channels * 4, kernel_size=3, stride=1, padding=1, bias=False),
@@ -341,6 +344,8 @@ def mimic_version8(bottleneck_channels, target_channels=512):
     )
 
 def mimic_version9(bottleneck_channels, target_channels=256):
+    from compressai.layers import GDN1
+
     return nn.Sequential(
         nn.Conv2d(64, 64, kernel_size=2, stride=1, padding=1, bias=False),
         GDN1(64),
@@ -367,6 +372,8 @@ def mimic_version9(bottleneck_channels, target_channels=256):
 
 # like 7b but with variational output
 def mimic_version10(bottleneck_channels, target_channels=512, variational=False):
+    from compressai.layers import GDN1
+
     n = 2 if variational else 1
     return nn.Sequential(
         nn.Conv2d(64, 64, kernel_size=2, stride=1, padding=1, bias=False),
@@ -15,7 +15,9 @@ def get_argparser():
     argparser = argparse.ArgumentParser(description='Layer-wise representation analyzer')
     argparser.add_argument('--config', required=True, help='yaml file path')
     argparser.add_argument('--split', default='train', help='dataset split')
-    argparser.add_argument('--method', default='tsne', help='representation method')
+    argparser.add_argument('--mode', default='mean_inputs', choices=['mean_inputs', 'all_samples'],
+                           help='discriminability of the per-class mean inputs or, streaming, of all the samples')
+    argparser.add_argument('--method', default='tsne', help='representation method (tsne, pca, random or none)')
     argparser.add_argument('--dim', type=int, default=2, help='number of dimensions after transformation')
     argparser.add_argument('--output', help='output plot file path')
     argparser.add_argument('-cpu', action='store_true', help='use CPU')
@@ -34,64 +36,116 @@ def extract_transformed_outputs(parent_module, transformed_output_list, name_lis
 
 
 def assess_discriminabilities(transformed_outputs):
+    """
+    Args:
+        transformed_outputs (list): per layer, list of transformed outputs
+
+    Returns (list): per layer, average pairwise distance between the transformed outputs
+
+    """
     value_list = list()
     for transformed_output in transformed_outputs:
-        dist_list = list()
-        for i, transformed_output_x in enumerate(transformed_output):
-            for transformed_output_y in transformed_outputs[i + 1:]:
-                dist = np.linalg.norm(transformed_output_x - transformed_output_y)
-                dist_list.append(dist)
-        value_list.append(np.mean(dist_list))
+        transformed_output = torch.from_numpy(np.concatenate(transformed_output)).double()
+        dist_mat = torch.cdist(transformed_output, transformed_output)
+        num_outputs = dist_mat.shape[0]
+        value_list.append((dist_mat.sum() / (num_outputs * (num_outputs - 1))).item())
     return value_list
 
 
+def compute_mean_inputs(data_loader):
+    """
+    Returns (Tensor): per-class mean input, for the classes found in data_loader (sorted by label)
+
+    """
+    input_sums = None
+    counts = None
+    for sample_batch, targets in data_loader:
+        num_classes = int(targets.max().item()) + 1
+        if input_sums is None or input_sums.shape[0] < num_classes:
+            new_input_sums = sample_batch.new_zeros((num_classes, *sample_batch.shape[1:]), dtype=torch.float64)
+            new_counts = torch.zeros(num_classes, dtype=torch.int64)
+            if input_sums is not None:
+                new_input_sums[:input_sums.shape[0]] = input_sums
+                new_counts[:counts.shape[0]] = counts
+            input_sums, counts = new_input_sums, new_counts
+
+        input_sums.index_add_(0, targets, sample_batch.double())
+        counts.index_add_(0, targets, torch.ones_like(targets))
+
+    valid = counts > 0
+    return (input_sums[valid] / counts[valid].view(-1, *[1] * (input_sums.dim() - 1))).float()
+
+
+def wrap_model(model, input_shape, device, method, dim, streaming=False):
+    model = model.module if isinstance(model, DataParallel) else model
+    wrapped_modules = list()
+    input_batch = torch.rand(input_shape).unsqueeze(0).to(device)
+    module_wrap_util.wrap_decomposable_modules(model, RepresentationWrapper, input_batch, wrapped_list=wrapped_modules,
+                                               method=method, dim=dim, streaming=streaming)
+    # forget the outputs of the probing forward passes
+    for wrapped_module in wrapped_modules:
+        wrapped_module.reset()
+    return model, wrapped_modules
+
+
+def plot_discriminabilities(discriminabilities, name_list, label, split_name, output_file_path):
+    xs = list(range(len(name_list)))
+    plt.plot(xs, discriminabilities, label=label)
+    plt.xticks(xs, name_list, rotation=90)
+    plt.xlabel('Layer')
+    plt.ylabel('Discriminability')
+    plt.title(split_name)
+    plt.legend()
+    plt.savefig(output_file_path)
+    plt.show()
+
+
 def analyze_with_mean_inputs(model, input_shape, data_loader, device, split_name,
                              method, dim, model_type, output_file_path):
     if output_file_path is None:
         output_file_path = './{}_with_mean_inputs_by_{}.eps'.format(model_type, '{}_{}-dim'.format(method, dim))
 
     file_util.make_parent_dirs(output_file_path)
-    model = model.module if isinstance(model, DataParallel) else model
-    input_batch = torch.rand(input_shape).unsqueeze(0).to(device)
-    module_wrap_util.wrap_decomposable_modules(model, RepresentationWrapper, input_batch, method=method, dim=dim)
+    model, _ = wrap_model(model, input_shape, device, method, dim)
     if device.type == 'cuda':
         model = DataParallel(model)
 
     model.eval()
-    accumulated_tensor_dict = dict()
     with torch.no_grad():
         print('Computing mean inputs ...')
-        for batch_idx, (sample_batch, targets) in enumerate(data_loader):
-            for x, y in zip(sample_batch, targets):
-                class_label = y.item()
-                if class_label not in accumulated_tensor_dict:
-                    accumulated_tensor_dict[class_label] = [x, 1]
-                else:
-                    accumulated_tensor_dict[class_label][0] += x
-                    accumulated_tensor_dict[class_label][1] += 1
-
-        mean_input_list = list()
-        for y, (x, num_samples) in accumulated_tensor_dict.items():
-            mean_x = x / num_samples
-            mean_input_list.append(mean_x)
-
-        mean_batch = torch.stack(mean_input_list)
+        mean_batch = compute_mean_inputs(data_loader).to(device)
         print('Analyzing layer-wise discriminability ...')
         preds = model(mean_batch)
 
     transformed_output_list = list()
     name_list = list()
     extract_transformed_outputs(model, transformed_output_list, name_list)
-    xs = list(range(len(name_list)))
     discriminabilities = assess_discriminabilities(transformed_output_list)
-    plt.plot(xs, discriminabilities, label=method)
-    plt.xticks(xs, name_list, rotation=90)
-    plt.xlabel('Layer')
-    plt.ylabel('Discriminability')
-    plt.title(split_name)
-    plt.legend()
-    plt.savefig(output_file_path)
-    plt.show()
+    plot_discriminabilities(discriminabilities, name_list, method, split_name, output_file_path)
+
+
+def analyze_with_all_samples(model, input_shape, data_loader, device, split_name, dim, model_type, output_file_path):
+    """
+    Streaming discriminability over all the samples: the ratio between the between-class and the within-class scatter
+    of the randomly projected outputs of each layer, accumulated batch by batch in constant memory.
+    """
+    if output_file_path is None:
+        output_file_path = './{}_with_all_samples_by_random_{}-dim.eps'.format(model_type, dim)
+
+    file_util.make_parent_dirs(output_file_path)
+    # not replicated by DataParallel, as the replicas would not keep the accumulated statistics
+    model, wrapped_modules = wrap_model(model, input_shape, device, 'random', dim, streaming=True)
+    model.eval()
+    with torch.no_grad():
+        print('Analyzing layer-wise discriminability over all samples ...')
+        for sample_batch, targets in data_loader:
+            for wrapped_module in wrapped_modules:
+                wrapped_module.targets = targets
+            preds = model(sample_batch.to(device))
+
+    name_list = [type(wrapped_module.org_module).__name__ for wrapped_module in wrapped_modules]
+    discriminabilities = [wrapped_module.get_scatter_ratio() for wrapped_module in wrapped_modules]
+    plot_discriminabilities(discriminabilities, name_list, 'random', split_name, output_file_path)
 
 
 def run(args):
@@ -112,8 +166,12 @@ def run(args):
     model_type, _, _, _ = module_util.resume_from_ckpt(model, model_config, False)
     split_name = args.split
     data_loader = train_loader if split_name == 'train' else valid_loader if split_name == 'valid' else test_loader
-    analyze_with_mean_inputs(model, input_shape, data_loader, device, split_name,
-                             args.method, args.dim, model_type, args.output)
+    if args.mode == 'all_samples':
+        analyze_with_all_samples(model, input_shape, data_loader, device, split_name, args.dim, model_type,
+                                 args.output)
+    else:
+        analyze_with_mean_inputs(model, input_shape, data_loader, device, split_name,
+                                 args.method, args.dim, model_type, args.output)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,14 @@
 from io import BytesIO
 
 import numpy as np
+import torch
 import torchvision.transforms.functional as functional
 from PIL import Image
+from torch.utils.data import Dataset
 from torchvision.datasets import ImageFolder
 from torchvision.datasets.folder import default_loader
 
+from myutils.common import file_util
 from myutils.pytorch.vision.dataset import RgbImageDataset
 
 
@@ -186,3 +189,62 @@ class AdvImageFolder(ImageFolder):
         print('File size [KB]:', self.avg_comp_file_size, '+-', self.sd_comp_file_size)
         print('Compression rate:', self.avg_compression_rate, '+-', self.sd_compression_rate)
 
+
+class SubsetDataset(Dataset):
+    """
+    Index-based view of a dataset: only the samples at the given indexes are ever read and decoded, and the storage of
+    the wrapped dataset is not copied.
+    """
+    def __init__(self, dataset, indexes):
+        self.dataset = dataset
+        self.indexes = np.asarray(indexes, dtype=np.int64)
+        targets = dataset.targets if hasattr(dataset, 'targets') else dataset.labels
+        self.targets = np.asarray(targets)[self.indexes]
+
+    @property
+    def data(self):
+        return self.dataset.data[self.indexes]
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, idx):
+        return self.dataset[int(self.indexes[idx])]
+
+    def __getattr__(self, attr):
+        # fall back to the wrapped dataset (e.g., classes), but not while the view itself is being unpickled
+        if 'dataset' not in self.__dict__:
+            raise AttributeError(attr)
+        return getattr(self.dataset, attr)
+
+
+class FeatureCacheDataset(Dataset):
+    """
+    Memory-mapped fp16 store of fixed-shape features (e.g., the outputs of a frozen head model), one row per sample.
+    get_storage() exposes the mapped file as a tensor, so that TensorBatchLoader gathers whole batches from it
+    without ever loading the store in memory.
+    """
+    def __init__(self, file_path, num_samples, feature_shape):
+        file_util.make_parent_dirs(file_path)
+        self.file_path = file_path
+        self.features = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.float16,
+                                                  shape=(num_samples, *feature_shape))
+        self.targets = np.zeros(num_samples, dtype=np.int64)
+        self.transform = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.asarray(self.features[idx])), int(self.targets[idx])
+
+    def write(self, start, features, targets):
+        end = start + features.shape[0]
+        self.features[start:end] = features.detach().to(torch.float16).cpu().numpy()
+        self.targets[start:end] = targets.cpu().numpy()
+
+    def flush(self):
+        self.features.flush()
+
+    def get_storage(self):
+        return torch.from_numpy(self.features), self.targets, None
@@ -1,11 +1,16 @@
+import contextlib
 import datetime
+import os
 import time
 from collections import defaultdict, deque
 
+import numpy as np
 import torch
 import torch.distributed as dist
 
-from utils import main_util
+from utils import main_util, profile_util
+
+DEFAULT_SINKS = list()
 
 
 class SmoothedValue(object):
@@ -32,13 +37,23 @@ class SmoothedValue(object):
         """
         if not main_util.is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=main_util.get_sync_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
         self.count = int(t[0])
         self.total = t[1]
 
+    def merge(self, other):
+        """
+        Adds the series tracked by another meter (e.g., of another evaluation shard).
+        """
+        if isinstance(other, TensorValue):
+            other.materialize()
+        self.deque.extend(other.deque)
+        self.count += other.count
+        self.total += other.total
+
     @property
     def median(self):
         d = torch.tensor(list(self.deque))
@@ -70,6 +85,74 @@ class SmoothedValue(object):
             value=round_at_significant(self.value, 5))
 
 
+class TensorValue(SmoothedValue):
+    """SmoothedValue that also accepts tensors: they are detached and accumulated
+    on their own device, and copied to the host all at once only when the meter
+    is read (e.g., at log_every print intervals), so that updates never force a
+    device synchronization.
+    """
+
+    def __init__(self, window_size=20, fmt=None):
+        super().__init__(window_size, fmt)
+        self.pending = deque(maxlen=window_size)
+        self.pending_total = None
+        self.pending_count = 0
+
+    def update(self, value, n=1):
+        if not isinstance(value, torch.Tensor):
+            self.materialize()
+            super().update(value, n)
+            return
+        value = value.detach().reshape(()).double()
+        self.pending.append(value)
+        self.pending_total = value * n if self.pending_total is None else self.pending_total + value * n
+        self.pending_count += n
+
+    def materialize(self):
+        if self.pending_total is None:
+            return
+        values = torch.stack(list(self.pending) + [self.pending_total]).tolist()
+        self.deque.extend(values[:-1])
+        self.total += values[-1]
+        self.count += self.pending_count
+        self.pending.clear()
+        self.pending_total = None
+        self.pending_count = 0
+
+    def synchronize_between_processes(self):
+        self.materialize()
+        super().synchronize_between_processes()
+
+    def merge(self, other):
+        self.materialize()
+        super().merge(other)
+
+    @property
+    def median(self):
+        self.materialize()
+        return super().median
+
+    @property
+    def avg(self):
+        self.materialize()
+        return super().avg
+
+    @property
+    def global_avg(self):
+        self.materialize()
+        return super().global_avg
+
+    @property
+    def max(self):
+        self.materialize()
+        return super().max
+
+    @property
+    def value(self):
+        self.materialize()
+        return super().value
+
+
 class CtrValue(object):
     """
     Track a counter and provide access to fraction value over a global window.
@@ -96,13 +179,22 @@ class CtrValue(object):
         """
         if not main_util.is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=main_util.get_sync_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
         self.count = int(t[0])
         self.total = t[1]
 
+    def merge(self, other):
+        """
+        Adds the counts tracked by another counter (e.g., of another evaluation shard).
+        """
+        self.c_deque.extend(other.c_deque)
+        self.t_deque.extend(other.t_deque)
+        self.count += other.count
+        self.total += other.total
+
     @property
     def median(self):
         dc = torch.tensor(list(self.c_deque))
@@ -141,20 +233,61 @@ class CtrValue(object):
             value=round_at_significant(self.value, 5))
 
 
+def add_default_sink(sink):
+    """
+    Attaches sink (see structure.metric_sink) to every MetricLogger created from now on.
+    """
+    DEFAULT_SINKS.append(sink)
+
+
+def get_rss():
+    """
+    Returns (int): resident set size of this process in bytes (peak one where /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_batch_size(obj):
+    """
+    Returns (int): number of samples of a batch yielded by a data loader (0 if unknown)
+    """
+    batch = obj[0] if isinstance(obj, (tuple, list)) and len(obj) > 0 else obj
+    try:
+        return len(batch)
+    except TypeError:
+        return 0
+
+
 class MetricLogger(object):
-    def __init__(self, delimiter="\t"):
-        self.meters = defaultdict(SmoothedValue)
+    def __init__(self, delimiter="\t", sinks=None):
+        self.meters = defaultdict(TensorValue)
         self.counters = defaultdict(CtrValue)
         self.delimiter = delimiter
+        self.sinks = list(DEFAULT_SINKS) if sinks is None else sinks
+        self.h2d_elapsed_time = 0.0
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
-            if isinstance(v, torch.Tensor):
+            if isinstance(v, torch.Tensor) and not isinstance(self.meters[k], TensorValue):
                 v = v.item()
-            assert isinstance(v, (float, int))
+            assert isinstance(v, (float, int, torch.Tensor))
             self.meters[k].update(v)
 
+    def __getstate__(self):
+        # sinks stay with the process that created them (e.g., a logger returned by a data-parallel worker)
+        state = dict(self.__dict__)
+        state['sinks'] = list()
+        return state
+
     def __getattr__(self, attr):
+        if attr in ('meters', 'counters', 'sinks'):
+            # not set yet, e.g., while unpickling
+            raise AttributeError(attr)
         if attr in self.meters:
             return self.meters[attr]
         if attr in self.counters:
@@ -178,20 +311,92 @@ class MetricLogger(object):
         for counter in self.counters.values():
             counter.synchronize_between_processes()
 
+    def merge(self, other):
+        """
+        Adds meters and counters of another logger, e.g., of another shard of a data-parallel evaluation.
+        """
+        for name, meter in other.meters.items():
+            self.meters[name].merge(meter)
+        for name, counter in other.counters.items():
+            self.counters[name].merge(counter)
+
     def add_meter(self, name, meter):
         self.meters[name] = meter
 
     def add_counter(self, name, counter):
         self.counters[name] = counter
 
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    @contextlib.contextmanager
+    def time_transfer(self):
+        """
+        Times the host to device transfer of the current log_every step (h2d_time meter), which is then excluded from
+        its compute_time. Since the copies may be asynchronous, this is the time the host spends issuing them.
+        """
+        start_time = time.time()
+        try:
+            with profile_util.record('h2d'):
+                yield
+        finally:
+            self.h2d_elapsed_time += time.time() - start_time
+
+    def emit(self, header, step, num_steps, num_samples, elapsed_time, data_time, h2d_time, compute_time,
+             step_times):
+        """
+        Writes the record of the last log interval to the sinks.
+        Args:
+            header (str): header of the log_every loop
+            step (int): steps done so far
+            num_steps (int): steps of the loop
+            num_samples (int): samples processed in the interval
+            elapsed_time (float): wall time of the interval in seconds
+            data_time (float): time spent waiting for the data loader in the interval
+            h2d_time (float): time spent in host to device transfers in the interval
+            compute_time (float): rest of the time of the steps of the interval
+            step_times (list): time of each step of the interval
+
+        """
+        p50, p90, p99 = np.percentile(step_times, [50, 90, 99]) if len(step_times) > 0 else (0.0, 0.0, 0.0)
+        record = {
+            'time': time.time(),
+            'header': header,
+            'step': step,
+            'steps': num_steps,
+            'img/s': num_samples / elapsed_time if elapsed_time > 0 else 0.0,
+            'step_time': {'p50': float(p50), 'p90': float(p90), 'p99': float(p99)},
+            'data_time': data_time,
+            'h2d_time': h2d_time,
+            'compute_time': compute_time,
+            'rss_bytes': get_rss(),
+            'meters': {name: {'value': float(meter.value), 'global_avg': float(meter.global_avg)}
+                       for name, meter in self.meters.items()},
+            'counters': {name: {'global_avg': float(counter.global_avg)} for name, counter in self.counters.items()}
+        }
+        if torch.cuda.is_available():
+            record['max_cuda_memory_bytes'] = torch.cuda.max_memory_allocated()
+        for sink in self.sinks:
+            sink.write(record)
+
     def log_every(self, iterable, print_freq, header=None, verbose=True):
+        """
+        Yields the items of iterable, printing the meters every print_freq steps. The time of every step is split
+        into the data_time (waiting for the next item), h2d_time (see time_transfer) and compute_time (the rest)
+        meters, whose totals are printed at the end along with the total time.
+        """
         i = 0
         if not header:
             header = ''
         start_time = time.time()
         end = time.time()
         iter_time = SmoothedValue(fmt='{avg:.4f}')
-        data_time = SmoothedValue(fmt='{avg:.4f}')
+        for name in ['data_time', 'h2d_time', 'compute_time']:
+            if name not in self.meters:
+                self.add_meter(name, SmoothedValue(fmt='{avg:.4f}'))
+        data_time, h2d_time, compute_time = self.meters['data_time'], self.meters['h2d_time'], \
+            self.meters['compute_time']
+        start_totals = data_time.total, h2d_time.total, compute_time.total
         space_fmt = ':' + str(len(str(len(iterable)))) + 'd'
         if torch.cuda.is_available():
             log_msg = self.delimiter.join([
@@ -200,7 +405,6 @@ class MetricLogger(object):
                 'eta: {eta}',
                 '{meters}',
                 'time: {time}',
-                'data: {data}',
                 'max mem: {memory:.0f}'
             ])
         else:
@@ -209,14 +413,26 @@ class MetricLogger(object):
                 '[{0' + space_fmt + '}/{1}]',
                 'eta: {eta}',
                 '{meters}',
-                'time: {time}',
-                'data: {data}'
+                'time: {time}'
             ])
         MB = 1024.0 * 1024.0
-        for obj in iterable:
-            data_time.update(time.time() - end)
+        # per log interval statistics, for the sinks
+        interval_start_time = start_time
+        interval_samples = 0
+        interval_totals = start_totals
+        interval_step_times = list()
+        for obj in profile_util.iterate(iterable):
+            fetch_end = time.time()
+            self.h2d_elapsed_time = 0.0
             yield obj
-            iter_time.update(time.time() - end)
+            step_end = time.time()
+            iter_time.update(step_end - end)
+            data_time.update(fetch_end - end)
+            h2d_time.update(self.h2d_elapsed_time)
+            compute_time.update(max(step_end - fetch_end - self.h2d_elapsed_time, 0.0))
+            if self.sinks:
+                interval_samples += get_batch_size(obj)
+                interval_step_times.append(step_end - end)
             if i % print_freq == 0 or i == len(iterable) - 1:
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
@@ -227,18 +443,37 @@ class MetricLogger(object):
                         print(log_msg.format(
                             i, len(iterable), eta=eta_string,
                             meters=str(self),
-                            time=str(iter_time), data=str(data_time),
+                            time=str(iter_time),
                             memory=torch.cuda.max_memory_allocated() / MB))
                     else:
                         print(log_msg.format(
                             i, len(iterable), eta=eta_string,
                             meters=str(self),
-                            time=str(iter_time), data=str(data_time)))
+                            time=str(iter_time)))
+                if self.sinks:
+                    now = time.time()
+                    totals = data_time.total, h2d_time.total, compute_time.total
+                    self.emit(header, min(i + 1, len(iterable)), len(iterable), interval_samples,
+                              now - interval_start_time,
+                              *[total - interval_total for total, interval_total in zip(totals, interval_totals)],
+                              interval_step_times)
+                    interval_start_time = now
+                    interval_samples = 0
+                    interval_totals = totals
+                    interval_step_times = list()
             i += 1
             end = time.time()
+        for sink in self.sinks:
+            sink.flush()
         total_time = time.time() - start_time
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
-        print('{} Total time: {}'.format(header, total_time_str))
+        loop_data_time, loop_h2d_time, loop_compute_time = \
+            [total - start_total for total, start_total in zip((data_time.total, h2d_time.total, compute_time.total),
+                                                               start_totals)]
+        loop_step_time = loop_data_time + loop_h2d_time + loop_compute_time
+        print('{} Total time: {} (data: {:.1f} s, h2d: {:.1f} s, compute: {:.1f} s, waiting for data {:.1f}%)'
+              .format(header, total_time_str, loop_data_time, loop_h2d_time, loop_compute_time,
+                      100 * loop_data_time / loop_step_time if loop_step_time > 0 else 0.0))
 
 
 def round_at_significant(x, d):
@@ -0,0 +1,158 @@
+import atexit
+import csv
+import json
+import os
+import re
+import time
+
+from structure import logger
+from utils import ckpt_util, main_util
+
+FORMATS = ['jsonl', 'csv', 'prom']
+
+
+def flatten(record, prefix=''):
+    """
+    Returns (dict): the numeric entries of a (nested) record, keyed by their dot-separated path
+    """
+    flat_record = dict()
+    for key, value in record.items():
+        if isinstance(value, dict):
+            flat_record.update(flatten(value, '{}{}.'.format(prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat_record[prefix + key] = value
+    return flat_record
+
+
+class BufferedSink(object):
+    """
+    Keeps the records emitted by MetricLogger.log_every in memory and writes them out only once buffer_size records
+    are pending or flush_interval seconds have passed since the last write, so that logging never waits for the
+    disk at every interval.
+    """
+
+    def __init__(self, buffer_size=64, flush_interval=10.0):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.buffer = list()
+        self.last_flush_time = time.time()
+
+    def write(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size or time.time() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            records, self.buffer = self.buffer, list()
+            self._write_records(records)
+        self.last_flush_time = time.time()
+
+    def _write_records(self, records):
+        raise NotImplementedError('_write_records method must be implemented')
+
+    def close(self):
+        self.flush()
+
+
+class JsonlSink(BufferedSink):
+    """
+    Appends one JSON object per record.
+    """
+
+    def __init__(self, file_path, buffer_size=64, flush_interval=10.0):
+        super().__init__(buffer_size, flush_interval)
+        self.file_path = file_path
+
+    def _write_records(self, records):
+        with open(self.file_path, 'a') as fp:
+            fp.writelines(json.dumps(record) + '\n' for record in records)
+
+
+class CsvSink(BufferedSink):
+    """
+    Appends the records in long format, one (time, header, step, metric, value) row per numeric entry, so that
+    loops logging different meters can share the same file.
+    """
+    FIELD_NAMES = ['time', 'header', 'step', 'metric', 'value']
+
+    def __init__(self, file_path, buffer_size=64, flush_interval=10.0):
+        super().__init__(buffer_size, flush_interval)
+        self.file_path = file_path
+
+    def _write_records(self, records):
+        write_header = not os.path.isfile(self.file_path) or os.path.getsize(self.file_path) == 0
+        with open(self.file_path, 'a', newline='') as fp:
+            writer = csv.writer(fp)
+            if write_header:
+                writer.writerow(self.FIELD_NAMES)
+            for record in records:
+                for metric, value in flatten(record).items():
+                    if metric not in ('time', 'step'):
+                        writer.writerow([record['time'], record['header'], record['step'], metric, value])
+
+
+class PrometheusSink(BufferedSink):
+    """
+    Keeps the latest value of every metric per log_every header and rewrites them atomically as a Prometheus text
+    exposition file (e.g., for the textfile collector of the node exporter) at every flush.
+    """
+
+    def __init__(self, file_path, prefix='hnd', flush_interval=10.0):
+        super().__init__(1, flush_interval)
+        self.file_path = file_path
+        self.prefix = prefix
+        self.samples = dict()
+
+    def write(self, record):
+        for metric, value in flatten(record).items():
+            self.samples[(self.get_metric_name(metric), record['header'])] = value
+        if time.time() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def get_metric_name(self, metric):
+        return re.sub(r'[^a-zA-Z0-9_:]', '_', '{}_{}'.format(self.prefix, metric.replace('/', '_per_')))
+
+    @staticmethod
+    def escape(label_value):
+        return label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def flush(self):
+        if len(self.samples) > 0:
+            lines = list()
+            for metric_name in sorted({metric_name for metric_name, _ in self.samples}):
+                lines.append('# TYPE {} gauge'.format(metric_name))
+                lines.extend('{}{{header="{}"}} {}'.format(metric_name, self.escape(header), value)
+                             for (name, header), value in sorted(self.samples.items()) if name == metric_name)
+            text = '\n'.join(lines) + '\n'
+            ckpt_util.atomic_save(text, self.file_path, lambda obj, fp: fp.write(obj.encode('utf-8')))
+        self.last_flush_time = time.time()
+
+
+def add_argument(argparser):
+    argparser.add_argument('--metrics_dir', help='directory of the machine-readable metrics written at every '
+                                                 'log interval (one file per format and rank)')
+    argparser.add_argument('--metrics_formats', nargs='+', default=FORMATS, choices=FORMATS,
+                           help='formats of the metrics: JSON lines, CSV and/or Prometheus text exposition')
+
+
+def open_default_sinks(dir_path, formats=None):
+    """
+    Creates the sinks of the chosen formats in dir_path and attaches them to every MetricLogger; they are flushed at
+    the end of every log_every loop and closed at exit.
+    Args:
+        dir_path (str): output directory
+        formats (list): formats among FORMATS (all by default)
+
+    Returns (list): the sinks
+
+    """
+    os.makedirs(dir_path, exist_ok=True)
+    file_prefix = os.path.join(dir_path, 'metrics-rank{}'.format(main_util.get_rank()))
+    sink_classes = {'jsonl': JsonlSink, 'csv': CsvSink, 'prom': PrometheusSink}
+    sinks = [sink_classes[sink_format]('{}.{}'.format(file_prefix, sink_format))
+             for sink_format in (FORMATS if formats is None else formats)]
+    for sink in sinks:
+        logger.add_default_sink(sink)
+        atexit.register(sink.close)
+    return sinks
@@ -1,33 +1,169 @@
+import contextlib
+import queue
+import statistics
 import sys
+import threading
 import time
 import zlib
 
 import numpy as np
-from sklearn.manifold import TSNE
+import torch
 from torch import nn
+from torch import profiler
+
+
+class CompressionPool(object):
+    """
+    Worker threads compressing layer outputs off the forward path (zlib releases the GIL while compressing).
+    At most max_pending jobs wait in the queue: submit blocks beyond that, which bounds the memory held by copies.
+    """
+
+    def __init__(self, num_workers=4, max_pending=64):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.threads = [threading.Thread(target=self._run, name='CompressionPool-{}'.format(i), daemon=True)
+                        for i in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            fn, args = self.queue.get()
+            try:
+                fn(*args)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn, *args):
+        self.queue.put((fn, args))
+
+    def wait(self):
+        self.queue.join()
+
+
+class CompressionStats(object):
+    """
+    Streaming statistics of per-sample data sizes and compression rates (Welford's algorithm), safe to update from
+    several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.org_data_size = 0
+        self.compressed_data_size = 0
+        self.mean_rate = 0.0
+        self.m2_rate = 0.0
+
+    def update(self, org_data_size, compressed_data_size):
+        rate = compressed_data_size / org_data_size
+        with self.lock:
+            self.count += 1
+            self.org_data_size += org_data_size
+            self.compressed_data_size += compressed_data_size
+            delta = rate - self.mean_rate
+            self.mean_rate += delta / self.count
+            self.m2_rate += delta * (rate - self.mean_rate)
+
+    def get_rate_interval(self, confidence=0.95):
+        """
+        Args:
+            confidence (float): confidence level
+
+        Returns (tuple): normal-approximation confidence interval of the mean per-sample compression rate
+
+        """
+        if self.count < 2:
+            return self.mean_rate, self.mean_rate
+
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        half_width = z * np.sqrt(self.m2_rate / (self.count - 1) / self.count)
+        return self.mean_rate - half_width, self.mean_rate + half_width
 
 
 class CompressionWrapper(nn.Module):
-    def __init__(self, org_module, compression_level=9):
+    """
+    Measures how well the outputs of the wrapped module compress, sample by sample.
+    Only every sample_interval-th batch is considered; with reservoir_size > 0, a uniform reservoir of that many
+    samples is kept and compressed by finalize(), otherwise the sampled batches are compressed as they come.
+    If a CompressionPool is given the compression runs there and the forward pass only pays for a copy of the output.
+    """
+
+    def __init__(self, org_module, compression_level=9, sample_interval=1, reservoir_size=0, pool=None):
         super().__init__()
         self.org_module = org_module
         self.compression_level = compression_level
-        self.org_data_size = 0
-        self.compressed_data_size = 0
-        self.count = 0
+        self.sample_interval = sample_interval
+        self.reservoir_size = reservoir_size
+        self.pool = pool
+        self.stats = CompressionStats()
+        self.num_batches = 0
+        self.num_seen_samples = 0
+        self.reservoir = list()
+
+    def compress(self, np_output):
+        for np_sample in np_output:
+            compressed_sample = zlib.compress(np_sample, self.compression_level)
+            self.stats.update(np_sample.nbytes, sys.getsizeof(compressed_sample))
+
+    def add_to_reservoir(self, np_output):
+        # samples are copied, a view would keep its whole batch alive
+        for np_sample in np_output:
+            self.num_seen_samples += 1
+            if len(self.reservoir) < self.reservoir_size:
+                self.reservoir.append(np_sample.copy())
+            else:
+                idx = np.random.randint(self.num_seen_samples)
+                if idx < self.reservoir_size:
+                    self.reservoir[idx] = np_sample.copy()
+
+    def sample(self, output):
+        self.num_batches += 1
+        if (self.num_batches - 1) % self.sample_interval != 0:
+            return
+
+        # copied, as the output may be modified in place by the next layers
+        np_output = output.detach().to('cpu', copy=True).numpy()
+        if self.reservoir_size > 0:
+            self.add_to_reservoir(np_output)
+        elif self.pool is not None:
+            self.pool.submit(self.compress, np_output)
+        else:
+            self.compress(np_output)
 
     def forward(self, *input):
         output = self.org_module(*input)
-        np_output = output.clone().cpu().detach().numpy()
-        compressed_output = zlib.compress(np_output, self.compression_level)
-        self.org_data_size += np_output.nbytes
-        self.compressed_data_size += sys.getsizeof(compressed_output)
-        self.count += len(np_output)
+        self.sample(output)
         return output
 
+    def finalize(self):
+        """
+        Compresses the reservoir (if any) and waits for the pending compressions, to be called before reading the
+        statistics.
+        """
+        if len(self.reservoir) > 0:
+            reservoir, self.reservoir = np.stack(self.reservoir), list()
+            self.compress(reservoir)
+        if self.pool is not None:
+            self.pool.wait()
+
+    @property
+    def count(self):
+        return self.stats.count
+
+    @property
+    def org_data_size(self):
+        return self.stats.org_data_size
+
+    @property
+    def compressed_data_size(self):
+        return self.stats.compressed_data_size
+
     def get_compression_rate(self):
         return self.compressed_data_size / self.org_data_size
 
+    def get_compression_rate_interval(self, confidence=0.95):
+        return self.stats.get_rate_interval(confidence)
+
     def get_average_org_data_size(self):
         return self.org_data_size / self.count
 
@@ -35,70 +171,200 @@ class CompressionWrapper(nn.Module):
         return self.compressed_data_size / self.count
 
 
+class StreamingTimeStats(object):
+    """
+    Constant-memory statistics of a stream of durations in nanoseconds: count, mean and M2 (Welford's algorithm),
+    min/max and an HDR-style log-linear histogram for percentiles. Durations below 2 ** (sub_bucket_bits + 1) ns are
+    counted exactly, larger ones with a relative error below 2 ** -sub_bucket_bits.
+    """
+
+    def __init__(self, sub_bucket_bits=5):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.histogram = np.zeros((66 - sub_bucket_bits) << sub_bucket_bits, dtype=np.int64)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def _get_bucket(self, value):
+        shift = value.bit_length() - self.sub_bucket_bits - 1
+        if shift <= 0:
+            return value
+        return (shift << self.sub_bucket_bits) + (value >> shift)
+
+    def _get_bucket_value(self, bucket):
+        shift = (bucket >> self.sub_bucket_bits) - 1
+        if shift <= 0:
+            return bucket
+        # middle of the bucket
+        return ((bucket - (shift << self.sub_bucket_bits)) << shift) + (1 << (shift - 1))
+
+    def update(self, value):
+        value = max(int(value), 0)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.histogram[self._get_bucket(value)] += 1
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def percentile(self, q):
+        """
+        Args:
+            q (float): percentile in [0, 100]
+
+        Returns (int): approximate q-th percentile in nanoseconds
+
+        """
+        if self.count == 0:
+            return 0
+
+        rank = max(int(np.ceil(q / 100 * self.count)), 1)
+        bucket = int(np.searchsorted(np.cumsum(self.histogram), rank))
+        return min(max(self._get_bucket_value(bucket), self.min), self.max)
+
+
 class RunTimeWrapper(CompressionWrapper):
-    def __init__(self, org_module, compression_level=9):
+    """
+    Measures the time elapsed from the beginning of the forward pass (taken by the wrapper flagged as is_first) to the
+    end of the wrapped module, and the time spent compressing its output if is_compressed, with perf_counter_ns and
+    streaming statistics, so that arbitrarily long streams are analyzed in constant memory.
+    With record_function, the wrapped module also runs inside a torch.profiler range named after it.
+    """
+    start_timestamp = 0
+
+    def __init__(self, org_module, compression_level=9, record_function=False):
         super().__init__(org_module, compression_level)
         self.is_first = False
         self.is_compressed = False
-        self.start_timestamp_list = list()
-        self.timestamp_list = list()
-        self.comp_timestamp_list = list()
+        self.record_function = record_function
+        self.elapsed_time_stats = StreamingTimeStats()
+        self.comp_time_stats = StreamingTimeStats()
 
     def forward(self, *input):
         if self.is_first:
-            self.start_timestamp_list.append(time.time())
+            RunTimeWrapper.start_timestamp = time.perf_counter_ns()
 
-        output = self.org_module(*input)
-        self.timestamp_list.append(time.time())
+        with profiler.record_function(type(self.org_module).__name__) if self.record_function \
+                else contextlib.nullcontext():
+            output = self.org_module(*input)
+        timestamp = time.perf_counter_ns()
         if not self.is_compressed:
+            self.elapsed_time_stats.update(timestamp - RunTimeWrapper.start_timestamp)
             return output
 
-        np_output = output.clone().cpu().detach().numpy()
-        compressed_output = zlib.compress(np_output, self.compression_level)
-        self.org_data_size += np_output.nbytes
-        self.compressed_data_size += sys.getsizeof(compressed_output)
-        self.count += len(np_output)
-        self.comp_timestamp_list.append(time.time())
+        # compressed synchronously, as the compression time is what is measured
+        self.compress(output.clone().cpu().detach().numpy())
+        comp_timestamp = time.perf_counter_ns()
+        self.comp_time_stats.update(comp_timestamp - timestamp)
+        self.elapsed_time_stats.update(comp_timestamp - RunTimeWrapper.start_timestamp)
         return output
 
-    def get_timestamps(self):
-        return self.timestamp_list
-
-    def get_compression_timestamps(self):
-        return self.comp_timestamp_list
-
-    def get_compression_time_list(self):
-        return [self.comp_timestamp_list[i] - self.timestamp_list[i] for i in range(len(self.comp_timestamp_list))]
-
 
 class RepresentationWrapper(nn.Module):
-    def __init__(self, org_module, method='tsne', dim=2):
+    """
+    Transforms the (flattened) outputs of the wrapped module to dim dimensions, with t-SNE ('tsne'), randomized PCA
+    ('pca') or a random Gaussian projection ('random'); any other method keeps the outputs as they are.
+    In streaming mode nothing is stored: the outputs are randomly projected and their per-class sums and squared norms
+    are accumulated (the targets of the batch have to be set before each forward), to compute the ratio between the
+    between-class and the within-class scatter over all the samples.
+    """
+
+    def __init__(self, org_module, method='tsne', dim=2, streaming=False):
         super().__init__()
         self.org_module = org_module
         self.method = method
         self.dim = dim
+        self.streaming = streaming
+        self.projection = None
+        self.targets = None
         self.transformed_list = list()
+        self.class_sums = None
+        self.class_counts = None
+        self.sum_squared_norms = 0.0
+
+    def reset(self):
+        self.transformed_list = list()
+        self.class_sums = None
+        self.class_counts = None
+        self.sum_squared_norms = 0.0
 
     @staticmethod
-    def normalize(np_mat):
-        min_values = np.min(np_mat, axis=0, keepdims=True)
-        max_values = np.max(np_mat, axis=0, keepdims=True)
-        return (np_mat - min_values) / (max_values - min_values)
+    def normalize(mat):
+        min_values = mat.min(dim=0, keepdim=True)[0]
+        max_values = mat.max(dim=0, keepdim=True)[0]
+        return (mat - min_values) / (max_values - min_values)
+
+    def transform_by_tsne(self, flat_output):
+        from sklearn.manifold import TSNE
+        transformed_output = TSNE(n_components=self.dim).fit_transform(flat_output.cpu().numpy())
+        return self.normalize(torch.from_numpy(transformed_output))
 
-    def transform_by_tsne(self, np_flat_output):
-        transformed_output = TSNE(n_components=self.dim).fit_transform(np_flat_output)
-        return self.normalize(transformed_output)
+    def transform_by_pca(self, flat_output):
+        centered_output = flat_output - flat_output.mean(dim=0, keepdim=True)
+        _, _, v = torch.pca_lowrank(centered_output, q=min(self.dim, *centered_output.shape), center=False)
+        return self.normalize(centered_output @ v)
+
+    def project(self, flat_output):
+        # the same random matrix is used for every batch
+        if self.projection is None:
+            generator = torch.Generator().manual_seed(0)
+            self.projection = torch.randn(flat_output.shape[1], self.dim, generator=generator) / np.sqrt(self.dim)
+        self.projection = self.projection.to(flat_output.device)
+        return flat_output @ self.projection
+
+    def accumulate(self, projected_output):
+        projected_output = projected_output.double()
+        targets = self.targets.to(projected_output.device)
+        num_classes = int(targets.max().item()) + 1
+        if self.class_sums is None or self.class_sums.shape[0] < num_classes:
+            class_sums = projected_output.new_zeros((num_classes, projected_output.shape[1]))
+            class_counts = projected_output.new_zeros(num_classes)
+            if self.class_sums is not None:
+                class_sums[:self.class_sums.shape[0]] = self.class_sums
+                class_counts[:self.class_counts.shape[0]] = self.class_counts
+            self.class_sums, self.class_counts = class_sums, class_counts
+
+        self.class_sums.index_add_(0, targets, projected_output)
+        self.class_counts.index_add_(0, targets, torch.ones_like(targets, dtype=projected_output.dtype))
+        self.sum_squared_norms += (projected_output * projected_output).sum().item()
 
     def forward(self, *input):
         output = self.org_module(*input)
-        np_flat_output = output.clone().cpu().detach().flatten(1).numpy()
+        flat_output = output.detach().flatten(1).float()
+        if self.streaming:
+            self.accumulate(self.project(flat_output))
+            return output
+
         if self.method == 'tsne':
-            transformed_output = self.transform_by_tsne(np_flat_output)
+            transformed_output = self.transform_by_tsne(flat_output)
+        elif self.method == 'pca':
+            transformed_output = self.transform_by_pca(flat_output)
+        elif self.method == 'random':
+            transformed_output = self.normalize(self.project(flat_output))
         else:
-            transformed_output = self.normalize(np_flat_output)
+            transformed_output = self.normalize(flat_output)
 
-        self.transformed_list.append(transformed_output)
+        self.transformed_list.append(transformed_output.cpu().numpy())
         return output
 
     def get_transformed_list(self):
         return self.transformed_list.copy()
+
+    def get_scatter_ratio(self):
+        """
+        Returns (float): between-class over within-class scatter of the samples seen in streaming mode
+
+        """
+        valid = self.class_counts > 0
+        class_sums, class_counts = self.class_sums[valid], self.class_counts[valid]
+        class_scatter = ((class_sums * class_sums).sum(dim=1) / class_counts).sum().item()
+        total_sum = class_sums.sum(dim=0)
+        total_scatter = (total_sum * total_sum).sum().item() / class_counts.sum().item()
+        return (class_scatter - total_scatter) / (self.sum_squared_norms - class_scatter)
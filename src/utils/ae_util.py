@@ -2,12 +2,15 @@ import torch
 from torch import nn
 from torch.nn import DataParallel
 from torch.nn.parallel.distributed import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 from models.autoencoder.base import BaseExtendedModel
 from models.autoencoder.input_ae import InputAutoencoder, InputVAE
 from models.autoencoder.middle_ae import MiddleAutoencoder
 from myutils.common import yaml_util
-from utils import module_util
+from structure.dataset import FeatureCacheDataset
+from utils import dataset_util, main_util, module_util
 
 
 def get_autoencoder(config, device=None, is_static=False):
@@ -78,3 +81,41 @@ def get_extended_model(autoencoder, config, input_shape, device, skip_bottleneck
     module_util.resume_from_ckpt(model, sub_model_config, False)
     return extend_model(autoencoder, model, input_shape, device,
                         org_model_config['partition_idx'], skip_bottleneck_size), model
+
+
+@torch.no_grad()
+def cache_head_outputs(head_model, train_loader, file_path, device, precision='fp32', cache=None):
+    """
+    Runs the frozen head model once over the training samples of train_loader (the ones of this process, if
+    distributed) and dumps its outputs to a memory-mapped fp16 store, to train the autoencoder without recomputing
+    the head at every epoch. The samples go through the training transforms, so every call stores a new fixed
+    augmentation of the training set.
+    Args:
+        head_model:
+        train_loader:
+        file_path (str): file of the store
+        device:
+        precision (str): 'fp32' or 'bf16'
+        cache (FeatureCacheDataset): store to overwrite (refresh), a new one is created if None
+
+    Returns (FeatureCacheDataset): the store
+
+    """
+    dataset = train_loader.dataset
+    if isinstance(train_loader.sampler, DistributedSampler):
+        dataset = dataset_util.get_subset(dataset, list(train_loader.sampler))
+
+    loader = DataLoader(dataset, batch_size=train_loader.batch_size, shuffle=False,
+                        num_workers=train_loader.num_workers, pin_memory=train_loader.pin_memory)
+    head_model.eval()
+    start = 0
+    for sample_batch, targets in loader:
+        sample_batch = main_util.to_channels_last(sample_batch.to(device, non_blocking=True), precision)
+        with main_util.autocast(precision, device):
+            head_outputs = head_model(sample_batch)
+        if cache is None:
+            cache = FeatureCacheDataset(file_path, len(dataset), head_outputs.shape[1:])
+        cache.write(start, head_outputs, targets)
+        start += head_outputs.shape[0]
+    cache.flush()
+    return cache
@@ -0,0 +1,158 @@
+import atexit
+import copy
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import torch
+
+from myutils.common import file_util
+
+WRITER = None
+
+
+def snapshot(obj):
+    """
+    Cheap point-in-time copy of a (nested) state dict: tensors are detached and cloned on their device, numpy arrays
+    are copied and any other object is copied shallowly, so that attributes reassigned by a later fit (e.g., the
+    arrays of a sklearn estimator) do not leak into the snapshot. Unlike copy.deepcopy, nothing else is duplicated.
+    Args:
+        obj: state dict (or any nesting of dicts, lists and tuples)
+
+    Returns: the snapshot
+
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().clone()
+    elif isinstance(obj, np.ndarray):
+        return obj.copy()
+    elif isinstance(obj, dict):
+        obj_snapshot = type(obj)((key, snapshot(value)) for key, value in obj.items())
+        if hasattr(obj, '_metadata'):
+            # per-module versions of a state_dict, used by load_state_dict for backward compatible loading
+            obj_snapshot._metadata = copy.copy(obj._metadata)
+        return obj_snapshot
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    elif obj is None or isinstance(obj, (str, bytes, int, float, bool, torch.device, torch.dtype)):
+        return obj
+    return copy.copy(obj)
+
+
+def atomic_save_dir(obj, dir_path, save_fn):
+    """
+    Directory counterpart of atomic_save: save_fn(obj, tmp_dir_path) fills a temporary directory next to dir_path,
+    which then replaces dir_path.
+    """
+    dir_path = os.path.abspath(dir_path)
+    file_util.make_parent_dirs(dir_path)
+    parent_dir_path, dir_name = os.path.split(dir_path)
+    tmp_dir_path = tempfile.mkdtemp(prefix='.{}.'.format(dir_name), suffix='.tmp', dir=parent_dir_path)
+    try:
+        save_fn(obj, tmp_dir_path)
+        if os.path.isfile(dir_path):
+            os.remove(dir_path)
+        if os.path.isdir(dir_path):
+            old_dir_path = tempfile.mkdtemp(prefix='.{}.'.format(dir_name), suffix='.old', dir=parent_dir_path)
+            os.replace(dir_path, old_dir_path)
+            os.replace(tmp_dir_path, dir_path)
+            shutil.rmtree(old_dir_path)
+        else:
+            os.replace(tmp_dir_path, dir_path)
+    except BaseException:
+        shutil.rmtree(tmp_dir_path, ignore_errors=True)
+        raise
+
+
+def atomic_save(obj, file_path, save_fn=torch.save):
+    """
+    Writes obj with save_fn(obj, file) to a temporary file next to file_path and renames it, so that a crash during
+    the write never leaves a truncated checkpoint behind.
+    """
+    file_util.make_parent_dirs(file_path)
+    dir_path, file_name = os.path.split(os.path.abspath(file_path))
+    fd, tmp_file_path = tempfile.mkstemp(prefix='.{}.'.format(file_name), suffix='.tmp', dir=dir_path)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            save_fn(obj, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
+
+
+class CheckpointWriter(object):
+    """
+    Background thread writing checkpoints while training goes on. submit() only takes a snapshot of the state and
+    enqueues it; at most max_pending snapshots wait in the queue (submit blocks beyond that), which bounds the extra
+    memory to max_pending + 1 copies of the state.
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = list()
+        self.thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            obj, file_path, save_fn, directory = self.queue.get()
+            try:
+                if directory:
+                    atomic_save_dir(obj, file_path, save_fn)
+                else:
+                    atomic_save(obj, file_path, save_fn)
+            except Exception as e:
+                print('Failed to save {}: {}'.format(file_path, e))
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, obj, file_path, save_fn=torch.save, directory=False, copy_state=True):
+        self.queue.put((snapshot(obj) if copy_state else obj, file_path, save_fn, directory))
+
+    def wait(self):
+        """
+        Blocks until every submitted checkpoint is on disk, and raises the first error met by the writer, if any.
+        """
+        self.queue.join()
+        if len(self.errors) > 0:
+            errors, self.errors = self.errors, list()
+            raise errors[0]
+
+
+def get_writer():
+    global WRITER
+    if WRITER is None:
+        WRITER = CheckpointWriter()
+        atexit.register(WRITER.wait)
+    return WRITER
+
+
+def save_async(obj, file_path, save_fn=torch.save, directory=False, copy_state=True):
+    """
+    Snapshots obj and saves it to file_path in background with save_fn(obj, file).
+    Args:
+        obj: state dict to save
+        file_path (str): destination path
+        save_fn: function writing obj to an open binary file (torch.save, pickle.dump, joblib.dump, ...)
+        directory (bool): file_path is a directory, filled by save_fn(obj, dir_path)
+        copy_state (bool): snapshot obj, False if the caller already passes a private copy (e.g., of objects that
+            copy.copy cannot duplicate, as faiss indexes)
+
+    """
+    get_writer().submit(obj, file_path, save_fn, directory, copy_state)
+
+
+def wait():
+    """
+    Waits for the pending checkpoints, to be called before reading back a checkpoint saved with save_async.
+    """
+    if WRITER is not None:
+        WRITER.wait()
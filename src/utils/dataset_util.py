@@ -1,4 +1,3 @@
-import copy
 import multiprocessing
 
 import os
@@ -12,7 +11,7 @@ import torchvision
 from torch.utils.data.sampler import Sampler
 from torchvision import transforms
 
-from structure.dataset import AdvRgbImageDataset
+from structure.dataset import AdvRgbImageDataset, SubsetDataset
 from utils import data_util
 
 
@@ -202,7 +201,52 @@ def get_datasets(dataset_config, compression_type=None, compressed_size=None, no
     return train_dataset, valid_dataset, test_dataset
 
 
-def get_loader(dataset, shuffle=False, order_labels=False, n_labels=None, batch_size=32, pin_memory=False):
+def get_targets(dataset):
+    return dataset.targets if hasattr(dataset, 'targets') else dataset.labels
+
+
+def get_subset_indexes(targets, n_labels=None, fraction_of_samples=1.0):
+    """
+    Resolve a label subset and a per-class fraction of samples into the (sorted) indexes of the selected samples.
+    For each label, the first samples in dataset order are kept.
+    Args:
+        targets: labels of the whole dataset
+        n_labels (int): only samples whose label is lower than n_labels are kept (all if None)
+        fraction_of_samples (float): fraction of samples kept for each label
+
+    Returns (np.ndarray):
+
+    """
+    targets = np.asarray(targets)
+    indexes = np.flatnonzero(targets < n_labels) if n_labels is not None else np.arange(len(targets))
+    if fraction_of_samples >= 1.0:
+        return indexes
+
+    indexes = indexes[np.argsort(targets[indexes], kind='stable')]
+    _, starts, counts = np.unique(targets[indexes], return_index=True, return_counts=True)
+    indexes = [indexes[start:start + int(fraction_of_samples * count)] for start, count in zip(starts, counts)]
+    return np.sort(np.concatenate(indexes))
+
+
+def get_subset(dataset, indexes):
+    """
+    Build a view of the dataset restricted to the given indexes, without copying its storage.
+    Args:
+        dataset (Dataset):
+        indexes (np.ndarray):
+
+    Returns (Dataset): the dataset itself if all its samples are selected
+
+    """
+    if len(indexes) == len(dataset):
+        return dataset
+    if hasattr(dataset, 'subset'):
+        return dataset.subset(indexes)
+    return SubsetDataset(dataset, indexes)
+
+
+def get_loader(dataset, shuffle=False, order_labels=False, n_labels=None, batch_size=32, pin_memory=False,
+               fraction_of_samples=1.0, drop_last=False):
     """
 
     Args:
@@ -212,24 +256,32 @@ def get_loader(dataset, shuffle=False, order_labels=False, n_labels=None, batch_
         n_labels (int):
         batch_size (int):
         pin_memory (Bool):
+        fraction_of_samples (float):
+        drop_last (Bool):
 
-    Returns (DataLoader):
+    Returns (DataLoader or TensorBatchLoader): a TensorBatchLoader if the dataset is backed by an in-memory tensor
 
     """
-    sub_dataset = copy.copy(dataset)
-    if n_labels is not None:
-        dataset.targets = np.array(dataset.targets)
-        sub_dataset.targets = np.array(sub_dataset.targets)
-        sub_dataset.targets = sub_dataset.targets[dataset.targets < n_labels]
-        sub_dataset.data = sub_dataset.data[dataset.targets < n_labels]
-
+    sub_dataset = dataset
+    if n_labels is not None or fraction_of_samples < 1.0:
+        indexes = get_subset_indexes(get_targets(dataset), n_labels, fraction_of_samples)
+        sub_dataset = get_subset(dataset, indexes)
+
+    if is_tensor_backed(sub_dataset):
+        return TensorBatchLoader(sub_dataset, batch_size=batch_size, shuffle=shuffle, order_labels=order_labels,
+                                 pin_memory=pin_memory, drop_last=drop_last)
     if order_labels:
         sampler = PerLabelSampler(sub_dataset, shuffle=shuffle)
     elif shuffle:
         sampler = RandomSampler(sub_dataset)
     else:
         sampler = SequentialSampler(sub_dataset)
-    return DataLoader(sub_dataset, batch_size=batch_size, sampler=sampler, pin_memory=pin_memory)
+    return DataLoader(sub_dataset, batch_size=batch_size, sampler=sampler, pin_memory=pin_memory, drop_last=drop_last)
+
+
+def is_tensor_backed(dataset):
+    return hasattr(dataset, 'get_storage') and getattr(dataset, 'transform', None) is None \
+           and torch.is_tensor(dataset.get_storage()[0])
 
 
 def get_indexes(dataset, data_batch):
@@ -274,6 +326,61 @@ class PerLabelSampler(Sampler):
         return len(self.data_source)
 
 
+class TensorBatchLoader(object):
+    r"""Iterates over a dataset backed by in-memory tensors (e.g., EmbeddingDataset) gathering whole batches with
+    index_select, instead of calling __getitem__ per sample and collating the results.
+
+    Arguments:
+        dataset (Dataset): dataset exposing get_storage(), returning data, targets and (optional) subset indexes
+        batch_size (int): how many samples per batch
+        shuffle (bool): iterate over a new random permutation at every epoch
+        order_labels (bool): iterate ordered per label, as PerLabelSampler does
+        pin_memory (bool): gather batches into page-locked buffers
+        drop_last (bool): drop the last incomplete batch
+    """
+
+    def __init__(self, dataset, batch_size=32, shuffle=False, order_labels=False, pin_memory=False, drop_last=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order_labels = order_labels
+        self.drop_last = drop_last
+        self.data, targets, indexes = dataset.get_storage()
+        self.pin_memory = pin_memory and torch.cuda.is_available() and not self.data.is_cuda
+        self.targets = torch.as_tensor(targets)
+        self.indexes = torch.as_tensor(indexes) if indexes is not None else None
+
+    def _get_order(self):
+        num_samples = len(self.dataset)
+        if self.order_labels:
+            targets = np.asarray(self.dataset.targets)
+            order = np.random.permutation(num_samples) if self.shuffle else np.arange(num_samples)
+            order = torch.from_numpy(order[np.argsort(targets[order], kind='stable')])
+        elif self.shuffle:
+            order = torch.randperm(num_samples)
+        else:
+            order = torch.arange(num_samples)
+        return order if self.indexes is None else self.indexes[order]
+
+    def _gather(self, storage, idx):
+        if not self.pin_memory:
+            return storage.index_select(0, idx)
+        # the caching host allocator recycles pinned blocks only once pending copies from them are done
+        out = torch.empty((len(idx), *storage.shape[1:]), dtype=storage.dtype, pin_memory=True)
+        return torch.index_select(storage, 0, idx, out=out)
+
+    def __iter__(self):
+        order = self._get_order()
+        for i in range(0, len(self) * self.batch_size, self.batch_size):
+            idx = order[i:i + self.batch_size]
+            yield self._gather(self.data, idx), self._gather(self.targets, idx)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
 def dataset_with_indices(cls):
     """
     Modifies the given Dataset class to return a tuple data, target, index
@@ -0,0 +1,89 @@
+import multiprocessing
+import pickle
+import time
+
+import numpy as np
+import torch
+
+from utils import dataset_util, main_util
+
+PARALLEL_JOB = dict()
+
+
+def _init_worker(run_fn, dataset, batch_size, workers, threads):
+    PARALLEL_JOB.update(run_fn=run_fn, dataset=dataset, batch_size=batch_size)
+    main_util.set_eval_policy(threads, workers)
+
+
+def _run_shard(shard_indexes):
+    shard, indexes = shard_indexes
+    main_util.pin_cpu_threads(shard, main_util.get_eval_workers(), main_util.get_eval_threads())
+    torch.set_num_threads(main_util.get_eval_threads())
+    shard_loader = dataset_util.get_loader(dataset_util.get_subset(PARALLEL_JOB['dataset'], indexes),
+                                           batch_size=PARALLEL_JOB['batch_size'])
+    metric_logger = PARALLEL_JOB['run_fn'](shard_loader)
+    for meter in metric_logger.meters.values():
+        if hasattr(meter, 'materialize'):
+            meter.materialize()
+    return metric_logger
+
+
+def run_data_parallel(run_fn, data_loader, workers, threads):
+    """
+    Shards the dataset of data_loader among workers processes (each pinned to threads cores), runs
+    run_fn(shard_loader) on every shard and merges the returned metric loggers.
+    The workers are started by a forkserver rather than forked from this process, whose OpenMP thread pool may
+    already be in use (forking it can deadlock the children with libgomp); run_fn (e.g., with the model and the early
+    exit classifier it references) and the dataset are therefore pickled to every worker, and the shard indexes are
+    sent with each task. If they cannot be pickled, the evaluation runs in this process. CPU evaluation only.
+    Args:
+        run_fn: function taking a data loader and returning a MetricLogger
+        data_loader: loader of the whole evaluation set
+        workers (int):
+        threads (int): intra-op threads per worker
+
+    Returns (MetricLogger): the logger merging all the shards
+
+    """
+    shards = list(enumerate(np.array_split(np.arange(len(data_loader.dataset)), workers)))
+    context = multiprocessing.get_context('forkserver')
+    try:
+        pool = context.Pool(workers, initializer=_init_worker,
+                            initargs=(run_fn, data_loader.dataset, data_loader.batch_size, workers, threads))
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        print('Cannot send the evaluation to worker processes ({}), evaluating in this process'.format(e))
+        return run_fn(data_loader)
+    with pool:
+        metric_loggers = pool.map(_run_shard, shards)
+    metric_logger = metric_loggers[0]
+    for shard_metric_logger in metric_loggers[1:]:
+        metric_logger.merge(shard_metric_logger)
+    return metric_logger
+
+
+def print_throughput_curve(run_fn, data_loader, splits=None):
+    """
+    Times the data-parallel evaluation for several workers x threads splits of the available cores, to tune the
+    'workers' and 'threads' entries of the test configuration.
+    Args:
+        run_fn: function taking a data loader and returning a MetricLogger
+        data_loader: loader of the evaluation set
+        splits (list): (workers, threads) pairs, by default powers of two of workers sharing all the cores
+
+    Returns (list): (workers, threads, images per second) tuples
+
+    """
+    num_cpus = len(main_util.get_available_cpus())
+    if splits is None:
+        splits = [(2 ** i, num_cpus // 2 ** i) for i in range(int(np.log2(num_cpus)) + 1)]
+    num_samples = len(data_loader.dataset)
+    curve = list()
+    print('Evaluation throughput ({} samples, {} cores)'.format(num_samples, num_cpus))
+    print('workers x threads:   img/s')
+    for workers, threads in splits:
+        start_time = time.time()
+        run_data_parallel(run_fn, data_loader, workers, threads)
+        throughput = num_samples / (time.time() - start_time)
+        curve.append((workers, threads, throughput))
+        print('{:7d} x {:7d}: {:7.1f}'.format(workers, threads, throughput))
+    return curve
@@ -1,4 +1,5 @@
 import builtins as __builtin__
+import contextlib
 import json
 import os
 
@@ -38,26 +39,83 @@ def setup_for_distributed(is_master):
     __builtin__.print = print
 
 
-def init_distributed_mode(world_size=1, dist_url='env://'):
+EVAL_POLICY = {'threads': None, 'workers': 1}
+
+
+def get_available_cpus():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+
+def pin_cpu_threads(local_rank, local_world_size, num_threads=None):
+    """
+    Splits the CPUs available on the node among its local processes: each rank is pinned to its own contiguous block
+    of cores (of num_threads cores, if given) and sizes its intra-op thread pool to the block.
+    """
+    cpus = get_available_cpus()
+    cpus_per_rank = num_threads if num_threads else max(len(cpus) // local_world_size, 1)
+    rank_cpus = cpus[local_rank * cpus_per_rank:(local_rank + 1) * cpus_per_rank] or cpus
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, rank_cpus)
+    torch.set_num_threads(num_threads if num_threads else len(rank_cpus))
+    return torch.get_num_threads()
+
+
+def set_eval_policy(threads=None, workers=1):
+    """
+    Sets how the evaluation entry points use the CPU: the number of intra-op threads (None keeps the current
+    setting, split among workers if more than one), and the number of worker processes the test set is sharded
+    among (data-parallel evaluation, CPU only).
+    """
+    EVAL_POLICY['threads'] = threads
+    EVAL_POLICY['workers'] = max(int(workers), 1)
+
+
+def get_eval_workers():
+    return EVAL_POLICY['workers']
+
+
+def get_eval_threads():
+    if EVAL_POLICY['threads']:
+        return EVAL_POLICY['threads']
+    return max(torch.get_num_threads() // EVAL_POLICY['workers'], 1)
+
+
+def init_distributed_mode(world_size=1, dist_url='env://', device='cuda'):
+    """
+    Initializes the process group: nccl with one GPU per process if the device is a GPU, gloo with per-rank CPU
+    thread pinning otherwise (in this case, the returned device_ids is None, as expected by DistributedDataParallel
+    for CPU modules).
+    """
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         rank = int(os.environ['RANK'])
         world_size = int(os.environ['WORLD_SIZE'])
-        device_id = int(os.environ['LOCAL_RANK'])
+        local_rank = int(os.environ['LOCAL_RANK'])
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        device_id = local_rank
     elif 'SLURM_PROCID' in os.environ:
         rank = int(os.environ['SLURM_PROCID'])
-        device_id = rank % torch.cuda.device_count()
+        local_rank = int(os.environ.get('SLURM_LOCALID', 0))
+        local_world_size = int(os.environ.get('SLURM_NTASKS_PER_NODE', 1))
+        device_id = rank % torch.cuda.device_count() if torch.cuda.is_available() else local_rank
     else:
         print('Not using distributed mode')
         return False, None
 
-    torch.cuda.set_device(device_id)
-    dist_backend = 'nccl'
+    if torch.cuda.is_available() and 'cuda' in str(device):
+        torch.cuda.set_device(device_id)
+        dist_backend = 'nccl'
+        device_ids = [device_id]
+    else:
+        num_threads = pin_cpu_threads(local_rank, local_world_size)
+        print('| rank {}: {} CPU threads'.format(rank, num_threads), flush=True)
+        dist_backend = 'gloo'
+        device_ids = None
     print('| distributed init (rank {}): {}'.format(rank, dist_url), flush=True)
     torch.distributed.init_process_group(backend=dist_backend, init_method=dist_url,
                                          world_size=world_size, rank=rank)
     torch.distributed.barrier()
     setup_for_distributed(rank == 0)
-    return True, [device_id]
+    return True, device_ids
 
 
 def is_dist_avail_and_initialized():
@@ -74,6 +132,13 @@ def get_rank():
     return dist.get_rank()
 
 
+def get_sync_device():
+    """
+    Device of the tensors exchanged by collective operations, as required by the process group backend.
+    """
+    return torch.device('cuda' if dist.get_backend() == 'nccl' else 'cpu')
+
+
 def save_on_master(*args, **kwargs):
     if is_main_process():
         torch.save(*args, **kwargs)
@@ -102,6 +167,25 @@ def get_data_loaders(config, distributed):
     raise ValueError('dataset_name `{}` is not expected'.format(dataset_name))
 
 
+def autocast(precision, device):
+    """
+    Context for the forward passes: bfloat16 autocast if precision is 'bf16', plain fp32 otherwise.
+    Losses should be computed outside of it, on outputs cast back to float.
+    """
+    if precision == 'bf16':
+        return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def to_channels_last(x, precision):
+    """
+    Converts a module or a batch of images to the channels_last memory format if precision is 'bf16'.
+    """
+    if precision != 'bf16' or (torch.is_tensor(x) and x.dim() != 4):
+        return x
+    return x.to(memory_format=torch.channels_last)
+
+
 def compute_accuracy(output, target, topk=(1,)):
     if len(target) == 0:
         return [torch.zeros(1) for _ in topk]
@@ -3,10 +3,6 @@ import time
 import torch
 import numpy as np
 
-from pytorch_metric_learning import miners, losses, distances, reducers, trainers, samplers, testers
-from pytorch_metric_learning.utils import logging_presets
-from pytorch_metric_learning.utils.accuracy_calculator import AccuracyCalculator
-
 from torch import nn
 from torch.nn import Module
 
@@ -27,6 +23,10 @@ def learn_dataset(dataset, device, n_labels=None, epochs=20):
     Returns (Module):
 
     """
+    from pytorch_metric_learning import miners, losses, distances, reducers, trainers, samplers, testers
+    from pytorch_metric_learning.utils import logging_presets
+    from pytorch_metric_learning.utils.accuracy_calculator import AccuracyCalculator
+
     pin_memory = 'cuda' in device.type
     loader = dataset_util.get_loader(dataset, shuffle=True, n_labels=n_labels, pin_memory=pin_memory)
     sampler = samplers.MPerClassSampler(dataset.targets, m=4, length_before_new_iter=len(dataset))
@@ -135,7 +135,7 @@ def _train(model, loss_fn, mining_func, device, train_loader, optimizer, epoch):
         loss = loss_fn(embeddings, targets, indices_tuple)
         loss.backward()
         optimizer.step()
-        metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        metric_logger.update(loss=loss, lr=optimizer.param_groups[0]['lr'])
         metric_logger.meters['img/s'].update(sample_batch.shape[0] / (time.time() - start_time))
         #metric_logger.meters['n_triplets'].update(mining_func.num_triplets)
 
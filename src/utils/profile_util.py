@@ -0,0 +1,122 @@
+import atexit
+import contextlib
+import os
+import time
+
+import torch
+from torch import profiler
+
+from utils import main_util
+
+PROFILER = None
+DEFAULT_WINDOW = '1,2,5'
+
+
+def add_argument(argparser):
+    argparser.add_argument('--profile', nargs='?', const=DEFAULT_WINDOW, metavar='WAIT,WARMUP,ACTIVE[,REPEAT]',
+                           help='profile a window of steps (log_every iterations) with torch.profiler, skipping WAIT '
+                                'and warming up on WARMUP steps before recording ACTIVE ones, REPEAT times '
+                                '(default window: {})'.format(DEFAULT_WINDOW))
+
+
+def parse_window(window):
+    """
+    Args:
+        window (str): 'wait,warmup,active[,repeat]' steps
+
+    Returns (tuple): wait, warmup, active and repeat (1 if not given)
+
+    """
+    values = [int(value) for value in window.split(',')]
+    if len(values) not in (3, 4) or any(value < 0 for value in values) or values[2] == 0:
+        raise ValueError('Expected a profiling window as wait,warmup,active[,repeat], got `{}`'.format(window))
+    return tuple(values) if len(values) == 4 else tuple(values) + (1,)
+
+
+def get_output_dir(config, runner_name):
+    """
+    Returns (str): profiling directory of this run, under the one of the experiment (the experiment of the early
+    exit, student, mimic or plain model of the configuration, in this order)
+    """
+    experiment = 'default'
+    for key in ['ee_model', 'student_model', 'mimic_model', 'model']:
+        if isinstance(config.get(key, None), dict) and 'experiment' in config[key]:
+            experiment = config[key]['experiment']
+            break
+    return os.path.join('./resource/profile/', experiment,
+                        '{}_{}'.format(runner_name, time.strftime('%Y%m%d-%H%M%S')))
+
+
+def export(prof, output_dir, top_k):
+    """
+    Writes the Chrome trace and the table of the top_k operators (by self time) of a finished profiling cycle.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    file_prefix = os.path.join(output_dir, 'rank{}-step{}'.format(main_util.get_rank(), prof.step_num))
+    prof.export_chrome_trace(file_prefix + '.trace.json')
+    sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+    with open(file_prefix + '.top_ops.txt', 'w') as fp:
+        fp.write(prof.key_averages().table(sort_by=sort_by, row_limit=top_k))
+    print('Profile of the steps before {} saved to {}.*'.format(prof.step_num, file_prefix))
+
+
+def start(window, output_dir, top_k=20):
+    """
+    Starts profiling the steps of the window (see parse_window) with torch.profiler; the profiler is stopped at exit
+    at the latest.
+    Args:
+        window (str): 'wait,warmup,active[,repeat]' steps
+        output_dir (str): directory of the Chrome traces and of the top_k operator tables
+        top_k (int): number of rows of the operator tables
+
+    """
+    global PROFILER
+    stop()
+    wait, warmup, active, repeat = parse_window(window)
+    activities = [profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(profiler.ProfilerActivity.CUDA)
+    PROFILER = profiler.profile(activities=activities,
+                                schedule=profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+                                on_trace_ready=lambda prof: export(prof, output_dir, top_k),
+                                record_shapes=True, profile_memory=True)
+    PROFILER.__enter__()
+    atexit.register(stop)
+
+
+def stop():
+    global PROFILER
+    if PROFILER is not None:
+        prof, PROFILER = PROFILER, None
+        prof.__exit__(None, None, None)
+
+
+def step():
+    """
+    Marks the end of a step.
+    """
+    if PROFILER is not None:
+        PROFILER.step()
+
+
+def iterate(iterable):
+    """
+    Yields the items of iterable (e.g., the batches of a data loader), each fetch in a 'data_load' range, and ends a
+    profiler step every time the consumer asks for the next item.
+    """
+    iterator = iter(iterable)
+    while True:
+        with record('data_load'):
+            try:
+                obj = next(iterator)
+            except StopIteration:
+                return
+        yield obj
+        step()
+
+
+def record(name):
+    """
+    Returns: a torch.profiler range named name while profiling, a no-op context otherwise
+    """
+    return profiler.record_function(name) if PROFILER is not None else contextlib.nullcontext()